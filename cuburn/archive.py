@@ -0,0 +1,139 @@
+"""
+Indexed frame archives.
+
+Writing one file per frame leaves huge numbers of small files behind. An
+archive instead appends each encoded file to a single blob, ``PATH.cuba``,
+and records its name, offset and size in a text index, ``PATH.cuba.idx``,
+with one ``offset size name`` line per member.
+
+Index entries are only written after the data they describe has been synced
+to disk, and syncs are batched, so a crash loses at most one batch of
+frames and never leaves an index entry pointing at missing data. Reopening
+an archive for writing discards anything written after the last complete
+index entry. If a name is added more than once, the last entry wins.
+"""
+
+import os
+import mmap
+import time
+import shutil
+from collections import OrderedDict
+
+BLOB_SUFFIX = '.cuba'
+INDEX_SUFFIX = '.cuba.idx'
+
+def _parse_index(data):
+    """
+    Parse the text of an index, returning an ordered dict mapping names to
+    `(offset, size)`, and the length of the text up to the end of the last
+    complete line.
+    """
+    entries = OrderedDict()
+    end = data.rfind('\n') + 1
+    for line in data[:end].splitlines():
+        off, size, name = line.split(' ', 2)
+        entries.pop(name, None)
+        entries[name] = (int(off), int(size))
+    return entries, end
+
+def read_index(path):
+    """
+    Return an ordered dict mapping the names of the members of the archive
+    at ``path`` (without suffix) to `(offset, size)`. Returns an empty dict
+    if there is no archive at ``path``.
+    """
+    try:
+        with open(path + INDEX_SUFFIX, 'rb') as fp:
+            return _parse_index(fp.read())[0]
+    except IOError:
+        return OrderedDict()
+
+class ArchiveWriter(object):
+    """
+    Appends files to the archive at ``path``, creating it if needed. Added
+    files are synced to disk and indexed once ``sync_every`` files or
+    ``sync_interval`` seconds have accumulated, and on `sync` or `close`.
+    """
+    def __init__(self, path, sync_every=64, sync_interval=10):
+        self.path = path
+        self.sync_every, self.sync_interval = sync_every, sync_interval
+        self.blob = open(path + BLOB_SUFFIX, 'ab+')
+        self.index = open(path + INDEX_SUFFIX, 'ab+')
+
+        # Discard any torn index line, and data not covered by the index
+        self.index.seek(0)
+        entries, end = _parse_index(self.index.read())
+        self.index.truncate(end)
+        self.blob.truncate(max([o + s for o, s in entries.values()] or [0]))
+        self.blob.seek(0, os.SEEK_END)
+
+        self._pending = []
+        self._last_sync = time.time()
+
+    def add(self, name, data):
+        """
+        Append a member to the archive. ``data`` may be a string or a
+        file-like object, which will be read from its current position.
+        """
+        if '\n' in name:
+            raise ValueError('Invalid archive member name %r' % name)
+        off = self.blob.tell()
+        if isinstance(data, basestring):
+            self.blob.write(data)
+        else:
+            shutil.copyfileobj(data, self.blob, 1 << 20)
+        self._pending.append((off, self.blob.tell() - off, name))
+        if (len(self._pending) >= self.sync_every or
+                time.time() - self._last_sync > self.sync_interval):
+            self.sync()
+
+    def sync(self):
+        """Sync all added data to disk, and then index it."""
+        self._last_sync = time.time()
+        if not self._pending:
+            return
+        self.blob.flush()
+        os.fsync(self.blob.fileno())
+        self.index.write(''.join('%d %d %s\n' % p for p in self._pending))
+        self.index.flush()
+        os.fsync(self.index.fileno())
+        self._pending = []
+
+    def close(self):
+        self.sync()
+        self.blob.close()
+        self.index.close()
+
+class ArchiveReader(object):
+    """
+    Random access to the members of the archive at ``path``, by name. The
+    blob is memory-mapped, and members are returned as read-only buffers
+    into the map, without copying.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.entries = read_index(path)
+        self._fp = open(path + BLOB_SUFFIX, 'rb')
+        self._map = None
+        if os.fstat(self._fp.fileno()).st_size:
+            self._map = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def names(self):
+        return self.entries.keys()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __getitem__(self, name):
+        off, size = self.entries[name]
+        if not size:
+            return ''
+        return buffer(self._map, off, size)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+        self._fp.close()
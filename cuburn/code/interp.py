@@ -4,6 +4,7 @@ import numpy as np
 from cuburn.genome import specs
 from cuburn.genome.util import resolve_spec
 from cuburn.genome.use import Wrapper, SplineEval
+from cuburn.genome.soa import GenomeArrays
 
 import util
 from util import Template, assemble_code, devlib, binsearchlib, ringbuflib, snd
@@ -208,6 +209,9 @@ class GenomePacker(object):
         """
         Return a packed copy of the genome ready for uploading to the GPU,
         as two float32 NDArrays for the knot times and values.
+
+        ``gnm`` may be a plain dict or a `GenomeArrays` instance; the latter
+        is packed by array indexing instead of walking the genome.
         """
         width = 1 << self.search_rounds
         if pool:
@@ -215,6 +219,12 @@ class GenomePacker(object):
             knots = pool.allocate((len(self.genome), width), 'f4')
         else:
             times, knots = np.empty((2, len(self.genome), width), 'f4')
+
+        if isinstance(gnm, GenomeArrays):
+            scale = gnm.other.get('time.duration', 1)
+            return gnm.normalized(self.genome, scale, width, times, knots,
+                                  specs.anim)
+
         times.fill(1e9)
 
         # TODO: do a nicer job of finding the value of scale
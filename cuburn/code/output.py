@@ -70,6 +70,98 @@ __global__ void f32_to_rgba_u16(
     rctxs[rb_incr(rb->tail, tid)] = rctx;
 }
 
+// Convert to half-precision RGBA, for HDR output. Values are not clamped or
+// dithered, except that negative and non-finite inputs become zero.
+__device__ unsigned short f32_to_f16(float in) {
+    unsigned short out;
+    in = isfinite(in) ? fmaxf(0.0f, in) : 0.0f;
+    asm("cvt.rn.f16.f32 %0, %1;" : "=h"(out) : "f"(in));
+    return out;
+}
+
+__global__ void f32_to_rgba_f16(
+    ushort4 *dst, const float4 *src,
+    int gutter, int dstride, int sstride, int height)
+{
+    int x = blockIdx.x * blockDim.x + threadIdx.x;
+    int y = blockIdx.y * blockDim.y + threadIdx.y;
+    if (x >= dstride || y >= height) return;
+    int isrc = sstride * (y + gutter) + x + gutter;
+
+    float4 in = src[isrc];
+    dst[dstride * y + x] = make_ushort4(f32_to_f16(in.x), f32_to_f16(in.y),
+                                        f32_to_f16(in.z), f32_to_f16(in.w));
+}
+
+// Perform a conversion from float32 values to packed 16-bit RGB, as consumed
+// directly by encoders taking rgb48 input. If 'alpha' is set, the packed RGB
+// is followed by a YV12 frame carrying the alpha channel as its luma plane
+// and neutral chroma, for encoding as a separate stream.
+__global__ void f32_to_rgb48(
+    uint16_t *dst, const float4 *src,
+    int gutter, int dstride, int sstride, int height,
+    ringbuf *rb, mwc_st *rctxs, int alpha)
+{
+    int x = blockIdx.x * blockDim.x + threadIdx.x;
+    int y = blockIdx.y * blockDim.y + threadIdx.y;
+    if (x >= dstride || y >= height) return;
+    int isrc = sstride * (y + gutter) + x + gutter;
+
+    int tid = blockDim.x * threadIdx.y + threadIdx.x;
+    mwc_st rctx = rctxs[rb_incr(rb->head, tid)];
+
+    float4 in = src[isrc];
+    int ipix = dstride * y + x;
+    dst[3 * ipix]     = dclampf(rctx, 65535.0f, in.x);
+    dst[3 * ipix + 1] = dclampf(rctx, 65535.0f, in.y);
+    dst[3 * ipix + 2] = dclampf(rctx, 65535.0f, in.z);
+
+    if (alpha) {
+        int npix = dstride * height;
+        dst[3 * npix + ipix] = dclampf(rctx, 65535.0f, in.w);
+        // The two chroma planes hold half as many samples as luma, together
+        if (ipix < npix / 2) dst[4 * npix + ipix] = 32767;
+    }
+    rctxs[rb_incr(rb->tail, tid)] = rctx;
+}
+
+// Convert from rgb444 to planar 8-bit YUV 4:2:0, using JPEG full-range
+// primaries. Chroma is subsampled using alpha-weighted averages, as in
+// f32_to_yuv420p10. Both dimensions must be even.
+__global__ void f32_to_yuv420p(
+    unsigned char *dst, const float4 *src,
+    int gutter, int dstride, int sstride, int height,
+    ringbuf *rb, mwc_st *rctxs)
+{
+    int x = blockIdx.x * blockDim.x + threadIdx.x;
+    int y = blockIdx.y * blockDim.y + threadIdx.y;
+    if (x >= dstride || y >= height) return;
+    int tid = blockDim.x * threadIdx.y + threadIdx.x;
+    mwc_st rctx = rctxs[rb_incr(rb->head, tid)];
+
+    int isrc = sstride * (y + gutter) + x + gutter;
+    int idst = dstride * y + x;
+    float4 in = src[isrc];
+    dst[idst] = dclampf(rctx, 255.0f, 0.299f * in.x + 0.587f * in.y + 0.114f * in.z);
+
+    if (x * 2 < dstride && y * 2 < height) {
+        isrc = sstride * (y * 2 + gutter) + x * 2 + gutter;
+        float sum = 1e-12f, cb = 0.0f, cr = 0.0f;
+        for (int i = 0; i < 4; i++) {
+            in = src[isrc + (i & 1) + (i >> 1) * sstride];
+            sum += in.w;
+            cb += in.w * (-0.168736f  * in.x - 0.331264f  * in.y + 0.5f       * in.z);
+            cr += in.w * (0.5f        * in.x - 0.418688f  * in.y - 0.081312f  * in.z);
+        }
+        idst = dstride * height + dstride / 2 * y + x;
+        dst[idst] = dclampf(rctx, 255.0f, cb / sum + 0.5f);
+        idst += dstride * height / 4;
+        dst[idst] = dclampf(rctx, 255.0f, cr / sum + 0.5f);
+    }
+
+    rctxs[rb_incr(rb->tail, tid)] = rctx;
+}
+
 // Convert from rgb444 to planar YUV with no chroma subsampling.
 // Uses JPEG full-range color primaries.
 __global__ void f32_to_yuv444p(
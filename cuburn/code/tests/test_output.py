@@ -122,3 +122,63 @@ class ProfileTest(unittest.TestCase, util.ClsMod):
         self.assertTrue(172 <= out_cr[0,0] <= 174)
         self.assertTrue(511 <= out_cr[0,1] <= 512)
         self.assertTrue(511 <= out_cr[1,0] <= 512)
+
+    def test_rgb48_alpha_layout(self):
+        ins = np.zeros((self.dim.ah, self.dim.astride, 4), dtype='f4')
+        ins[self.fb.gutter,self.fb.gutter+1,:] = [1, 0, 0.5, 1]
+        cuda.memcpy_htod(self.fb.d_front, ins)
+
+        launchC('f32_to_rgb48', self.mod, None, self.dim, self.fb,
+                self.fb.d_rb, self.fb.d_seeds, np.int32(1))
+
+        w, h = self.dim.w, self.dim.h
+        outs = np.empty(w * h * 9 / 2, dtype='u2')
+        cuda.memcpy_dtoh(outs, self.fb.d_back)
+        rgb = outs[:w*h*3].reshape(h, w, 3)
+        alpha = outs[w*h*3:w*h*4].reshape(h, w)
+        chroma = outs[w*h*4:]
+
+        self.assertTrue(np.all(rgb[0,0] == 0))
+        self.assertEquals(65535, rgb[0,1,0])
+        self.assertEquals(0, rgb[0,1,1])
+        self.assertTrue(32767 <= rgb[0,1,2] <= 32768)
+        self.assertEquals(65535, alpha[0,1])
+        self.assertEquals(1, np.count_nonzero(alpha))
+        self.assertTrue(np.all(chroma == 32767))
+
+    def test_yuv420p_layout(self):
+        ins = np.zeros((self.dim.ah, self.dim.astride, 4), dtype='f4')
+        ins[self.fb.gutter,self.fb.gutter,:] = [0, 1, 0, 1]
+        cuda.memcpy_htod(self.fb.d_front, ins)
+
+        launchC('f32_to_yuv420p', self.mod, None, self.dim, self.fb,
+                self.fb.d_rb, self.fb.d_seeds)
+
+        w, h = self.dim.w, self.dim.h
+        outs = np.empty(w * h * 3 / 2, dtype='u1')
+        cuda.memcpy_dtoh(outs, self.fb.d_back)
+        luma = outs[:w*h].reshape(h, w)
+        cb = outs[w*h:w*h*5/4].reshape(h/2, w/2)
+        cr = outs[w*h*5/4:].reshape(h/2, w/2)
+
+        self.assertTrue(luma[0,0] > 0)
+        self.assertEquals(1, np.count_nonzero(luma))
+        self.assertTrue(cb[0,0] < 127)
+        self.assertTrue(cr[0,0] < 127)
+        self.assertTrue(np.all(127 <= cb.flat[1:]))
+        self.assertTrue(np.all(cb.flat[1:] <= 128))
+
+    def test_rgba_f16(self):
+        ins = np.zeros((self.dim.ah, self.dim.astride, 4), dtype='f4')
+        ins[self.fb.gutter,self.fb.gutter,:] = [0.1, 2.5, -1, np.nan]
+        ins[self.fb.gutter,self.fb.gutter+1,:] = [70000, 1, 0, 1]
+        cuda.memcpy_htod(self.fb.d_front, ins)
+
+        launchC('f32_to_rgba_f16', self.mod, None, self.dim, self.fb)
+
+        outs = np.empty((self.dim.h, self.dim.w, 4), dtype='f2')
+        cuda.memcpy_dtoh(outs, self.fb.d_back)
+        self.assertTrue(np.all(outs[0,0] == np.float16([0.1, 2.5, 0, 0])))
+        self.assertTrue(np.isinf(outs[0,1,0]))
+        self.assertEquals(0, np.count_nonzero(outs[1:]))
+
@@ -15,6 +15,8 @@ except ImportError, e:
 import numpy as np
 import tempita
 
+from cuburn.genome.spectypes import SEARCH_ROUNDS
+
 fst = lambda (a,b): a
 snd = lambda (a,b): b
 
@@ -230,10 +232,8 @@ __device__ int bitwise_binsearch(const float *hay, float needle) {
 ''', 'bitwise_binsearch')
     return devlib(defs=src.substitute(search_rounds=rounds))
 
-# 2^search_rounds is the maximum number of knots allowed in a single spline.
-# This includes the four required knots, so a 5 round search supports 28
-# interior knots in the domain (0, 1). 2^5 fits nicely on a single cache line.
-DEFAULT_SEARCH_ROUNDS = 5
+# The knot limit is part of the genome format; see `genome.spectypes`.
+DEFAULT_SEARCH_ROUNDS = SEARCH_ROUNDS
 binsearchlib = mkbinsearchlib(DEFAULT_SEARCH_ROUNDS)
 
 
@@ -0,0 +1,137 @@
+"""
+A minimal OpenEXR writer (and reader, for the files it writes), in numpy.
+
+Images are written as single-part scanline files with half-float channels,
+either uncompressed or with ZIP compression (zlib applied to blocks of 16
+scanlines, after the byte reordering and delta predictor OpenEXR uses), so
+they can be read by any OpenEXR-based tool.
+"""
+
+import zlib
+import struct
+import numpy as np
+
+MAGIC = 20000630
+VERSION = 2
+
+# Compression type codes, and the number of scanlines in each chunk
+COMPRESSION = dict(none=(0, 1), zip=(3, 16))
+HALF = 1
+
+def _attr(name, kind, value):
+    return ''.join([name, '\0', kind, '\0', struct.pack('<i', len(value)),
+                    value])
+
+def _header(w, h, channels, compression):
+    chlist = ''.join(name + '\0' + struct.pack('<iB3xii', HALF, 0, 1, 1)
+                     for name in channels) + '\0'
+    box = struct.pack('<iiii', 0, 0, w - 1, h - 1)
+    return ''.join([
+        struct.pack('<ii', MAGIC, VERSION),
+        _attr('channels', 'chlist', chlist),
+        _attr('compression', 'compression',
+              chr(COMPRESSION[compression][0])),
+        _attr('dataWindow', 'box2i', box),
+        _attr('displayWindow', 'box2i', box),
+        _attr('lineOrder', 'lineOrder', '\0'),
+        _attr('pixelAspectRatio', 'float', struct.pack('<f', 1)),
+        _attr('screenWindowCenter', 'v2f', struct.pack('<ff', 0, 0)),
+        _attr('screenWindowWidth', 'float', struct.pack('<f', 1)),
+        '\0'])
+
+def _zip(raw, level):
+    raw = np.frombuffer(raw, 'u1')
+    tmp = np.concatenate([raw[0::2], raw[1::2]])
+    tmp[1:] = np.diff(tmp) + 128
+    data = zlib.compress(tmp.tostring(), level)
+    # Readers take a chunk that didn't shrink to be stored uncompressed
+    return data if len(data) < len(raw) else raw.tostring()
+
+def _unzip(data, size):
+    if len(data) == size:
+        return data
+    tmp = np.frombuffer(zlib.decompress(data), 'u1')
+    tmp = np.cumsum(tmp - np.uint8(128), dtype='u1') + np.uint8(128)
+    half = (size + 1) / 2
+    raw = np.empty(size, 'u1')
+    raw[0::2], raw[1::2] = tmp[:half], tmp[half:]
+    return raw.tostring()
+
+def write(fp, img, channels='RGBA', compression='zip', level=6):
+    """
+    Write `img`, a `(height, width, nchannels)` array, to the file-like
+    object `fp` as EXR. `channels` names the channels in order. Values are
+    converted to half-float if needed.
+    """
+    h, w, nch = img.shape
+    if len(channels) != nch:
+        raise ValueError('Expected %d channel names' % nch)
+    if compression not in COMPRESSION:
+        raise ValueError('Unsupported EXR compression: %s' % compression)
+    lines = COMPRESSION[compression][1]
+
+    # Channels are stored in name order, each scanline holding the whole
+    # row of each channel in turn
+    order = sorted(range(nch), key=lambda i: channels[i])
+    planar = np.empty((h, nch, w), '<f2')
+    for i, src in enumerate(order):
+        planar[:,i] = img[:,:,src]
+
+    chunks = []
+    for y in range(0, h, lines):
+        raw = planar[y:y+lines].tostring()
+        if compression == 'zip':
+            raw = _zip(raw, level)
+        chunks.append(struct.pack('<ii', y, len(raw)) + raw)
+
+    header = _header(w, h, [channels[i] for i in order], compression)
+    offsets, pos = [], fp.tell() + len(header) + 8 * len(chunks)
+    for chunk in chunks:
+        offsets.append(pos)
+        pos += len(chunk)
+    fp.write(header)
+    fp.write(np.array(offsets, '<u8').tostring())
+    for chunk in chunks:
+        fp.write(chunk)
+
+def read(fp):
+    """
+    Read an EXR file written by `write`, returning `(img, channels)`, where
+    `img` is a float16 array of shape `(height, width, nchannels)` and
+    `channels` is a string of channel names, in storage order.
+    """
+    data = fp.read()
+    magic, version = struct.unpack_from('<ii', data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('Not a single-part scanline EXR file')
+    pos, attrs = 8, {}
+    while data[pos] != '\0':
+        name, kind, rest = data[pos:pos+512].split('\0', 2)
+        pos += len(name) + len(kind) + 2
+        size, = struct.unpack_from('<i', data, pos)
+        attrs[name] = data[pos+4:pos+4+size]
+        pos += 4 + size
+    pos += 1
+
+    channels, chlist = '', attrs['channels']
+    while chlist[0] != '\0':
+        name, chlist = chlist.split('\0', 1)
+        if struct.unpack_from('<i', chlist)[0] != HALF:
+            raise ValueError('Only half-float channels are supported')
+        channels, chlist = channels + name, chlist[16:]
+    x0, y0, x1, y1 = struct.unpack('<iiii', attrs['dataWindow'])
+    w, h, nch = x1 - x0 + 1, y1 - y0 + 1, len(channels)
+    comp = ord(attrs['compression'])
+    lines = dict(COMPRESSION.values())[comp]
+
+    nchunks = (h + lines - 1) / lines
+    offsets = np.frombuffer(data, '<u8', nchunks, pos)
+    planar = np.empty((h, nch, w), '<f2')
+    for off in map(int, offsets):
+        y, size = struct.unpack_from('<ii', data, off)
+        raw = data[off+8:off+8+size]
+        rows = min(lines, h - (y - y0))
+        if comp:
+            raw = _unzip(raw, rows * nch * w * 2)
+        planar[y-y0:y-y0+rows] = np.frombuffer(raw, '<f2').reshape(rows, nch, w)
+    return planar.transpose(0, 2, 1).copy(), channels
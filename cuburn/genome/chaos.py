@@ -0,0 +1,347 @@
+"""
+A small, vectorized host-side chaos game, for cheaply estimating properties
+of the attractor of an animation at a given time (bounds, convergence, and
+the like) without compiling or launching anything on the device.
+
+This is not a renderer. It only follows point positions, it supports a
+subset of the variations in `cuburn.code.variations` (others are treated as
+linear, and listed in `ChaosGame.unsupported`), and it uses ordinary random
+xform selection rather than the device's cooperative selection. The
+iteration, reset and camera logic otherwise mirror `iter_body_code`.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+from soa import GenomeArrays
+from specs import toplevels
+from util import resolve_spec
+
+# Point positions produced by a run. ``x`` and ``y`` are in frame units, as
+# produced by the camera transform: the frame spans [-0.5, 0.5] horizontally
+# and is centered vertically. ``resets`` counts the points that went
+# non-finite and were reseeded; ``iters`` is the total number of iterations.
+Samples = namedtuple('Samples', 'x y resets iters')
+
+def _ra(tx, ty):
+    return np.sqrt(tx*tx + ty*ty), np.arctan2(tx, ty)
+
+# Each variation takes `(tx, ty, w, pv, px, rand)`, where ``pv`` looks up a
+# variation parameter by name, ``px`` holds the coefficients of the xform's
+# pre-affine transform, and ``rand`` is a `RandomState`. Returns `(ox, oy)`.
+_vars = {}
+
+def _var(fn):
+    _vars[fn.__name__] = fn
+    return fn
+
+@_var
+def linear(tx, ty, w, pv, px, rand):
+    return w * tx, w * ty
+
+@_var
+def sinusoidal(tx, ty, w, pv, px, rand):
+    return w * np.sin(tx), w * np.sin(ty)
+
+@_var
+def spherical(tx, ty, w, pv, px, rand):
+    r2 = w / (tx*tx + ty*ty)
+    return tx * r2, ty * r2
+
+@_var
+def swirl(tx, ty, w, pv, px, rand):
+    r2 = tx*tx + ty*ty
+    c1, c2 = np.sin(r2), np.cos(r2)
+    return w * (c1*tx - c2*ty), w * (c2*tx + c1*ty)
+
+@_var
+def horseshoe(tx, ty, w, pv, px, rand):
+    r = w / np.sqrt(tx*tx + ty*ty)
+    return r * (tx - ty) * (tx + ty), 2 * tx * ty * r
+
+@_var
+def polar(tx, ty, w, pv, px, rand):
+    r, a = _ra(tx, ty)
+    return w * a / np.pi, w * (r - 1)
+
+@_var
+def handkerchief(tx, ty, w, pv, px, rand):
+    r, a = _ra(tx, ty)
+    return w * r * np.sin(a+r), w * r * np.cos(a-r)
+
+@_var
+def heart(tx, ty, w, pv, px, rand):
+    sq, a = _ra(tx, ty)
+    a *= sq
+    return w * sq * np.sin(a), -w * sq * np.cos(a)
+
+@_var
+def disc(tx, ty, w, pv, px, rand):
+    r, a = _ra(tx, ty)
+    a *= w / np.pi
+    r *= np.pi
+    return np.sin(r) * a, np.cos(r) * a
+
+@_var
+def spiral(tx, ty, w, pv, px, rand):
+    r, a = _ra(tx, ty)
+    r1 = w / r
+    return r1 * (np.cos(a) + np.sin(r)), r1 * (np.sin(a) - np.cos(r))
+
+@_var
+def hyperbolic(tx, ty, w, pv, px, rand):
+    r, a = _ra(tx, ty)
+    return w * np.sin(a) / r, w * np.cos(a) * r
+
+@_var
+def diamond(tx, ty, w, pv, px, rand):
+    r, a = _ra(tx, ty)
+    return w * np.sin(a) * np.cos(r), w * np.cos(a) * np.sin(r)
+
+@_var
+def ex(tx, ty, w, pv, px, rand):
+    r, a = _ra(tx, ty)
+    m0, m1 = np.sin(a+r) ** 3 * r, np.cos(a-r) ** 3 * r
+    return w * (m0 + m1), w * (m0 - m1)
+
+@_var
+def julia(tx, ty, w, pv, px, rand):
+    r, a = _ra(tx, ty)
+    a = 0.5 * a + np.pi * rand.randint(2, size=tx.shape)
+    r = w * np.sqrt(r)
+    return r * np.cos(a), r * np.sin(a)
+
+@_var
+def bent(tx, ty, w, pv, px, rand):
+    return (w * np.where(tx < 0, 2.0, 1.0) * tx,
+            w * np.where(ty < 0, 0.5, 1.0) * ty)
+
+@_var
+def fisheye(tx, ty, w, pv, px, rand):
+    r = 2 * w / (np.sqrt(tx*tx + ty*ty) + 1)
+    return r * ty, r * tx
+
+@_var
+def popcorn(tx, ty, w, pv, px, rand):
+    return (w * (tx + px['xo'] * np.sin(np.tan(3 * ty))),
+            w * (ty + px['yo'] * np.sin(np.tan(3 * tx))))
+
+@_var
+def exponential(tx, ty, w, pv, px, rand):
+    dx = w * np.exp(tx - 1)
+    dx = np.where(np.isfinite(dx), dx, 0)
+    return dx * np.cos(np.pi * ty), dx * np.sin(np.pi * ty)
+
+@_var
+def power(tx, ty, w, pv, px, rand):
+    r, a = _ra(tx, ty)
+    sa = np.sin(a)
+    r = w * r ** sa
+    return r * np.cos(a), r * sa
+
+@_var
+def cosine(tx, ty, w, pv, px, rand):
+    a = np.pi * tx
+    return w * np.cos(a) * np.cosh(ty), -w * np.sin(a) * np.sinh(ty)
+
+@_var
+def blob(tx, ty, w, pv, px, rand):
+    r, a = _ra(tx, ty)
+    low, high = pv('low'), pv('high')
+    r *= w * (low + 0.5 * (high - low) * (1 + np.sin(pv('waves') * a)))
+    return np.sin(a) * r, np.cos(a) * r
+
+@_var
+def pdj(tx, ty, w, pv, px, rand):
+    return (w * (np.sin(pv('a') * ty) - np.cos(pv('b') * tx)),
+            w * (np.sin(pv('c') * tx) - np.cos(pv('d') * ty)))
+
+@_var
+def eyefish(tx, ty, w, pv, px, rand):
+    r = 2 * w / (np.sqrt(tx*tx + ty*ty) + 1)
+    return r * tx, r * ty
+
+@_var
+def bubble(tx, ty, w, pv, px, rand):
+    r = w / (0.25 * (tx*tx + ty*ty) + 1)
+    return r * tx, r * ty
+
+@_var
+def cylinder(tx, ty, w, pv, px, rand):
+    return w * np.sin(tx), w * ty
+
+@_var
+def julian(tx, ty, w, pv, px, rand):
+    power, dist = pv('power'), pv('dist')
+    t_rnd = np.trunc(rand.random_sample(tx.shape) * abs(power))
+    a = (np.arctan2(ty, tx) + 2 * np.pi * t_rnd) / power
+    r = w * (tx*tx + ty*ty) ** (dist / (2 * power))
+    return r * np.cos(a), r * np.sin(a)
+
+@_var
+def blur(tx, ty, w, pv, px, rand):
+    a = rand.random_sample(tx.shape) * 2 * np.pi
+    r = w * rand.random_sample(tx.shape)
+    return r * np.cos(a), r * np.sin(a)
+
+@_var
+def gaussian_blur(tx, ty, w, pv, px, rand):
+    a = rand.random_sample(tx.shape) * 2 * np.pi
+    r = w * 0.57736 * np.sqrt(-2 * np.log(rand.random_sample(tx.shape)))
+    return r * np.cos(a), r * np.sin(a)
+
+@_var
+def curl(tx, ty, w, pv, px, rand):
+    c1, c2 = pv('c1'), pv('c2')
+    re = 1 + c1*tx + c2*(tx*tx - ty*ty)
+    im = c1*ty + 2*c2*tx*ty
+    r = w / (re*re + im*im)
+    return r * (tx*re + ty*im), r * (ty*re - tx*im)
+
+@_var
+def tangent(tx, ty, w, pv, px, rand):
+    return w * np.sin(tx) / np.cos(ty), w * np.tan(ty)
+
+@_var
+def square(tx, ty, w, pv, px, rand):
+    return (w * (rand.random_sample(tx.shape) - 0.5),
+            w * (rand.random_sample(tx.shape) - 0.5))
+
+def affine_coefs(get, path):
+    """
+    Return the coefficients of the affine transform at ``path`` as a dict,
+    following `precalc_xf_affine`. ``get`` looks up a value by path tuple.
+    """
+    pri = np.radians(get(path + ('angle',)))
+    spr = np.radians(get(path + ('spread',)))
+    magx = get(path + ('magnitude', 'x'))
+    magy = get(path + ('magnitude', 'y'))
+    return dict(xx=magx * np.cos(pri-spr), yx=-magx * np.sin(pri-spr),
+                xy=-magy * np.cos(pri+spr), yy=magy * np.sin(pri+spr),
+                xo=get(path + ('offset', 'x')), yo=-get(path + ('offset', 'y')))
+
+def apply_affine(c, x, y):
+    return (c['xx'] * x + c['xy'] * y + c['xo'],
+            c['yx'] * x + c['yy'] * y + c['yo'])
+
+class ChaosGame(object):
+    """
+    Runs the chaos game for an animation genome (a plain dict) at arbitrary
+    times.
+    """
+    def __init__(self, gnm, seed=0):
+        self.gnm = gnm
+        self.arrs = GenomeArrays.from_dict(gnm)
+        self.spec = toplevels['animation']
+        self.rand = np.random.RandomState(seed)
+        self.xforms = sorted(gnm.get('xforms', {}))
+        self.has_final = 'final_xform' in gnm
+        names = set()
+        for xf in gnm.get('xforms', {}).values() + [gnm.get('final_xform', {})]:
+            names.update(xf.get('variations', {}))
+        self.unsupported = sorted(names.difference(_vars))
+
+    def getter(self, t):
+        """
+        Return a function that looks up the value of any spline at time
+        ``t`` by its path tuple, falling back to the spec default.
+        """
+        vals = dict(zip(self.arrs.paths, self.arrs.evaluate(t)))
+        def get(path):
+            if path in vals:
+                return vals[path]
+            return resolve_spec(self.spec, path).default
+        return get
+
+    def xform_fn(self, get, path):
+        """
+        Return a function `f(x, y)` applying the xform at ``path`` (as found
+        in the genome, e.g. `('xforms', '0')`) with the values from ``get``.
+        """
+        xf = self.gnm
+        for k in path:
+            xf = xf[k]
+        pre = affine_coefs(get, path + ('pre_affine',))
+        post = None
+        if 'post_affine' in xf:
+            post = affine_coefs(get, path + ('post_affine',))
+        vs = []
+        for name in sorted(xf.get('variations', {})):
+            vpath = path + ('variations', name)
+            pv = lambda k, vpath=vpath: get(vpath + (k,))
+            vs.append((_vars.get(name, linear), get(vpath + ('weight',)), pv))
+        rand = self.rand
+
+        def apply(x, y):
+            tx, ty = apply_affine(pre, x, y)
+            ox, oy = np.zeros_like(tx), np.zeros_like(ty)
+            for fn, w, pv in vs:
+                dx, dy = fn(tx, ty, w, pv, pre, rand)
+                ox += dx
+                oy += dy
+            if post is not None:
+                ox, oy = apply_affine(post, ox, oy)
+            return ox, oy
+        return apply
+
+    def camera_fn(self, get):
+        """Return a function mapping world coordinates to frame units."""
+        rot = np.radians(get(('camera', 'rotation')))
+        cx, cy = get(('camera', 'center', 'x')), get(('camera', 'center', 'y'))
+        scale = get(('camera', 'scale'))
+        s, c = np.sin(rot), np.cos(rot)
+        def apply(x, y):
+            x, y = x - cx, y - cy
+            return scale * (c * x - s * y), scale * (s * x + c * y)
+        return apply
+
+    def run(self, t, npoints=4096, rounds=64, fuse=16, project=True):
+        """
+        Run ``npoints`` independent trajectories for ``fuse`` unrecorded
+        iterations followed by ``rounds`` recorded ones, at time ``t``.
+        Returns a `Samples` tuple; recorded points have been through the
+        final xform and camera, and include those that left the frame. If
+        ``project`` is False, the recorded points are instead left in world
+        coordinates, as they were before the final xform.
+        """
+        get = self.getter(t)
+        fns = [self.xform_fn(get, ('xforms', k)) for k in self.xforms]
+        weights = np.array([get(('xforms', k, 'weight')) for k in self.xforms])
+        cdf = np.cumsum(np.maximum(weights, 0))
+        if not len(cdf) or cdf[-1] <= 0:
+            empty = np.zeros(0)
+            return Samples(empty, empty, 0, 0)
+        cdf /= cdf[-1]
+        final = self.has_final and self.xform_fn(get, ('final_xform',))
+        camera = self.camera_fn(get)
+
+        rand = self.rand
+        x = rand.uniform(-1, 1, npoints)
+        y = rand.uniform(-1, 1, npoints)
+        outx, outy, resets = [], [], 0
+        for i in range(fuse + rounds):
+            bad = ~np.isfinite(np.abs(x) + np.abs(y))
+            nbad = np.count_nonzero(bad)
+            if nbad:
+                resets += nbad
+                x[bad] = rand.uniform(-1, 1, nbad)
+                y[bad] = rand.uniform(-1, 1, nbad)
+            sel = np.searchsorted(cdf, rand.random_sample(npoints))
+            sel = np.minimum(sel, len(fns) - 1)
+            with np.errstate(all='ignore'):
+                for j, fn in enumerate(fns):
+                    m = sel == j
+                    if m.any():
+                        x[m], y[m] = fn(x[m], y[m])
+                if i < fuse:
+                    continue
+                if project:
+                    fx, fy = final(x, y) if final else (x, y)
+                    fx, fy = camera(fx, fy)
+                else:
+                    fx, fy = x.copy(), y.copy()
+            outx.append(fx)
+            outy.append(fy)
+        return Samples(np.concatenate(outx), np.concatenate(outy), resets,
+                       npoints * (fuse + rounds))
@@ -18,6 +18,9 @@ class GenomeDB(object):
         return self._get(id)
     def stash(self, id, gnm):
         self.stashed[id] = gnm
+    def ids(self):
+        """Return the IDs of every genome in the database."""
+        raise NotImplementedError()
 
     def get_anim(self, name, half=False):
         """
@@ -66,6 +69,9 @@ class OneFileDB(GenomeDB):
     def get(self, id):
         return self.dct[id]
 
+    def ids(self):
+        return [k for k in self.dct if k != 'type']
+
 class FilesystemDB(GenomeDB):
     def __init__(self, path):
         self.path = path
@@ -76,6 +82,15 @@ class FilesystemDB(GenomeDB):
         with open(os.path.join(self.path, id)) as fp:
             return json.load(fp)
 
+    def ids(self):
+        out = []
+        for dirpath, dirnames, filenames in os.walk(self.path):
+            rel = os.path.relpath(dirpath, self.path)
+            for fn in filenames:
+                if fn.endswith('.json'):
+                    out.append(os.path.normpath(os.path.join(rel, fn[:-5])))
+        return sorted(out)
+
 def connect(path):
     if os.path.isfile(path):
         return OneFileDB.read(path)
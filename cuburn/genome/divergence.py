@@ -0,0 +1,138 @@
+"""
+Estimate whether an animation's iterated function system converges.
+
+When a flame diverges, points repeatedly go non-finite and are reseeded by
+the iteration kernel, and the resulting render is mostly noise no matter how
+long it runs. This module estimates, across an animation's time range:
+
+- the largest singular value of each xform's affine transforms, a cheap
+  upper bound on how much the linear part of each xform can expand space;
+- a Lyapunov-style exponent, the probability-weighted mean log expansion of
+  each xform (variations included) measured by finite differences at points
+  on the sampled attractor, where negative values indicate contraction;
+- the fraction of iterations in a sampled chaos game run that had to reset a
+  non-finite point, which directly measures wasted device work.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+from chaos import ChaosGame, affine_coefs
+
+# Per-xform statistics, as the maximum over all sampled times. ``sigma`` is
+# the largest singular value of the pre-affine transform (multiplied by that
+# of the post-affine, if present); ``expansion`` is the mean log expansion.
+XformStats = namedtuple('XformStats', 'name sigma expansion')
+
+# ``reset_rates`` holds the fraction of iterations that reset a point at each
+# of ``times``; ``reset_rate`` and ``lyapunov`` are the maximum over times.
+Divergence = namedtuple('Divergence',
+        'times reset_rates reset_rate lyapunov xforms unsupported')
+
+def _sigma(c):
+    return np.linalg.svd([[c['xx'], c['xy']], [c['yx'], c['yy']]],
+                         compute_uv=False)[0]
+
+def _expansion(game, fn, x, y, eps=1e-5):
+    """
+    Mean log expansion of the xform ``fn`` at the points (``x``, ``y``), in
+    random directions. Stochastic variations see the same random draws for
+    both evaluations of each point.
+    """
+    a = game.rand.uniform(0, 2 * np.pi, len(x))
+    dx, dy = eps * np.cos(a), eps * np.sin(a)
+    state = game.rand.get_state()
+    with np.errstate(all='ignore'):
+        x0, y0 = fn(x, y)
+        game.rand.set_state(state)
+        x1, y1 = fn(x + dx, y + dy)
+        ratio = np.log(np.hypot(x1 - x0, y1 - y0) / eps)
+    ratio = ratio[np.isfinite(ratio)]
+    return float(np.mean(ratio)) if len(ratio) else np.inf
+
+def analyze(gnm, ntimes=5, npoints=2048, rounds=16, seed=0):
+    """
+    Analyze the animation ``gnm`` at ``ntimes`` evenly spaced times. Returns
+    a `Divergence` tuple.
+    """
+    game = ChaosGame(gnm, seed)
+    times = np.linspace(0, 1, ntimes)
+    sigmas = dict((k, 0.0) for k in game.xforms)
+    expansions = dict((k, -np.inf) for k in game.xforms)
+    reset_rates, lyapunovs = [], []
+
+    for t in times:
+        samples = game.run(t, npoints, rounds, project=False)
+        reset_rates.append(samples.resets / float(max(1, samples.iters)))
+
+        get = game.getter(t)
+        ok = np.isfinite(samples.x) & np.isfinite(samples.y)
+        x, y = samples.x[ok][:npoints], samples.y[ok][:npoints]
+        weights = np.array([max(0, get(('xforms', k, 'weight')))
+                            for k in game.xforms])
+        if not len(x) or weights.sum() <= 0:
+            lyapunovs.append(np.inf)
+            continue
+        weights /= weights.sum()
+
+        lyap = 0.0
+        for k, w in zip(game.xforms, weights):
+            path = ('xforms', k)
+            sigma = _sigma(affine_coefs(get, path + ('pre_affine',)))
+            if 'post_affine' in gnm['xforms'][k]:
+                sigma *= _sigma(affine_coefs(get, path + ('post_affine',)))
+            sigmas[k] = max(sigmas[k], sigma)
+            exp = _expansion(game, game.xform_fn(get, path), x, y)
+            expansions[k] = max(expansions[k], exp)
+            if w > 0:
+                lyap += w * exp
+        lyapunovs.append(lyap)
+
+    xforms = [XformStats(k, sigmas[k], expansions[k]) for k in game.xforms]
+    reset_rates = np.array(reset_rates)
+    return Divergence(times, reset_rates, float(reset_rates.max()),
+                      float(max(lyapunovs)), xforms, game.unsupported)
+
+def format_report(name, div):
+    lines = ['%s: reset rate %.3g%% (max), lyapunov %.3g%s' % (
+                name, 100 * div.reset_rate, div.lyapunov,
+                ' DIVERGENT' if div.lyapunov > 0 else '')]
+    for xf in div.xforms:
+        lines.append('  xform %-8s sigma %7.3f  expansion %7.3f%s' % (
+            xf.name, xf.sigma, xf.expansion,
+            ' (expanding)' if xf.expansion > 0 else ''))
+    if div.unsupported:
+        lines.append('  approximated variations: %s' %
+                     ', '.join(div.unsupported))
+    return '\n'.join(lines)
+
+if __name__ == "__main__":
+    import sys, argparse
+    import db
+    parser = argparse.ArgumentParser(
+        description='Estimate the convergence of flames.')
+    parser.add_argument('flames', metavar='ID', type=str, nargs='+',
+        help="Filenames or flame IDs of genomes to check. If prefixed with "
+             "'@', a file containing one ID per line.")
+    parser.add_argument('-d', '--genomedb', metavar='PATH', type=str,
+        help="Path to genome database (file or directory, default '.')",
+        default='.')
+    parser.add_argument('--max-reset-rate', metavar='FRAC', type=float,
+        default=0.01, help="Flag genomes resetting more than this fraction "
+        "of iterations (default 0.01)")
+    args = parser.parse_args()
+
+    gdb = db.connect(args.genomedb)
+    nflagged = 0
+    for oid in args.flames:
+        ids = [oid]
+        if oid[0] == '@':
+            with open(oid[1:]) as fp:
+                ids = filter(None, fp.read().split('\n'))
+        for id in ids:
+            gnm, basename = gdb.get_anim(id)
+            div = analyze(gnm)
+            print format_report(basename, div)
+            nflagged += div.reset_rate > args.max_reset_rate
+    sys.exit(1 if nflagged else 0)
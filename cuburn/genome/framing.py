@@ -0,0 +1,133 @@
+"""
+Estimate how much of an animation's attractor actually lands in frame.
+
+The iteration kernel silently drops every sample whose camera-space position
+falls outside the accumulation buffer, so a loosely framed genome can waste
+most of its render time without any visible symptom other than noise. This
+module runs the host-side chaos game from `chaos` at a handful of times
+across the animation, reports the fraction of samples that were in frame,
+and proposes camera center and scale splines that frame the bulk of the
+attractor tightly.
+"""
+
+from collections import namedtuple
+
+import numpy as np
+
+from chaos import ChaosGame
+
+# ``times`` and ``fractions`` are arrays of the sampled times and the
+# in-frame fraction at each; ``fraction`` is their mean. ``camera`` is a
+# camera dict holding the proposed center and scale splines, and
+# ``unsupported`` lists variations approximated by the estimate.
+Framing = namedtuple('Framing', 'times fractions fraction camera unsupported')
+
+def _spline(times, vals):
+    """Encode values at ``times`` (which start at 0 and end at 1) as a
+    spline, with zero velocity at each end."""
+    vals = [float(v) for v in vals]
+    if np.allclose(vals, vals[0]):
+        return vals[0]
+    return [vals[0], 0, vals[-1], 0] + [
+            float(v) for tv in zip(times[1:-1], vals[1:-1]) for v in tv]
+
+def estimate(gnm, width=1920, height=1080, ntimes=5, npoints=4096,
+             rounds=64, coverage=0.99, margin=0.05, seed=0):
+    """
+    Estimate the framing of the animation ``gnm`` at ``ntimes`` evenly
+    spaced times, for output frames of the given size. Returns a `Framing`.
+
+    The proposed camera keeps the genome's rotation, and centers and scales
+    each sampled frame so that the central ``coverage`` fraction of samples
+    along each axis fits within the frame, with ``margin`` (as a fraction of
+    the frame size) left on each side.
+    """
+    game = ChaosGame(gnm, seed)
+    aspect = float(height) / width
+    times = np.linspace(0, 1, ntimes)
+    fractions, centers, scales = [], [], []
+    q = 100 * (1 - coverage) / 2
+
+    for t in times:
+        samples = game.run(t, npoints, rounds)
+        x, y = samples.x, samples.y
+        ok = np.isfinite(x) & np.isfinite(y)
+        inside = ok & (np.abs(x) < 0.5) & (np.abs(y) < 0.5 * aspect)
+        fractions.append(np.count_nonzero(inside) / float(max(1, len(x))))
+
+        get = game.getter(t)
+        scale = get(('camera', 'scale'))
+        rot = np.radians(get(('camera', 'rotation')))
+        cx, cy = get(('camera', 'center', 'x')), get(('camera', 'center', 'y'))
+        x, y = x[ok], y[ok]
+        if not len(x):
+            centers.append((cx, cy))
+            scales.append(scale)
+            continue
+
+        # Find the extents in the (rotated) frame, then shift and scale
+        x0, x1 = np.percentile(x, [q, 100 - q])
+        y0, y1 = np.percentile(y, [q, 100 - q])
+        mx, my = 0.5 * (x0 + x1) / scale, 0.5 * (y0 + y1) / scale
+        s, c = np.sin(rot), np.cos(rot)
+        centers.append((cx + c * mx + s * my, cy - s * mx + c * my))
+        extent = max((x1 - x0) / scale, (y1 - y0) / scale / aspect, 1e-9)
+        scales.append((1 - 2 * margin) / extent)
+
+    centers = np.array(centers)
+    camera = dict(center=dict(x=_spline(times, centers[:,0]),
+                              y=_spline(times, centers[:,1])),
+                  scale=_spline(times, scales))
+    fractions = np.array(fractions)
+    return Framing(times, fractions, float(np.mean(fractions)), camera,
+                   game.unsupported)
+
+def apply_camera(gnm, framing):
+    """Return a copy of ``gnm`` with the camera proposed by ``framing``."""
+    gnm = dict(gnm)
+    gnm['camera'] = dict(gnm.get('camera', {}), **framing.camera)
+    return gnm
+
+if __name__ == "__main__":
+    import sys, argparse
+    import db, convert
+    parser = argparse.ArgumentParser(
+        description='Estimate the fraction of samples that land in frame.')
+    parser.add_argument('flames', metavar='ID', type=str, nargs='+',
+        help="Filenames or flame IDs of genomes to check. If prefixed with "
+             "'@', a file containing one ID per line.")
+    parser.add_argument('-d', '--genomedb', metavar='PATH', type=str,
+        help="Path to genome database (file or directory, default '.')",
+        default='.')
+    parser.add_argument('--width', type=int, default=1920)
+    parser.add_argument('--height', type=int, default=1080)
+    parser.add_argument('--threshold', metavar='FRAC', type=float,
+        default=0.5, help="Flag genomes wasting more than this fraction "
+        "of samples (default 0.5)")
+    parser.add_argument('--fix', action='store_true',
+        help="Print each flagged genome with the proposed camera applied")
+    args = parser.parse_args()
+
+    gdb = db.connect(args.genomedb)
+    nflagged = 0
+    for oid in args.flames:
+        ids = [oid]
+        if oid[0] == '@':
+            with open(oid[1:]) as fp:
+                ids = filter(None, fp.read().split('\n'))
+        for id in ids:
+            gnm, basename = gdb.get_anim(id)
+            framing = estimate(gnm, args.width, args.height)
+            waste = 1 - framing.fraction
+            flag = waste > args.threshold
+            nflagged += flag
+            print '%-40s %5.1f%% in frame (%s)%s' % (
+                    basename, 100 * framing.fraction,
+                    ' '.join('%.0f' % (100 * f) for f in framing.fractions),
+                    '  WASTEFUL' if flag else '')
+            if framing.unsupported:
+                print >> sys.stderr, '  approximated variations: %s' % (
+                        ', '.join(framing.unsupported))
+            if flag and args.fix:
+                print convert.to_json(apply_camera(gnm, framing))
+    sys.exit(1 if nflagged else 0)
@@ -0,0 +1,169 @@
+"""
+Knot decimation for animation splines.
+
+Splines are limited to `validate.MAX_KNOTS` knots on the device, including
+the stabilizing knots added during normalization. Long keyframed edits, or
+animations converted from frame-based sources, can easily exceed that, and
+even when they don't, every extra knot costs packing and search time.
+
+`simplify_spline` greedily removes the interior knot whose removal changes
+the curve the least, until no knot can be removed without deviating from the
+original by more than a given tolerance (and, regardless of the tolerance,
+until the spline fits within the knot limit). Deviation is measured over a
+dense set of sample times in [0, 1], using the vectorized evaluator from
+`soa`, so that the result matches what the device will actually render.
+
+Magnitude splines are interpolated in a linear-log domain, and deviation is
+measured there too: above `soa.ELBOW`, a deviation of ``e`` is a ratio of
+``2**e`` between the values, so a tolerance of 0.01 allows a 0.7% change.
+Periodic splines are compared modulo their period.
+"""
+
+import numpy as np
+
+from soa import GenomeArrays, catmull_rom, _linlog
+from use import SplineEval
+from validate import MAX_KNOTS
+
+def _deviation(a, b, mag=False, period=None):
+    """
+    Absolute difference between two arrays of spline values. Magnitude
+    splines are compared in the linear-log domain they are interpolated in,
+    and periodic ones are compared modulo their period.
+    """
+    if mag:
+        a, b = _linlog(a), _linlog(b)
+    d = np.abs(a - b)
+    if period:
+        d = np.mod(d, period)
+        d = np.minimum(d, period - d)
+    return d
+
+def _join(head, extra):
+    return head + [v for knot in extra for v in knot]
+
+def _pack(rows):
+    """Pad a list of normalized knot arrays into `(times, knots)` arrays."""
+    width = max(4, max(r.shape[1] for r in rows))
+    times = np.empty((len(rows), width))
+    knots = np.zeros((len(rows), width))
+    times.fill(1e9)
+    for i, r in enumerate(rows):
+        times[i,:r.shape[1]], knots[i,:r.shape[1]] = r
+    return times, knots
+
+def simplify_spline(knots, scale=1, tol=0, max_knots=MAX_KNOTS, mag=False,
+                    period=None, density=8):
+    """
+    Remove interior knots from the animation spline ``knots`` (in its JSON
+    encoding), keeping the curve within ``tol`` of the original at every
+    sample time, and reducing its normalized knot count to no more than
+    ``max_knots``. ``scale`` is the animation duration, as passed to
+    `SplineEval.normalize`.
+
+    The curve is sampled ``density`` times between each pair of adjacent
+    knots in the original, as well as at each knot.
+
+    Returns `(knots, error)`, where ``error`` is the maximum deviation of the
+    simplified spline from the original over the sample times. If knots had
+    to be removed to fit within ``max_knots``, ``error`` may exceed ``tol``.
+    """
+    if not isinstance(knots, list) or len(knots) <= 4:
+        return knots, 0.0
+    head = list(knots[:4])
+    extra = sorted(zip(knots[4::2], knots[5::2]))
+
+    ts = sorted(set([0.0, 1.0] + [t for t, p in extra if 0 <= t <= 1]))
+    samples = np.concatenate(
+            [np.linspace(a, b, density, endpoint=False)
+             for a, b in zip(ts[:-1], ts[1:])] + [[1.0]])
+    times, vals = _pack([SplineEval.normalize(knots, scale)])
+    ref = catmull_rom(np.repeat(times, len(samples), axis=0),
+                      np.repeat(vals, len(samples), axis=0), samples, mag)
+    err = np.zeros_like(samples)
+
+    while extra:
+        over = SplineEval.normalize(_join(head, extra), scale).shape[1]
+        over = over > max_knots
+
+        # Removing a knot changes the curve up to two knots away on either
+        # side, or all the way to the end if that reaches a stabilizing knot
+        alltimes = sorted([0.0, 1.0] + [t for t, p in extra])
+        rows, sels = [], []
+        for i, (t, p) in enumerate(extra):
+            j = alltimes.index(t)
+            lo = alltimes[j-2] if j >= 2 else -np.inf
+            hi = alltimes[j+2] if j + 2 < len(alltimes) else np.inf
+            rows.append(SplineEval.normalize(
+                    _join(head, extra[:i] + extra[i+1:]), scale))
+            sels.append(np.nonzero((samples >= lo) & (samples <= hi))[0])
+
+        times, vals = _pack(rows)
+        idx = np.repeat(np.arange(len(rows)), map(len, sels))
+        sidx = np.concatenate(sels)
+        dev = _deviation(catmull_rom(times[idx], vals[idx], samples[sidx], mag),
+                         ref[sidx], mag, period)
+        bounds = np.cumsum([0] + map(len, sels))
+        scores = [dev[a:b].max() if b > a else 0.0
+                  for a, b in zip(bounds[:-1], bounds[1:])]
+
+        best = int(np.argmin(scores))
+        if scores[best] > tol and not over:
+            break
+        err[sels[best]] = dev[bounds[best]:bounds[best+1]]
+        del extra[best]
+
+    return _join(head, extra), float(err.max())
+
+def simplify(gnm, tol=0, max_knots=MAX_KNOTS, density=8):
+    """
+    Simplify every spline in the animation genome ``gnm``. Returns
+    `(gnm, report)`, where ``gnm`` is a new genome and ``report`` is a list of
+    `(path, knots_removed, error)` for each spline that was changed.
+    """
+    arrs = GenomeArrays.from_dict(gnm)
+    scale = arrs.other.get('time.duration', 1)
+    report = []
+    for i, path in enumerate(arrs.paths):
+        knots = arrs.knotlist(i)
+        if arrs.scalar[i] or len(knots) <= 4:
+            continue
+        period = None if np.isnan(arrs.period[i]) else arrs.period[i]
+        new, error = simplify_spline(knots, scale, tol, max_knots,
+                                     arrs.mag[i], period, density)
+        if len(new) < len(knots):
+            arrs[path] = new
+            report.append(('.'.join(path), (len(knots) - len(new)) / 2, error))
+    return arrs.to_dict(), report
+
+def print_report(report, fp):
+    for path, removed, error in report:
+        print >> fp, '%-48s %4d knots removed, max error %g' % (
+                path, removed, error)
+    if report:
+        print >> fp, '%d knots removed from %d splines, max error %g' % (
+                sum(r[1] for r in report), len(report),
+                max(r[2] for r in report))
+
+if __name__ == "__main__":
+    import sys, argparse
+    import db, convert
+    parser = argparse.ArgumentParser(
+        description='Remove knots from the splines of an animation.')
+    parser.add_argument('flame', metavar='ID', type=str,
+        help="Filename or flame ID of genome to simplify")
+    parser.add_argument('-d', '--genomedb', metavar='PATH', type=str,
+        help="Path to genome database (file or directory, default '.')",
+        default='.')
+    parser.add_argument('-e', '--max-error', metavar='TOL', type=float,
+        default=0.001, help="Maximum deviation from the original splines "
+        "(for magnitudes, in log2 units)")
+    parser.add_argument('--max-knots', metavar='N', type=int,
+        default=MAX_KNOTS, help="Maximum knots per spline, including "
+        "stabilizing knots")
+    args = parser.parse_args()
+
+    gnm, basename = db.connect(args.genomedb).get_anim(args.flame)
+    gnm, report = simplify(gnm, args.max_error, args.max_knots)
+    print_report(report, sys.stderr)
+    print convert.to_json(gnm)
@@ -0,0 +1,299 @@
+"""
+Struct-of-arrays representation of genomes.
+
+Most genome operations walk the nested dicts described in `specs`, which is
+convenient but slow when the same operation must be applied to every spline
+in a big genome. A `GenomeArrays` object flattens every Spline leaf of a
+genome into one row of a set of contiguous arrays, so that bulk operations
+(packing, evaluation, simplification, analysis) can be done with array
+indexing and vectorized math instead of dict traversal.
+
+The conversion is lossless: `GenomeArrays.to_dict()` returns a genome that
+encodes identically to the one it was built from.
+"""
+
+import numpy as np
+
+import spectypes
+from specs import toplevels
+from use import SplineEval
+from util import unflatten, resolve_spec
+
+# Magnitude-domain constants, which must match those in `catmullromlib`.
+ELBOW = 0.0625
+ELOG1 = 5.0
+
+# Time of the stabilizing knots added by `SplineEval.normalize`.
+_TD = 2
+
+def _linlog(x):
+    ax = np.abs(x)
+    return np.where(ax > ELBOW,
+                    np.sign(x) * (np.log2(np.maximum(ax, ELBOW)) + ELOG1),
+                    x / ELBOW)
+
+def _linexp(v):
+    av = np.abs(v)
+    return np.where(av >= 1, np.sign(v) * np.exp2(av - ELOG1), v * ELBOW)
+
+def _linslope(x, m):
+    return m / np.maximum(np.abs(x), ELBOW)
+
+def catmull_rom(times, knots, t, mag=False):
+    """
+    Evaluate many normalized splines at once, using the same arithmetic as
+    the device-side `catmull_rom` and `catmull_rom_mag` functions.
+
+    ``times`` and ``knots`` are `(n, width)` arrays in the format produced by
+    `GenomeArrays.normalized` (rows padded at the end with very large times).
+    ``t`` is a scalar or an array broadcastable to `(n,)`. ``mag`` is a
+    boolean or a boolean array of shape `(n,)` selecting magnitude-domain
+    interpolation for each row. Returns an array of shape `(n,)`.
+    """
+    times, knots = np.atleast_2d(times), np.atleast_2d(knots)
+    n, width = times.shape
+    t = np.broadcast_to(np.asarray(t, dtype=np.float64), (n,))
+    rows = np.arange(n)
+
+    idx = np.sum(times < t[:,None], axis=1) - 1
+    idx = np.clip(idx, 1, width - 3)
+
+    t1 = times[rows, idx]
+    rt2 = 1.0 / (times[rows, idx+1] - t1)
+    t0 = (times[rows, idx-1] - t1) * rt2
+    t3 = (times[rows, idx+2] - t1) * rt2
+    t = (t - t1) * rt2
+
+    k0, k1 = knots[rows, idx-1], knots[rows, idx]
+    k2, k3 = knots[rows, idx+1], knots[rows, idx+2]
+    m1 = (k2 - k0) / (1.0 - t0)
+    m2 = (k3 - k1) / t3
+
+    mag = np.broadcast_to(np.asarray(mag, dtype=bool), (n,))
+    if mag.any():
+        m1 = np.where(mag, _linslope(k1, m1), m1)
+        m2 = np.where(mag, _linslope(k2, m2), m2)
+        k1 = np.where(mag, _linlog(k1), k1)
+        k2 = np.where(mag, _linlog(k2), k2)
+
+    tt = t * t
+    ttt = tt * t
+    r = ( m1 * (      ttt - 2.0*tt + t)
+        + k1 * ( 2.0*ttt - 3.0*tt + 1)
+        + m2 * (      ttt -     tt)
+        + k2 * (-2.0*ttt + 3.0*tt))
+    if mag.any():
+        r = np.where(mag, _linexp(r), r)
+    return r
+
+class GenomeArrays(object):
+    """
+    A genome with every Spline leaf stored as one row of a flat array.
+
+    ``paths`` is the sorted list of path tuples of every spline leaf, and
+    ``index`` maps each path to its row. The raw (JSON-encoded) values of row
+    ``i`` are ``values[offsets[i]:offsets[i+1]]``; ``scalar[i]`` is True if
+    the leaf was encoded as a plain number rather than a list. Missing knot
+    positions in edge edits (JSON ``null``) are stored as NaN.
+
+    ``mag`` and ``period`` hold the interpolation type and period (NaN if
+    aperiodic) of each row, as taken from the spec.
+
+    Every leaf that isn't a spline (strings, palettes, scalars, enums, and
+    anything not covered by the spec) is kept in ``other``, a flattened dict
+    as produced by `util.flatten`.
+    """
+    def __init__(self, type, paths, values, offsets, scalar, mag, period,
+                 other):
+        self.type, self.paths, self.other = type, paths, other
+        self.values, self.offsets, self.scalar = values, offsets, scalar
+        self.mag, self.period = mag, period
+        self.index = dict((p, i) for i, p in enumerate(paths))
+
+    @classmethod
+    def from_dict(cls, gnm, spec=None):
+        """
+        Build from a plain genome dict. If ``spec`` is None, it is looked up
+        from the genome's 'type' key.
+        """
+        if spec is None:
+            spec = toplevels[gnm['type']]
+        leaves, other = [], {}
+
+        def go(val, sp, path):
+            if (isinstance(sp, spectypes.Spline) and
+                    isinstance(val, (int, long, float, list))):
+                leaves.append((path, sp, val))
+            elif isinstance(val, dict) and not val:
+                other['.'.join(path)] = val
+            elif isinstance(sp, (dict, spectypes.Map)) and isinstance(val, dict):
+                for k, v in val.items():
+                    if isinstance(sp, spectypes.Map):
+                        go(v, sp.type, path + (str(k),))
+                    elif k in sp:
+                        go(v, sp[k], path + (str(k),))
+                    else:
+                        go(v, None, path + (str(k),))
+            elif sp is None and isinstance(val, dict):
+                for k, v in val.items():
+                    go(v, None, path + (str(k),))
+            else:
+                other['.'.join(path)] = val
+        go(gnm, spec, ())
+        leaves.sort(key=lambda l: l[0])
+
+        isnum = lambda v: not isinstance(v, list)
+        lens = [1 if isnum(v) else len(v) for p, s, v in leaves]
+        offsets = np.zeros(len(leaves) + 1, dtype=np.intp)
+        np.cumsum(lens, out=offsets[1:])
+        values = np.empty(offsets[-1], dtype=np.float64)
+        flat = []
+        for p, s, v in leaves:
+            if isnum(v):
+                flat.append(v)
+            else:
+                flat.extend(v)
+        values[:] = [np.nan if v is None else v for v in flat]
+
+        scalar = np.array([isnum(v) for p, s, v in leaves], dtype=bool)
+        mag = np.array([s.interp == 'mag' for p, s, v in leaves], dtype=bool)
+        period = np.array([np.nan if s.period is None else s.period
+                           for p, s, v in leaves], dtype=np.float64)
+        return cls(gnm.get('type'), [l[0] for l in leaves], values, offsets,
+                   scalar, mag, period, other)
+
+    def __len__(self):
+        return len(self.paths)
+
+    def _row(self, path):
+        if isinstance(path, basestring):
+            path = tuple(path.split('.'))
+        return self.index[path]
+
+    def __contains__(self, path):
+        try:
+            self._row(path)
+        except KeyError:
+            return False
+        return True
+
+    def __getitem__(self, path):
+        """
+        Return the raw values of the spline at ``path`` (a tuple, or a
+        dot-separated string) as a view into ``values``.
+        """
+        i = self._row(path)
+        return self.values[self.offsets[i]:self.offsets[i+1]]
+
+    def __setitem__(self, path, val):
+        """
+        Replace the raw values of the spline at ``path``. If the number of
+        values changes, the flat arrays are rebuilt.
+        """
+        i = self._row(path)
+        scalar = not isinstance(val, (list, tuple, np.ndarray))
+        val = np.atleast_1d(np.asarray(val, dtype=np.float64))
+        a, b = self.offsets[i], self.offsets[i+1]
+        if len(val) == b - a:
+            self.values[a:b] = val
+        else:
+            self.values = np.concatenate(
+                    [self.values[:a], val, self.values[b:]])
+            self.offsets[i+1:] += len(val) - (b - a)
+        self.scalar[i] = scalar
+
+    def knotlist(self, i):
+        """Return row ``i`` in its JSON encoding."""
+        vals = self.values[self.offsets[i]:self.offsets[i+1]]
+        if self.scalar[i]:
+            return float(vals[0])
+        return [None if np.isnan(v) else float(v) for v in vals]
+
+    def to_dict(self):
+        """Return the genome as a plain nested dict."""
+        out = dict(self.other)
+        for i, path in enumerate(self.paths):
+            out['.'.join(path)] = self.knotlist(i)
+        return unflatten(out)
+
+    def normalized(self, paths, scale, width, times=None, knots=None,
+                   spec=None):
+        """
+        Return `(times, knots)`, two `(len(paths), width)` float32 arrays
+        holding the normalized knots (see `SplineEval.normalize`) of each
+        animation spline in ``paths``, padded with very large times. Paths
+        that aren't present take the default value from ``spec`` (by default,
+        the spec of this genome's type). Pass ``times`` and ``knots`` to fill
+        existing arrays, such as page-locked host allocations.
+
+        Splines without interior knots, which make up almost all of any real
+        genome, are normalized without leaving NumPy.
+        """
+        if spec is None:
+            spec = toplevels[self.type]
+        n = len(paths)
+        if times is None:
+            times = np.empty((n, width), np.float32)
+        if knots is None:
+            knots = np.empty((n, width), np.float32)
+        times.fill(1e9)
+        knots.fill(0)
+
+        rows = np.array([self.index.get(tuple(p), -1) for p in paths],
+                        dtype=np.intp)
+        found = rows >= 0
+        lens = np.zeros(n, dtype=np.intp)
+        lens[found] = np.diff(self.offsets)[rows[found]]
+        starts = np.zeros(n, dtype=np.intp)
+        starts[found] = self.offsets[rows[found]]
+        scalar = np.zeros(n, dtype=bool)
+        scalar[found] = self.scalar[rows[found]]
+        if np.any(found & ~scalar & (lens % 2 == 1)):
+            raise ValueError("List with odd number of elements given")
+
+        # Plain numbers, two-element lists and [p0, v0, p1, v1] lists all
+        # normalize to the same four-knot shape.
+        p0 = np.empty(n)
+        p1 = np.empty(n)
+        v0 = np.zeros(n)
+        v1 = np.zeros(n)
+        for i in np.nonzero(~found)[0]:
+            p0[i] = p1[i] = resolve_spec(spec, paths[i]).default
+        one, two, four = (lens == 1), (lens == 2), (lens == 4)
+        p0[one] = p1[one] = self.values[starts[one]]
+        p0[two] = self.values[starts[two]]
+        p1[two] = self.values[starts[two] + 1]
+        p0[four] = self.values[starts[four]]
+        v0[four] = self.values[starts[four] + 1] * scale
+        p1[four] = self.values[starts[four] + 2]
+        v1[four] = self.values[starts[four] + 3] * scale
+
+        simple = ~found | one | two | four
+        times[simple,:4] = [-_TD, 0, 1, 1 + _TD]
+        knots[simple,0] = (p1 - (1 + _TD) * v0)[simple]
+        knots[simple,1] = p0[simple]
+        knots[simple,2] = p1[simple]
+        knots[simple,3] = (p0 + (1 + _TD) * v1)[simple]
+
+        for i in np.nonzero(~simple)[0]:
+            attr = SplineEval.normalize(self.knotlist(rows[i]), scale)
+            times[i,:attr.shape[1]] = attr[0]
+            knots[i,:attr.shape[1]] = attr[1]
+        return times, knots
+
+    def evaluate(self, t, scale=None, width=None):
+        """
+        Evaluate every spline at time ``t`` (a scalar, or an array of times
+        with one entry per row), returning an array with one value per row.
+        ``scale`` defaults to the genome's duration; ``width`` to the largest
+        normalized knot count.
+        """
+        if not self.paths:
+            return np.zeros(0)
+        if scale is None:
+            scale = self.other.get('time.duration', 1)
+        if width is None:
+            width = max(4, np.max(np.diff(self.offsets)) / 2 + 2)
+        times, knots = np.empty((2, len(self.paths), width))
+        self.normalized(self.paths, scale, width, times, knots)
+        return catmull_rom(times, knots, t, self.mag)
@@ -132,7 +132,8 @@ profile = (
 
   # The other keys in the 'output' dictionary are format-specific and not
   # documented here.
-  , 'output': {'type': enum('jpeg png tiff x264', 'jpeg')}
+  , 'output': {'type': enum('jpeg png tiff exr x264 vp8 vp9 prores y4m',
+                            'jpeg')}
   })
 
 # Types recognized as independent units with a 'type' key
@@ -276,6 +276,13 @@ integer multiple of the period size.
 
 from collections import namedtuple
 
+# 2^SEARCH_ROUNDS is the maximum number of knots allowed in a single spline.
+# This includes the four required knots, so a 5 round search supports 28
+# interior knots in the domain (0, 1). 2^5 fits nicely on a single cache line.
+# The device interpolator's binary search is generated with this many rounds.
+SEARCH_ROUNDS = 5
+MAX_KNOTS = 1 << SEARCH_ROUNDS
+
 Map = namedtuple('Map', 'type doc')
 List = namedtuple('List', 'type default doc')
 Spline = namedtuple('Spline', 'default min max interp period doc var')
@@ -0,0 +1,43 @@
+import unittest
+import numpy as np
+
+from cuburn.genome.chaos import ChaosGame
+
+def _contraction():
+    # x -> x/2 + (0.25, -0.5), which converges to (0.5, -1)
+    return dict(type='animation', xforms={'0': dict(
+        weight=1, variations=dict(linear=dict(weight=1)),
+        pre_affine=dict(magnitude=dict(x=0.5, y=0.5),
+                        offset=dict(x=0.25, y=0.5)))})
+
+class ChaosGameTest(unittest.TestCase):
+    def test_fixed_point(self):
+        game = ChaosGame(_contraction())
+        s = game.run(0.5, npoints=256, rounds=4, project=False)
+        self.assertEquals(0, s.resets)
+        self.assertEquals(256 * 20, s.iters)
+        self.assertEquals(256 * 4, len(s.x))
+        self.assertTrue(np.allclose(0.5, s.x, atol=1e-4))
+        self.assertTrue(np.allclose(-1, s.y, atol=1e-4))
+        self.assertEquals([], game.unsupported)
+
+    def test_camera(self):
+        gnm = _contraction()
+        gnm['camera'] = dict(center=dict(x=0.5, y=0), scale=2, rotation=90)
+        s = ChaosGame(gnm).run(0.5, npoints=256, rounds=4)
+        self.assertTrue(np.allclose(2, s.x, atol=1e-3))
+        self.assertTrue(np.allclose(0, s.y, atol=1e-3))
+
+    def test_resets(self):
+        gnm = dict(type='animation', xforms={'0': dict(
+            weight=1, variations=dict(spherical=dict(weight=1)),
+            pre_affine=dict(magnitude=dict(x=0, y=0)))})
+        s = ChaosGame(gnm).run(0.5, npoints=64, rounds=2, fuse=2)
+        # Every point is sent to the origin, where spherical is undefined,
+        # so all of them are reseeded before each iteration after the first
+        self.assertEquals(64 * 3, s.resets)
+
+    def test_unsupported(self):
+        gnm = _contraction()
+        gnm['xforms']['0']['variations']['nonexistent'] = dict(weight=0)
+        self.assertEquals(['nonexistent'], ChaosGame(gnm).unsupported)
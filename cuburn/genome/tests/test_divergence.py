@@ -0,0 +1,28 @@
+import unittest
+import numpy as np
+
+from cuburn.genome import divergence
+
+def _linear(mag):
+    return dict(type='animation', xforms={'0': dict(
+        weight=1, variations=dict(linear=dict(weight=1)),
+        pre_affine=dict(magnitude=dict(x=mag, y=mag)))})
+
+class DivergenceTest(unittest.TestCase):
+    def test_contractive(self):
+        div = divergence.analyze(_linear(0.5), ntimes=2, npoints=256)
+        self.assertEquals(0, div.reset_rate)
+        self.assertEquals([0, 0], list(div.reset_rates))
+        self.assertAlmostEquals(np.log(0.5), div.lyapunov, places=6)
+        self.assertEquals(1, len(div.xforms))
+        self.assertAlmostEquals(0.5, div.xforms[0].sigma)
+        self.assertNotIn('DIVERGENT', divergence.format_report('c', div))
+
+    def test_expansive(self):
+        # Points overflow every eighth iteration, and are reset
+        div = divergence.analyze(_linear(1e40), ntimes=2, npoints=256)
+        # Flagged at the CLI's default `--max-reset-rate`
+        self.assertGreater(div.reset_rate, 0.01)
+        self.assertGreater(div.lyapunov, 0)
+        self.assertGreater(div.xforms[0].expansion, 0)
+        self.assertIn('DIVERGENT', divergence.format_report('e', div))
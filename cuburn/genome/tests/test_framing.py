@@ -0,0 +1,47 @@
+import unittest
+
+from cuburn.genome import framing
+from cuburn.genome.chaos import ChaosGame
+
+def _square(scale):
+    # Points uniformly distributed over [-0.5, 0.5] in both axes
+    return dict(type='animation', camera=dict(scale=scale, rotation=90),
+                xforms={'0': dict(weight=1,
+                                  variations=dict(square=dict(weight=1)))})
+
+class FramingTest(unittest.TestCase):
+    def test_filled(self):
+        f = framing.estimate(_square(0.7), 1000, 1000, ntimes=3, npoints=512,
+                             rounds=8)
+        self.assertEquals(3, len(f.fractions))
+        self.assertGreater(f.fraction, 0.99)
+        self.assertEquals([], f.unsupported)
+
+    def test_loose(self):
+        f = framing.estimate(_square(10), 1000, 1000, ntimes=3, npoints=512,
+                             rounds=8)
+        # The frame covers about 1% of the square
+        self.assertLess(f.fraction, 0.02)
+        self.assertGreater(f.fraction, 0)
+
+    def test_apply_camera(self):
+        gnm = _square(10)
+        f = framing.estimate(gnm, 1000, 1000, ntimes=3, npoints=512, rounds=8)
+        fixed = framing.apply_camera(gnm, f)
+        self.assertEquals(10, gnm['camera']['scale'])
+        self.assertEquals(90, fixed['camera']['rotation'])
+        for key in ('center', 'scale'):
+            self.assertEquals(f.camera[key], fixed['camera'][key])
+
+        # The central 99% of the square, with a 5% margin on each side
+        get = ChaosGame(fixed).getter(0.5)
+        self.assertAlmostEquals(0.9 / 0.99, get(('camera', 'scale')),
+                                places=1)
+        self.assertAlmostEquals(0, get(('camera', 'center', 'x')), places=1)
+
+        refit = framing.estimate(fixed, 1000, 1000, ntimes=3, npoints=512,
+                                 rounds=8)
+        self.assertGreater(refit.fraction, 0.99)
+        reget = ChaosGame(framing.apply_camera(fixed, refit)).getter(0.5)
+        self.assertAlmostEquals(get(('camera', 'scale')),
+                                reget(('camera', 'scale')), places=1)
@@ -0,0 +1,88 @@
+import unittest
+import numpy as np
+
+from cuburn.genome.use import SplineEval
+from cuburn.genome.soa import catmull_rom
+from cuburn.genome.simplify import simplify, simplify_spline, _deviation
+
+def _samples(knots, density=8):
+    """The sample times `simplify_spline` measures deviation at."""
+    ts = sorted(set([0.0, 1.0] + [t for t in knots[4::2] if 0 <= t <= 1]))
+    return np.concatenate(
+            [np.linspace(a, b, density, endpoint=False)
+             for a, b in zip(ts[:-1], ts[1:])] + [[1.0]])
+
+def _eval(knots, t, mag=False):
+    k = SplineEval.normalize(knots, 1)
+    return catmull_rom(np.repeat(k[:1], len(t), axis=0),
+                       np.repeat(k[1:], len(t), axis=0), t, mag)
+
+def _wave():
+    knots = [0, 0, 0, 0]
+    for t in np.arange(1, 10) / 10.:
+        knots += [t, round(np.sin(2 * np.pi * t), 3)]
+    return knots
+
+class SimplifySplineTest(unittest.TestCase):
+    def test_tolerance(self):
+        knots = _wave()
+        self.assertEquals((knots, 0.0), simplify_spline(knots, tol=0))
+
+        new, err = simplify_spline(knots, tol=0.05)
+        self.assertLess(len(new), len(knots))
+        t = _samples(knots)
+        dev = np.abs(_eval(new, t) - _eval(knots, t))
+        self.assertLessEqual(dev.max(), 0.05)
+        self.assertAlmostEquals(err, dev.max())
+
+        looser, err = simplify_spline(knots, tol=0.2)
+        self.assertLessEqual(len(looser), len(new))
+        self.assertLessEqual(err, 0.2)
+
+    def test_max_knots(self):
+        knots = _wave()
+        new, err = simplify_spline(knots, tol=0, max_knots=8)
+        # Knots are removed to fit, whatever the cost
+        self.assertEquals(8, SplineEval.normalize(new, 1).shape[1])
+        t = _samples(knots)
+        self.assertAlmostEquals(
+                err, np.abs(_eval(new, t) - _eval(knots, t)).max())
+        self.assertGreater(err, 0)
+
+    def test_flat(self):
+        knots = [1, 0, 1, 0, 0.25, 1, 0.5, 1, 0.75, 1]
+        new, err = simplify_spline(knots, tol=1e-9)
+        self.assertEquals([1, 0, 1, 0], new)
+        self.assertLess(err, 1e-9)
+
+    def test_mag(self):
+        # A 10% bump is far more than 0.2 in value, but log2(1.1) (about
+        # 0.14) in the linear-log domain magnitudes are interpolated in
+        knots = [1000, 0, 1000, 0, 0.5, 1100]
+        self.assertEquals((knots, 0.0), simplify_spline(knots, tol=0.2))
+        new, err = simplify_spline(knots, tol=0.2, mag=True)
+        self.assertEquals([1000, 0, 1000, 0], new)
+        self.assertAlmostEquals(np.log2(1.1), err, places=6)
+
+    def test_deviation(self):
+        a, b = np.array([350., 10.]), np.array([10., 350.])
+        self.assertEquals([340, 340], list(_deviation(a, b)))
+        self.assertEquals([20, 20], list(_deviation(a, b, period=360)))
+        self.assertAlmostEquals(
+                1, _deviation(np.array([4.]), np.array([8.]), mag=True)[0])
+
+class SimplifyTest(unittest.TestCase):
+    def test_simplify(self):
+        gnm = dict(type='animation', xforms={'0': dict(pre_affine=dict(
+            angle=[0, 0, 0, 0, 0.5, 360],
+            magnitude=dict(x=[1000, 0, 1000, 0, 0.5, 1100])))})
+        new, report = simplify(gnm, tol=0.2)
+        aff = new['xforms']['0']['pre_affine']
+        self.assertEquals([1000, 0, 1000, 0], aff['magnitude']['x'])
+        # Removing the full turn would change the angle between knots
+        self.assertEquals([0, 0, 0, 0, 0.5, 360], aff['angle'])
+        self.assertEquals(1, len(report))
+        path, removed, error = report[0]
+        self.assertEquals(('xforms.0.pre_affine.magnitude.x', 1),
+                          (path, removed))
+        self.assertAlmostEquals(np.log2(1.1), error, places=6)
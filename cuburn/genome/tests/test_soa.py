@@ -0,0 +1,89 @@
+import unittest
+import numpy as np
+
+from cuburn.genome import specs
+from cuburn.genome.use import SplineEval
+from cuburn.genome.soa import GenomeArrays, catmull_rom
+
+def _make_anim():
+    return dict(
+        type='animation',
+        name='test',
+        camera=dict(center=dict(x=0.5, y=[0, 1]), scale=[1, 0.5, 2, -0.5],
+                    rotation=[0, -360, -1080, -360, 0.25, -200, 0.5, -500]),
+        time=dict(duration=3),
+        filters=dict(haloclip={}),
+        palette=[[0, 'rgb8', 'AAAA']],
+        xforms={
+            '0': dict(weight=0.5, color=[0, 1],
+                      variations=dict(linear=dict(weight=1)),
+                      pre_affine=dict(angle=[45, 0, 405, 0])),
+            'pad_1': dict(weight=[0, 0, 1, 0, 0.5, 0.25],
+                          variations=dict(julian=dict(weight=1, power=2))),
+        })
+
+class GenomeArraysTest(unittest.TestCase):
+    def test_round_trip(self):
+        gnm = _make_anim()
+        arrs = GenomeArrays.from_dict(gnm)
+        self.assertEquals(gnm, arrs.to_dict())
+
+    def test_access_by_path(self):
+        arrs = GenomeArrays.from_dict(_make_anim())
+        self.assertEquals([0, 1], list(arrs['camera.center.y']))
+        self.assertEquals([0.5], list(arrs[('xforms', '0', 'weight')]))
+        self.assertIn('xforms.pad_1.variations.julian.power', arrs)
+        self.assertNotIn('xforms.0.color_speed', arrs)
+        self.assertTrue(arrs.mag[arrs.index[('camera', 'scale')]])
+
+    def test_set_changes_length(self):
+        arrs = GenomeArrays.from_dict(_make_anim())
+        arrs['camera.center.x'] = [0.5, 1]
+        arrs['xforms.0.color'] = 0.25
+        gnm = arrs.to_dict()
+        self.assertEquals([0.5, 1], gnm['camera']['center']['x'])
+        self.assertEquals(0.25, gnm['xforms']['0']['color'])
+        self.assertEquals(0.5, gnm['xforms']['0']['weight'])
+
+    def test_normalized_matches_spline_eval(self):
+        gnm = _make_anim()
+        arrs = GenomeArrays.from_dict(gnm)
+        paths = arrs.paths + [('xforms', '0', 'color_speed')]
+        times, knots = arrs.normalized(paths, 3, 32, spec=specs.anim)
+        for i, path in enumerate(arrs.paths):
+            ref = SplineEval.normalize(arrs.knotlist(i), 3)
+            n = ref.shape[1]
+            self.assertTrue(np.allclose(ref[0], times[i,:n]))
+            self.assertTrue(np.allclose(ref[1], knots[i,:n]))
+            self.assertTrue(np.all(times[i,n:] == 1e9))
+        self.assertTrue(np.allclose(0.5, knots[-1,:4]))
+
+    def test_normalized_rejects_odd_lists(self):
+        for knots in ([0.5], [0.5, 0, 1]):
+            arrs = GenomeArrays.from_dict(_make_anim())
+            arrs['xforms.0.color'] = knots
+            self.assertRaises(ValueError, SplineEval.normalize, knots, 3)
+            self.assertRaises(ValueError, arrs.normalized, arrs.paths, 3, 32)
+
+    def test_evaluate_matches_spline_eval(self):
+        arrs = GenomeArrays.from_dict(_make_anim())
+        for t in (0, 0.1, 0.5, 0.77, 1):
+            vals = arrs.evaluate(t)
+            for i, path in enumerate(arrs.paths):
+                if arrs.mag[i]:
+                    continue
+                ref = SplineEval(arrs.knotlist(i), 3)(t)
+                self.assertAlmostEqual(ref, vals[i], places=4)
+
+    def test_evaluate_without_splines(self):
+        arrs = GenomeArrays.from_dict(dict(type='animation', name='empty'))
+        self.assertEquals([], arrs.paths)
+        self.assertEquals(0, len(arrs.evaluate(0.5)))
+
+    def test_mag_interp_hits_knots(self):
+        times = np.array([[-2, 0, 1, 3]], dtype=np.float64)
+        knots = np.array([[4, 1, 4, 1]], dtype=np.float64)
+        self.assertAlmostEqual(1, catmull_rom(times, knots, 0, True)[0])
+        self.assertAlmostEqual(4, catmull_rom(times, knots, 1, True)[0])
+        mid = catmull_rom(times, knots, 0.5, True)[0]
+        self.assertTrue(1 < mid < 2.5)
@@ -0,0 +1,55 @@
+import unittest
+
+from cuburn.genome.db import OneFileDB
+from cuburn.genome.validate import validate, validate_db, MAX_KNOTS
+
+def _make_anim():
+    return dict(
+        type='animation',
+        camera=dict(center=dict(x=0.5, y=[0, 1]), scale=[1, 0.5, 2, -0.5]),
+        palette=[[0, 'rgb8', 'A' * 1024]],
+        xforms={'0': dict(weight=0.5,
+                          variations=dict(linear=dict(weight=1)))})
+
+class ValidateTest(unittest.TestCase):
+    def test_valid(self):
+        self.assertEquals([], validate(_make_anim()))
+
+    def test_reports_every_violation(self):
+        gnm = _make_anim()
+        gnm['camera']['scale'] = [1, 0.5, 2]
+        gnm['xforms']['0']['variations']['nonesuch'] = dict(weight=1)
+        gnm['palette'][0][1] = 'rgb16'
+        gnm['xforms']['0']['weight'] = [0, 0] + [0.5, 1] * MAX_KNOTS
+        paths = sorted(v.path for v in validate(gnm))
+        self.assertEquals(['camera.scale', 'palette.0',
+                           'xforms.0.variations.nonesuch',
+                           'xforms.0.weight'], paths)
+
+    def test_node_splines(self):
+        node = dict(type='node', camera=dict(scale=[1, 2, 3]))
+        self.assertEquals(['camera.scale'],
+                          [v.path for v in validate(node)])
+
+    def test_profile_output_is_open(self):
+        prof = dict(output=dict(type='x264', crf=15))
+        self.assertEquals([], validate(prof, 'profile'))
+        prof['output']['type'] = 'gif'
+        self.assertEquals(['output.type'],
+                          [v.path for v in validate(prof, 'profile')])
+
+    def test_validate_db(self):
+        bad = _make_anim()
+        bad['xforms']['0']['variations']['nonesuch'] = dict(weight=1)
+        dct = dict(type='onefiledb', bad=bad)
+        for i in range(7):
+            dct['good%d' % i] = _make_anim()
+        gdb = OneFileDB(dct)
+        for processes in (1, 2):
+            found = list(validate_db(gdb, processes=processes, chunksize=2))
+            self.assertEquals(['bad'], [id for id, errs in found])
+            self.assertEquals(['xforms.0.variations.nonesuch'],
+                              [v.path for v in found[0][1]])
+        found = list(validate_db(gdb, ['good0', 'missing'], processes=2,
+                                 chunksize=1))
+        self.assertEquals(['missing'], [id for id, errs in found])
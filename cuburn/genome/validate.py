@@ -0,0 +1,288 @@
+"""
+Validation of genome documents against the schemas in `specs`.
+
+Each spec is compiled once into a tree of checker closures, so validating a
+document is a single pass over its values with no spec lookups. Checkers
+report every violation they find, along with its dot-separated path, rather
+than stopping at the first.
+
+Checks are tailored to the document type: node splines must be a position or
+a position/velocity pair, edge splines must be lists of (time, position)
+knots, and animation splines must be normalizable and fit within the knot
+limit of the device interpolator.
+"""
+
+import binascii
+import multiprocessing
+from collections import namedtuple
+
+import spectypes
+from spectypes import MAX_KNOTS
+from specs import toplevels
+from variations import var_params
+
+Violation = namedtuple('Violation', 'path msg')
+
+# Keys that may appear in a document without being covered by its spec.
+# Blending carries the node-only 'author' and 'blend' sections through to
+# animations, where they're simply ignored.
+_tolerated = {
+    'animation': ('type', 'author', 'blend'),
+    'node': ('type',),
+    'edge': ('type',),
+    'profile': ('type',),
+}
+
+# Dicts whose unknown keys are passed through to some other consumer, and
+# so are not checked. The profile's output dict holds format-specific keys.
+_open = {'profile': (('output',),)}
+
+_isnum = lambda v: isinstance(v, (int, long, float)) and not isinstance(v, bool)
+
+def _spath(path):
+    return '.'.join(map(str, path))
+
+def _spline_anim(sp):
+    def check(val, path, out):
+        if _isnum(val):
+            return
+        if not isinstance(val, list):
+            out.append(Violation(_spath(path), 'spline must be a number or '
+                                 'a list, got %s' % type(val).__name__))
+        elif len(val) % 2 or not val:
+            out.append(Violation(_spath(path), 'spline has an odd or zero '
+                                 'number of elements (%d)' % len(val)))
+        elif not all(map(_isnum, val)):
+            out.append(Violation(_spath(path), 'spline contains non-numeric '
+                                 'values'))
+        elif len(val) > 2:
+            # Stabilizing knots are only added if no interior knot lies
+            # outside of the [0, 1] interval on that side
+            ts = val[4::2]
+            nknots = (len(val) / 2 + (not ts or min(ts) >= 0)
+                      + (not ts or max(ts) <= 1))
+            if nknots > MAX_KNOTS:
+                out.append(Violation(_spath(path), 'spline has %d knots, more '
+                                     'than the limit of %d' %
+                                     (nknots, MAX_KNOTS)))
+    return check
+
+def _spline_node(sp):
+    def check(val, path, out):
+        if _isnum(val):
+            return
+        if (not isinstance(val, list) or len(val) != 2
+                or not all(map(_isnum, val))):
+            out.append(Violation(_spath(path), 'node spline must be a number '
+                                 'or a [position, velocity] pair'))
+    return check
+
+def _spline_edge(sp):
+    def check(val, path, out):
+        if not isinstance(val, list):
+            out.append(Violation(_spath(path), 'edge spline must be a list '
+                                 'of [time, position] knots'))
+        elif len(val) % 2:
+            out.append(Violation(_spath(path), 'edge spline has an odd '
+                                 'number of elements (%d)' % len(val)))
+        elif not all(map(_isnum, val[::2])):
+            out.append(Violation(_spath(path), 'knot times must be numeric'))
+        elif not all(v is None or _isnum(v) for v in val[1::2]):
+            out.append(Violation(_spath(path), 'knot positions must be '
+                                 'numeric or null'))
+        elif len(val) / 2 + 4 > MAX_KNOTS:
+            out.append(Violation(_spath(path), 'edge spline has %d knots, '
+                                 'more than the limit of %d' %
+                                 (len(val) / 2, MAX_KNOTS - 4)))
+    return check
+
+_spline_checkers = dict(animation=_spline_anim, node=_spline_node,
+                        edge=_spline_edge, profile=_spline_anim)
+
+def _check_palette_data(val, path, out):
+    if not val or val[0] != 'rgb8':
+        out.append(Violation(_spath(path), 'palette format must be rgb8, got '
+                             '%r' % (val[0] if val else None)))
+        return
+    if not all(isinstance(v, basestring) for v in val[1:]):
+        out.append(Violation(_spath(path), 'palette data must be strings'))
+        return
+    try:
+        size = len(binascii.a2b_base64(''.join(val[1:])))
+    except binascii.Error, e:
+        out.append(Violation(_spath(path), 'bad palette data: %s' % e))
+        return
+    if size != 256 * 3:
+        out.append(Violation(_spath(path), 'palette data has %d bytes, '
+                             'expected %d' % (size, 256 * 3)))
+
+def _palette_list(kind):
+    if kind != 'animation':
+        # Nodes and edges hold a single palette in place of the list
+        def check(val, path, out):
+            if not isinstance(val, list):
+                out.append(Violation(_spath(path), 'palette must be a list'))
+            else:
+                _check_palette_data(val, path, out)
+        return check
+
+    def check(val, path, out):
+        if not isinstance(val, list):
+            out.append(Violation(_spath(path), 'palettes must be a list'))
+            return
+        if len(val) > MAX_KNOTS:
+            out.append(Violation(_spath(path), '%d palettes, more than the '
+                                 'limit of %d' % (len(val), MAX_KNOTS)))
+        for i, pal in enumerate(val):
+            ipath = path + (i,)
+            if not isinstance(pal, list) or not pal or not _isnum(pal[0]):
+                out.append(Violation(_spath(ipath), 'palette must be a list '
+                                     'starting with its time'))
+            else:
+                _check_palette_data(pal[1:], ipath, out)
+    return check
+
+def _compile(spec, kind, path=()):
+    """
+    Compile ``spec`` into a function `check(val, path, out)` that appends a
+    `Violation` to the list ``out`` for each problem found in ``val``.
+    """
+    if isinstance(spec, spectypes.Spline):
+        return _spline_checkers[kind](spec)
+    elif isinstance(spec, (spectypes.Scalar, spectypes.RefScalar)):
+        def check(val, path, out):
+            if val is not None and not _isnum(val):
+                out.append(Violation(_spath(path), 'expected a number'))
+        return check
+    elif isinstance(spec, spectypes.String):
+        def check(val, path, out):
+            if not isinstance(val, basestring):
+                out.append(Violation(_spath(path), 'expected a string'))
+        return check
+    elif isinstance(spec, spectypes.Enum):
+        choices = frozenset(spec.choices)
+        def check(val, path, out):
+            if val not in choices:
+                out.append(Violation(_spath(path), '%r is not one of %s' %
+                                     (val, ', '.join(sorted(choices)))))
+        return check
+    elif isinstance(spec, spectypes.List):
+        if isinstance(spec.type, spectypes.Palette):
+            return _palette_list(kind)
+        item = _compile(spec.type, kind, path + ('*',))
+        def check(val, path, out):
+            if not isinstance(val, list):
+                out.append(Violation(_spath(path), 'expected a list'))
+                return
+            for i, v in enumerate(val):
+                item(v, path + (i,), out)
+        return check
+    elif isinstance(spec, spectypes.Map):
+        item = _compile(spec.type, kind, path + ('*',))
+        def check(val, path, out):
+            if not isinstance(val, dict):
+                out.append(Violation(_spath(path), 'expected a dict'))
+                return
+            for k, v in val.items():
+                item(v, path + (k,), out)
+        return check
+    elif isinstance(spec, dict):
+        children = dict((k, _compile(v, kind, path + (k,)))
+                        for k, v in spec.items() if k != 'type')
+        tolerated = frozenset(_tolerated[kind] if not path else ())
+        is_open = path in _open.get(kind, ())
+        what = 'variation' if spec is var_params else 'key'
+        def check(val, path, out):
+            if not isinstance(val, dict):
+                out.append(Violation(_spath(path), 'expected a dict'))
+                return
+            for k, v in val.items():
+                child = children.get(k)
+                if child is not None:
+                    child(v, path + (k,), out)
+                elif not (is_open or k in tolerated):
+                    out.append(Violation(_spath(path + (k,)),
+                                         'unknown %s %r' % (what, k)))
+        return check
+    # Anything else (like the 'type' key itself) is not checked
+    return lambda val, path, out: None
+
+_checkers = dict((k, _compile(v, k)) for k, v in toplevels.items())
+
+def validate(doc, type=None):
+    """
+    Validate a genome or profile document, returning a list of `Violation`
+    namedtuples (empty if the document is valid). The document type is taken
+    from its 'type' key, unless given as ``type``.
+    """
+    if not isinstance(doc, dict):
+        return [Violation('', 'document must be a dict')]
+    type = type or doc.get('type')
+    if type not in _checkers:
+        return [Violation('type', 'unrecognized document type %r' % type)]
+    out = []
+    _checkers[type](doc, (), out)
+    return out
+
+def format_violations(name, violations):
+    """Format a document's violations as a human-readable string."""
+    return '\n'.join(['%s:' % name] +
+                     ['  %s: %s' % (v.path or '(root)', v.msg)
+                      for v in violations])
+
+# The database used by validation workers. Set before forking, so that
+# workers inherit it rather than having to reconnect or unpickle it.
+_pool_db = None
+
+def _validate_ids(ids):
+    out = []
+    for id in ids:
+        try:
+            errs = validate(_pool_db.get(id))
+        except Exception, e:
+            errs = [Violation('', 'could not load document: %s' % e)]
+        if errs:
+            out.append((id, errs))
+    return out
+
+def validate_db(gdb, ids=None, processes=None, chunksize=256):
+    """
+    Validate every document in the `GenomeDB` ``gdb`` (or just those in
+    ``ids``) using a pool of worker processes. Yields `(id, violations)` for
+    each invalid document, in no particular order.
+    """
+    global _pool_db
+    if ids is None:
+        ids = gdb.ids()
+    ids = list(ids)
+    chunks = [ids[i:i+chunksize] for i in range(0, len(ids), chunksize)]
+    if processes == 1 or len(chunks) <= 1:
+        _pool_db = gdb
+        for chunk in chunks:
+            for r in _validate_ids(chunk):
+                yield r
+        return
+
+    _pool_db = gdb
+    pool = multiprocessing.Pool(processes)
+    try:
+        for rs in pool.imap_unordered(_validate_ids, chunks):
+            for r in rs:
+                yield r
+    finally:
+        pool.terminate()
+        _pool_db = None
+
+if __name__ == "__main__":
+    import sys, time
+    import db
+    if len(sys.argv) < 2:
+        sys.exit('Usage: validate.py DBPATH [ID ...]')
+    gdb = db.connect(sys.argv[1])
+    start, nbad = time.time(), 0
+    for id, errs in validate_db(gdb, sys.argv[2:] or None):
+        nbad += 1
+        print format_violations(id, errs)
+    print >> sys.stderr, '%d invalid documents (%.2fs)' % (
+            nbad, time.time() - start)
+    sys.exit(1 if nbad else 0)
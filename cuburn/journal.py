@@ -0,0 +1,144 @@
+"""
+A crash-safe journal of the dispatcher's jobs.
+
+The journal is an append-only file of JSON lines, one per event:
+
+    genome    a genome, stored once and referred to by key afterwards
+    submit    a job was queued, with its name, start frame, times, archive,
+              retry count, and genome key
+    assign    a job was handed to a worker
+    split     a job gave up its frames from `limit` on to a new job
+    complete  a job finished, producing the given output suffixes
+    fail      a job failed, and was either requeued or dropped
+    source    all jobs for a flame id on the command line were submitted
+
+Jobs are identified by their name and start frame. Opening a journal
+replays it, so a restarted dispatcher can requeue whatever hadn't been
+completed (including jobs that were in flight) without resolving genomes
+or checking for output files again, and skip flame ids that were fully
+submitted. As with archives, a torn last line is discarded.
+"""
+
+import os
+import json
+import time
+import hashlib
+from collections import OrderedDict
+
+class Journal(object):
+    """
+    Appends to the journal at ``path``, after replaying any existing
+    contents. Each event is flushed as it's written, and synced to disk at
+    most every ``sync_interval`` seconds.
+
+    After replay, ``pending`` holds a dict of the fields of each incomplete
+    job, in submission order; ``sources`` holds the completed flame ids;
+    and ``splits`` maps the name of each split job to a dict of its part
+    start frames (``starts``), suffixes of the parts' outputs so far
+    (``suffixes``), the number of parts not yet complete (``pending``), and
+    whether any part was dropped after running out of retries (``failed``).
+    """
+    def __init__(self, path, sync_interval=1):
+        self.path, self.sync_interval = path, sync_interval
+        self._fp = open(path, 'ab+')
+        self._fp.seek(0)
+        data = self._fp.read()
+        end = data.rfind('\n') + 1
+        self._fp.truncate(end)
+        self._fp.seek(0, os.SEEK_END)
+        self._replay(data[:end].splitlines())
+        self._last_sync = time.time()
+        # Keys of the genomes written so far, by object identity, keeping
+        # a reference so that ids aren't reused
+        self._genome_keys = {}
+
+    def _replay(self, lines):
+        genomes, jobs, parts = {}, OrderedDict(), {}
+        suffixes, dropped, self.sources = {}, set(), set()
+        for line in lines:
+            ev = json.loads(line)
+            kind = ev.pop('ev')
+            if kind == 'genome':
+                genomes[ev['key']] = ev['genome']
+                continue
+            if kind == 'source':
+                self.sources.add(ev['id'])
+                continue
+            ident = (ev['name'], ev['start'])
+            if kind == 'submit':
+                ev['genome'] = genomes[ev['genome']]
+                jobs[ident] = ev
+            elif kind == 'split':
+                job = jobs[ident]
+                job['times'] = job['times'][:ev['limit']]
+                parts.setdefault(ev['name'], set()).update(
+                        [ev['start'], ev['start'] + ev['limit']])
+            elif kind == 'complete':
+                jobs.pop(ident, None)
+                suffixes.setdefault(ev['name'], set()).update(ev['suffixes'])
+            elif kind == 'fail':
+                # A job can be dropped, or complete, before a late failure
+                # of another attempt at it is recorded
+                job = jobs.get(ident)
+                if job is None:
+                    continue
+                if ev['requeued']:
+                    job['retry_count'] += 1
+                else:
+                    del jobs[ident]
+                    dropped.add(ev['name'])
+        self.pending = jobs.values()
+        self._genomes = genomes
+        self.splits = {}
+        for name, starts in parts.items():
+            self.splits[name] = dict(
+                    starts=starts, suffixes=suffixes.get(name, set()),
+                    pending=sum((name, s) in jobs for s in starts),
+                    failed=name in dropped)
+
+    def _write(self, kind, **ev):
+        ev['ev'] = kind
+        self._fp.write(json.dumps(ev) + '\n')
+        self._fp.flush()
+        if time.time() - self._last_sync > self.sync_interval:
+            self.sync()
+
+    def _genome_key(self, gnm):
+        if id(gnm) not in self._genome_keys:
+            key = hashlib.sha1(json.dumps(gnm, sort_keys=True)).hexdigest()
+            if key not in self._genomes:
+                self._write('genome', key=key, genome=gnm)
+                self._genomes[key] = None
+            self._genome_keys[id(gnm)] = (gnm, key)
+        return self._genome_keys[id(gnm)][1]
+
+    def submit(self, job):
+        self._write('submit', name=job.name, start=job.start,
+                    times=list(job.times), archive=job.archive,
+                    retry_count=job.retry_count,
+                    genome=self._genome_key(job.genome))
+
+    def assign(self, job, worker):
+        self._write('assign', name=job.name, start=job.start, worker=worker)
+
+    def split(self, job, limit):
+        self._write('split', name=job.name, start=job.start, limit=limit)
+
+    def complete(self, job, suffixes):
+        self._write('complete', name=job.name, start=job.start,
+                    suffixes=sorted(suffixes))
+
+    def fail(self, job, requeued):
+        self._write('fail', name=job.name, start=job.start, requeued=requeued)
+
+    def source(self, id):
+        self._write('source', id=id)
+
+    def sync(self):
+        self._last_sync = time.time()
+        self._fp.flush()
+        os.fsync(self._fp.fileno())
+
+    def close(self):
+        self.sync()
+        self._fp.close()
@@ -0,0 +1,111 @@
+"""
+Throughput metrics for the dispatcher, kept per worker.
+
+For each worker, the dispatcher counts jobs and frames rendered, GPU time
+spent rendering them (as reported by the worker), bytes received before
+and after transfer compression and the time spent receiving them, jobs
+that failed and were retried, time spent idle between jobs, waiting for
+the queue, and iteration modules compiled, along with the number of jobs
+routed to it by genome structure affinity. Comparing these shows whether a
+run is bound by the GPUs (little idle time, GPU time close to wall time),
+the network (transfer time close to wall time) or job supply (idle time
+with an empty queue).
+"""
+
+import time
+
+class WorkerStats(object):
+    def __init__(self, now):
+        self.start = self.idle_since = now
+        self.jobs = self.frames = self.retries = 0
+        self.compiles = self.affine_jobs = 0
+        self.render_ms = self.bytes = self.wire_bytes = 0
+        self.xfer_time = self.idle_time = 0.
+
+    def as_dict(self, now):
+        elapsed = max(now - self.start, 1e-6)
+        idle = self.idle_time
+        if self.idle_since is not None:
+            idle += now - self.idle_since
+        return dict(
+            jobs=self.jobs, frames=self.frames, retries=self.retries,
+            compiles=self.compiles, affine_jobs=self.affine_jobs,
+            fps=self.frames / elapsed,
+            ms_per_frame=self.render_ms / float(self.frames or 1),
+            gpu_util=self.render_ms / 1e3 / elapsed,
+            bytes=self.bytes, wire_bytes=self.wire_bytes,
+            xfer_time=self.xfer_time,
+            mbps=self.wire_bytes / 1e6 / max(self.xfer_time, 1e-6),
+            idle_time=idle, idle_frac=idle / elapsed)
+
+class Metrics(object):
+    """
+    Collects `WorkerStats` by worker address. `queue_depth`, if given, is
+    called to get the number of jobs waiting when taking a snapshot.
+    """
+    def __init__(self, queue_depth=None, clock=time.time):
+        self.queue_depth, self.clock = queue_depth, clock
+        self.start = clock()
+        self.workers = {}
+
+    def _get(self, addr):
+        if addr not in self.workers:
+            self.workers[addr] = WorkerStats(self.clock())
+        return self.workers[addr]
+
+    def job_started(self, addr, affine=False):
+        w = self._get(addr)
+        w.affine_jobs += affine
+        if w.idle_since is not None:
+            w.idle_time += self.clock() - w.idle_since
+        w.idle_since = None
+
+    def job_done(self, addr, failed=False, compiles=0):
+        w = self._get(addr)
+        w.idle_since = self.clock()
+        w.compiles += compiles
+        if failed:
+            w.retries += 1
+        else:
+            w.jobs += 1
+
+    def frame(self, addr, render_ms):
+        w = self._get(addr)
+        w.frames += 1
+        w.render_ms += render_ms
+
+    def transfer(self, addr, size, wire, secs):
+        w = self._get(addr)
+        w.bytes += size
+        w.wire_bytes += wire
+        w.xfer_time += secs
+
+    def snapshot(self):
+        """Return all metrics as a JSON-serializable dict."""
+        now = self.clock()
+        workers = dict((addr, w.as_dict(now))
+                       for addr, w in self.workers.items())
+        total = dict(elapsed=now - self.start,
+                     frames=sum(w.frames for w in self.workers.values()),
+                     fps=sum(w['fps'] for w in workers.values()))
+        if self.queue_depth is not None:
+            total['queue_depth'] = self.queue_depth()
+        return dict(time=now, total=total, workers=workers)
+
+    def summary(self):
+        """Return a table of per-worker metrics, as a string."""
+        snap = self.snapshot()
+        lines = ['%-20s %6s %7s %7s %9s %8s %8s %7s %6s %9s' % (
+            'worker', 'jobs', 'frames', 'fps', 'ms/frame', 'MB', 'xfer s',
+            'idle %', 'fails', 'compiles')]
+        for addr, w in sorted(snap['workers'].items()):
+            lines.append(
+                '%-20s %6d %7d %7.2f %9.0f %8.1f %8.1f %7.1f %6d %9d' % (
+                addr, w['jobs'], w['frames'], w['fps'], w['ms_per_frame'],
+                w['wire_bytes'] / 1e6, w['xfer_time'], 100 * w['idle_frac'],
+                w['retries'], w['compiles']))
+        total = snap['total']
+        lines.append('%d frames in %.1fs, %.2f frames/s' % (
+            total['frames'], total['elapsed'],
+            total['frames'] / max(total['elapsed'], 1e-6)))
+        return '\n'.join(lines)
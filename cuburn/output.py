@@ -1,7 +1,14 @@
 import io
 import os
 import sys
+import zlib
+import Queue
+import struct
 import tempfile
+import threading
+import multiprocessing
+from collections import deque
+from multiprocessing.pool import ThreadPool
 from cStringIO import StringIO
 from subprocess import Popen, PIPE
 import numpy as np
@@ -11,12 +18,7 @@ import pycuda.driver as cuda
 
 from code.util import ClsMod, launch
 from code.output import pixfmtlib
-
-
-try:
-    import gevent
-except ImportError:
-    gevent = None
+import exr
 
 def launchC(name, mod, stream, dim, fb, *args):
     launch(name, mod, stream,
@@ -26,6 +28,17 @@ def launchC(name, mod, stream, dim, fb, *args):
             *args)
 
 class Output(object):
+    # Temporal outputs carry state from one frame to the next, and must have
+    # `encode` called on each frame, in order, from one thread. Non-temporal
+    # outputs encode each frame independently, and may be used from several
+    # threads at once (see `EncodePool`).
+    temporal = True
+
+    # If set, temporal outputs write each media segment directly to the file
+    # ``dest + suffix``, rather than to an anonymous temporary file. Set this
+    # before the first frame of each segment is encoded.
+    dest = None
+
     def convert(self, fb, gnm, dim, stream=None):
         """
         Convert a filtered buffer to whatever output format is needed by the
@@ -54,7 +67,8 @@ class Output(object):
 
         The return value is a 2-tuple `(media, logs)`. `media` is a dictionary
         mapping channel names (appropriate for use as file suffixes) to
-        file-like objects containing the encoded media segments. `logs` is a
+        file-like objects containing the encoded media segments, or, for
+        segments written to `dest`, to the path of the completed file. `logs` is a
         dictionary containing log entries. Either or both entries can be empty
         at any time (and will typically be either populated on each frame
         except the flush, for non-temporal codecs, or will be empty on all
@@ -65,18 +79,153 @@ class Output(object):
         """
         raise NotImplementedError()
 
+    def close(self):
+        """
+        Wait for any media segments still being finished in the background,
+        returning a list of `(media, logs)` tuples as from `encode`. Call
+        after the final flush.
+        """
+        return []
+
+    def held_frames(self):
+        """
+        Return the host frames this output's encoders still hold. Holding
+        them as well keeps them from being freed by another thread that
+        flushes the output (see `ParallelOutput`).
+        """
+        return []
+
+
+class _EncoderProcess(object):
+    """
+    An encoder subprocess, fed frames from a background thread through a
+    bounded queue, so that callers only block when the encoder falls more
+    than ``depth`` frames behind. The subprocess's stderr is collected
+    continuously by a second thread, so it can never fill and stall the
+    encoder.
+
+    Frames are written with the buffer protocol. They're usually allocated
+    from the renderer's page-locked memory pool, which isn't thread-safe, so
+    a reference to each frame is held until the feeder has written it and
+    dropped its own, and is then released on the caller's thread, during the
+    next call to `write` or `close`.
+    """
+    def __init__(self, name, args, stdout=None, depth=4):
+        self.name = name
+        self.subp = Popen(map(str, args), stdin=PIPE, stderr=PIPE,
+                          stdout=stdout)
+        self._queue = Queue.Queue(depth)
+        self._held = deque()
+        self._nwritten = self._nreleased = 0
+        self._log = []
+        self._error = None
+        self._feeder = threading.Thread(target=self._feed)
+        self._drainer = threading.Thread(target=self._drain)
+        for thread in (self._feeder, self._drainer):
+            thread.daemon = True
+            thread.start()
+
+    def _feed(self):
+        while True:
+            buf = self._queue.get()
+            if buf is None:
+                break
+            if self._error is None:
+                try:
+                    self.subp.stdin.write(buffer(buf))
+                except IOError, e:
+                    # Keep consuming the queue, so writers can't block
+                    self._error = e
+            del buf
+            self._nwritten += 1
+        try:
+            self.subp.stdin.close()
+        except IOError:
+            pass
+
+    def _drain(self):
+        for line in iter(self.subp.stderr.readline, ''):
+            self._log.append(line)
+
+    def _raise(self, msg):
+        raise IOError('%s %s. Log:\n%s' % (self.name, msg, ''.join(self._log)))
+
+    def held(self):
+        return list(self._held)
+
+    def _release(self):
+        while self._nreleased < self._nwritten:
+            self._held.popleft()
+            self._nreleased += 1
+
+    def write(self, buf):
+        """Queue a frame for writing, blocking if the queue is full."""
+        self._release()
+        if self._error is not None:
+            self._raise('failed while writing (%s)' % self._error)
+        self._held.append(buf)
+        self._queue.put(buf)
+
+    def close(self):
+        """
+        Finish writing all queued frames and wait for the encoder to exit,
+        returning its log. Raises IOError if the encoder failed.
+        """
+        self._queue.put(None)
+        self._feeder.join()
+        self._release()
+        self._drainer.join()
+        self.subp.wait()
+        if self.subp.returncode or self._error is not None:
+            self._raise('exited with an error')
+        return ''.join(self._log)
+
+def _open_segment(dest, suffix):
+    """
+    Open a file for an encoder to write a media segment to. If ``dest`` is
+    set, this is ``dest + suffix + '.tmp'``, which `_close_segment` renames
+    into place; otherwise, it's an anonymous temporary file.
+    """
+    if dest is None:
+        return tempfile.TemporaryFile(bufsize=0)
+    return open(dest + suffix + '.tmp', 'w+b', 0)
+
+def _close_segment(fp, dest, suffix):
+    """
+    Finish a segment opened by `_open_segment`, returning the value to use
+    in the media dictionary.
+    """
+    if dest is None:
+        fp.seek(0)
+        return fp
+    fp.close()
+    os.rename(dest + suffix + '.tmp', dest + suffix)
+    return dest + suffix
 
 class PILOutput(Output, ClsMod):
     lib = pixfmtlib
+    temporal = False
 
-    def __init__(self, codec='jpeg', quality=100, alpha=False):
-        import scipy.misc
-        if not hasattr(scipy.misc, 'toimage'):
-            raise ImportError("Could not find scipy.misc.toimage. "
-                              "Are scipy and PIL installed?")
+    def __init__(self, codec='jpeg', quality=100, alpha=False,
+                 compress_level=1, optimize=False, subsampling=None,
+                 progressive=False):
+        """
+        ``quality``, ``subsampling`` (as 0, 1 or 2 for 4:4:4, 4:2:2 and
+        4:2:0, or None for the encoder default) and ``progressive`` apply to
+        JPEG; ``compress_level`` (0-9) applies to PNG. ``optimize`` enables
+        the extra encoder pass of either format.
+        """
+        from PIL import Image
 
         super(PILOutput, self).__init__()
         self.type, self.quality, self.alpha = codec, quality, alpha
+        if codec == 'jpeg':
+            self.opts = dict(quality=quality, optimize=optimize,
+                             progressive=progressive)
+            if subsampling is not None:
+                self.opts['subsampling'] = subsampling
+        else:
+            self.opts = dict(compress_level=compress_level, optimize=optimize)
 
     def convert(self, fb, gnm, dim, stream=None):
         launchC('f32_to_rgba_u8', self.mod, stream, dim, fb,
@@ -87,26 +236,198 @@ class PILOutput(Output, ClsMod):
         cuda.memcpy_dtoh_async(h_out, fb.d_back, stream)
         return h_out
 
-    def _convert_buf(self, buf):
-        import scipy.misc
+    def _save(self, img):
         out = StringIO()
-        img = scipy.misc.toimage(buf, cmin=0, cmax=1)
-        img.save(out, self.type, quality=self.quality, compress_level=1)
+        img.save(out, self.type, **self.opts)
         out.seek(0)
         return out
 
     def encode(self, buf):
+        from PIL import Image
         if buf is None: return {}, []
+        # The kernel output is already dithered RGBA8, so the host buffer can
+        # be wrapped without copying or rescaling.
+        h, w = buf.shape[:2]
+        img = Image.frombuffer('RGBA', (w, h), buf, 'raw', 'RGBA', 0, 1)
         if self.type == 'jpeg':
-            out = self._convert_buf(buf[:,:,:3])
+            out = self._save(img.convert('RGB'))
             if self.alpha:
-                alpha = self._convert_buf(buf[:,:,3])
+                alpha = self._save(img.split()[3])
                 return {'_color.jpg': out, '_alpha.jpg': alpha}, []
-            return {'.jpg': out}, {}
-        return {'.'+self.type: self._convert_buf(buf)}, []
+            return {'.jpg': out}, []
+        return {'.'+self.type: self._save(img)}, []
+
+def _png_filter(rows, bpp, ftype):
+    """
+    Apply PNG filter `ftype` (0-4) to each of `rows`, a 2D array of unsigned
+    bytes, where each pixel is `bpp` bytes wide. Byte arithmetic wraps, as
+    the filters require.
+    """
+    if ftype == 0:
+        return rows
+    a = np.zeros_like(rows)
+    a[:,bpp:] = rows[:,:-bpp]
+    if ftype == 1:
+        return rows - a
+    b = np.zeros_like(rows)
+    b[1:] = rows[:-1]
+    if ftype == 2:
+        return rows - b
+    elif ftype == 3:
+        return rows - ((a >> 1) + (b >> 1) + (a & b & 1))
+    c = np.zeros_like(rows)
+    c[1:,bpp:] = rows[:-1,:-bpp]
+    a, b, c = a.astype('i2'), b.astype('i2'), c.astype('i2')
+    p = a + b - c
+    pa, pb, pc = np.abs(p - a), np.abs(p - b), np.abs(p - c)
+    pred = np.where((pa <= pb) & (pa <= pc), a, np.where(pb <= pc, b, c))
+    return (rows - pred).astype('u1')
+
+def _png_chunk(kind, data):
+    return ''.join([struct.pack('>I', len(data)), kind, data,
+                    struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)])
+
+# Deflate pools, by size, shared by every PNGOutput. Outputs are encoded
+# from several `EncodePool` threads at once, and a pool per output (or per
+# encoding thread) would multiply the thread count.
+_deflate_pools = {}
+_deflate_pools_lock = threading.Lock()
+
+def _default_threads():
+    """
+    One per CPU, or one if gevent has patched `threading` (as in the
+    workers of distribute.py), since green threads never run in parallel.
+    """
+    monkey = sys.modules.get('gevent.monkey')
+    if monkey is not None and monkey.is_module_patched('threading'):
+        return 1
+    return multiprocessing.cpu_count()
+
+def _get_deflate_pool(threads):
+    with _deflate_pools_lock:
+        if threads not in _deflate_pools:
+            _deflate_pools[threads] = ThreadPool(threads)
+        return _deflate_pools[threads]
+
+class PNGOutput(Output, ClsMod):
+    """
+    Writes 8- or 16-bit PNG images. Scanlines are filtered with numpy, and
+    split into bands of rows which are deflated in parallel; since each
+    band but the last ends on a sync flush, the compressed bands can simply
+    be concatenated into one zlib stream.
+    """
+    lib = pixfmtlib
+    temporal = False
+
+    filters = dict(none=0, sub=1, up=2, avg=3, paeth=4, adaptive=None)
+
+    def __init__(self, depth=8, level=1, filter='up', threads=None,
+                 alpha=True, band_rows=64, compress_level=None,
+                 quality=None):
+        """
+        ``level`` is the zlib compression level, and ``filter`` is the name
+        of a PNG filter type to use on every row, or 'adaptive' to choose
+        one per row by the minimum sum of absolute differences. ``threads``
+        sets the size of the pool deflating bands, which is shared by all
+        PNG outputs (default: one thread per CPU, or none under gevent; see
+        `_default_threads`). Images are RGBA unless
+        ``alpha`` is False, as they always were when written by `PILOutput`.
+
+        ``compress_level`` is accepted as a synonym for ``level``, and
+        ``quality`` is ignored, as they were when PNGs were written by
+        `PILOutput`.
+        """
+        super(PNGOutput, self).__init__()
+        if depth not in (8, 16):
+            raise ValueError('Invalid PNG depth: %s' % depth)
+        if filter not in self.filters:
+            raise ValueError('Invalid PNG filter: %s' % filter)
+        if compress_level is not None:
+            level = compress_level
+        self.depth, self.level, self.filter = depth, level, filter
+        self.alpha, self.band_rows = alpha, band_rows
+        self.threads = threads or _default_threads()
+        self._pool = None
+        if self.threads > 1:
+            self._pool = _get_deflate_pool(self.threads)
+
+    def convert(self, fb, gnm, dim, stream=None):
+        kern = 'f32_to_rgba_u8' if self.depth == 8 else 'f32_to_rgba_u16'
+        launchC(kern, self.mod, stream, dim, fb, fb.d_rb, fb.d_seeds)
+
+    def copy(self, fb, dim, pool, stream=None):
+        fmt = 'u1' if self.depth == 8 else 'u2'
+        h_out = pool.allocate((dim.h, dim.w, 4), fmt)
+        cuda.memcpy_dtoh_async(h_out, fb.d_back, stream)
+        return h_out
+
+    def _filter(self, buf):
+        h, w, nch = buf.shape
+        bpp = nch * self.depth / 8
+        rows = buf.astype('>u%d' % (self.depth / 8)).view('u1')
+        rows = rows.reshape(h, w * bpp)
+        out = np.empty((h, w * bpp + 1), 'u1')
+        ftype = self.filters[self.filter]
+        if ftype is not None:
+            out[:,0] = ftype
+            out[:,1:] = _png_filter(rows, bpp, ftype)
+            return out
+        cands = [_png_filter(rows, bpp, f) for f in range(5)]
+        # Sum of absolute values of the bytes taken as signed, per the
+        # heuristic suggested by the PNG spec
+        costs = []
+        for cand in cands:
+            cand = cand.astype('i2')
+            costs.append(np.minimum(cand, 256 - cand).sum(axis=1))
+        best = np.argmin(costs, axis=0)
+        out[:,0] = best
+        out[:,1:] = np.choose(best[:,None], cands)
+        return out
+
+    def _deflate(self, (data, last)):
+        comp = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return comp.compress(data) + comp.flush(
+                zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+    def encode(self, buf):
+        if buf is None: return {}, []
+        if not self.alpha:
+            buf = buf[:,:,:3]
+        h, w, nch = buf.shape
+        rows = self._filter(buf)
+
+        bands = [(rows[i:i+self.band_rows].tostring(),
+                  i + self.band_rows >= h)
+                 for i in range(0, h, self.band_rows)]
+        if self._pool is not None:
+            chunks = self._pool.map(self._deflate, bands)
+        else:
+            chunks = map(self._deflate, bands)
+        adler = 1
+        for data, last in bands:
+            adler = zlib.adler32(data, adler)
+
+        # Build the zlib header by hand, to match the raw deflate streams
+        flevel = 0 if self.level < 2 else 1 if self.level < 6 else (
+                 2 if self.level == 6 else 3)
+        cmf, flg = 0x78, flevel << 6
+        flg += 31 - (cmf * 256 + flg) % 31
+        chunks.insert(0, chr(cmf) + chr(flg))
+        chunks.append(struct.pack('>I', adler & 0xffffffff))
+
+        out = StringIO()
+        out.write('\x89PNG\r\n\x1a\n')
+        out.write(_png_chunk('IHDR', struct.pack('>IIBBBBB', w, h, self.depth,
+                                                 6 if self.alpha else 2,
+                                                 0, 0, 0)))
+        out.write(_png_chunk('IDAT', ''.join(chunks)))
+        out.write(_png_chunk('IEND', ''))
+        out.seek(0)
+        return {'.png': out}, []
 
 class TiffOutput(Output, ClsMod):
     lib = pixfmtlib
+    temporal = False
 
     def __init__(self, alpha=False):
         import tifffile
@@ -135,6 +456,38 @@ class TiffOutput(Output, ClsMod):
         out.seek(0)
         return {'.tiff': out}, []
 
+class EXROutput(Output, ClsMod):
+    """
+    Writes the filtered buffer as half-float OpenEXR images, without
+    clamping or dithering, for compositing and grading.
+    """
+    lib = pixfmtlib
+    temporal = False
+
+    def __init__(self, alpha=True, compression='zip', level=6):
+        super(EXROutput, self).__init__()
+        if compression not in exr.COMPRESSION:
+            raise ValueError('Invalid EXR compression: ' + compression)
+        self.alpha, self.compression, self.level = alpha, compression, level
+
+    def convert(self, fb, gnm, dim, stream=None):
+        launchC('f32_to_rgba_f16', self.mod, stream, dim, fb)
+
+    def copy(self, fb, dim, pool, stream=None):
+        h_out = pool.allocate((dim.h, dim.w, 4), 'f2')
+        cuda.memcpy_dtoh_async(h_out, fb.d_back, stream)
+        return h_out
+
+    def encode(self, buf):
+        if buf is None: return {}, []
+        if not self.alpha:
+            buf = buf[:,:,:3]
+        out = StringIO()
+        exr.write(out, buf, 'RGBA'[:buf.shape[2]], self.compression,
+                  self.level)
+        out.seek(0)
+        return {'.exr': out}, []
+
 
 class ProResOutput(Output, ClsMod):
     lib = pixfmtlib
@@ -157,20 +510,25 @@ class ProResOutput(Output, ClsMod):
         return h_out
 
     def _spawn(self):
-        self._outf = tempfile.NamedTemporaryFile(bufsize=0, suffix='mov')
+        self._dest = self.dest
+        if self._dest is None:
+            self._outf = tempfile.NamedTemporaryFile(bufsize=0, suffix='mov')
+            fn = self._outf.name
+        else:
+            fn = self._dest + '.mov.tmp'
         cmd = ('ffmpeg -loglevel panic -f rawvideo -pix_fmt yuv444p12le '
                '-s {w}x{h} -r {fps} -i - -c:v prores -f mov -y {fn}').format(
-                       w=self._dim.w, h=self._dim.h, fps=self.fps,
-                       fn=self._outf.name)
-        self._subp = Popen(cmd.split(), stdin=PIPE)
+                       w=self._dim.w, h=self._dim.h, fps=self.fps, fn=fn)
+        self._subp = _EncoderProcess('ffmpeg', cmd.split())
 
     def _flush(self):
         if not self._subp:
             return {}, []
-        self._subp.stdin.close()
-        self._subp.wait()
-        if self._subp.returncode:
-            raise IOError("ffmpeg exited with an error")
+        self._subp.close()
+        if self._dest is not None:
+            os.rename(self._dest + '.mov.tmp', self._dest + '.mov')
+            self._subp = None
+            return {'.mov': self._dest + '.mov'}, []
         # get a new handle, delete the named file
         outf = open(self._outf.name)
         self._outf.close()
@@ -182,9 +540,12 @@ class ProResOutput(Output, ClsMod):
             return self._flush()
         if not self._subp:
             self._spawn()
-        self._subp.stdin.write(buffer(host_frame))
+        self._subp.write(host_frame)
         return {}, []
 
+    def held_frames(self):
+        return self._subp.held() if self._subp else []
+
 
 class X264Output(Output, ClsMod):
     lib = pixfmtlib
@@ -204,94 +565,86 @@ class X264Output(Output, ClsMod):
         self.alpha = alpha
         self.csp = csp
         self.framesize = None
-        self.zeros = None
         self.subp = None
         self.outf = None
         self.asubp = None
         self.aoutf = None
 
     def convert(self, fb, gnm, dim, stream=None):
-        launchC('f32_to_rgba_u16', self.mod, stream, dim, fb,
-                fb.d_rb, fb.d_seeds)
+        launchC('f32_to_rgb48', self.mod, stream, dim, fb,
+                fb.d_rb, fb.d_seeds, i32(self.alpha))
 
     def copy(self, fb, dim, pool, stream=None):
-        h_out = pool.allocate((dim.h, dim.w, 4), 'u2')
+        """
+        Returns the packed RGB48 frame, or if alpha is enabled, a tuple of
+        that and the YV12 frame holding the alpha channel. Each can be written
+        to its encoder as-is.
+        """
+        h_out = pool.allocate((dim.h, dim.w, 3), 'u2')
         cuda.memcpy_dtoh_async(h_out, fb.d_back, stream)
-        return h_out
+        if not self.alpha:
+            return h_out
+        h_alpha = pool.allocate((dim.h * 3 / 2, dim.w), 'u2')
+        cuda.memcpy_dtoh_async(h_alpha, int(fb.d_back) + h_out.nbytes, stream)
+        return h_out, h_alpha
+
+    def _suffix(self, alpha):
+        if not self.alpha:
+            return '.h264'
+        return '_alpha.h264' if alpha else '_color.h264'
 
     def _spawn_sub(self, framesize, alpha):
         res = '%dx%d' % (framesize[1], framesize[0])
         csp = 'yv12' if alpha else 'rgb'
         extras = ['--input-csp', csp, '--demuxer', 'raw', '--input-res', res]
-        outf = tempfile.TemporaryFile(bufsize=0)
+        outf = _open_segment(self._dest, self._suffix(alpha))
         if alpha:
             extras += ['--output-csp', 'i420', '--chroma-qp-offset', '24']
         else:
             extras += ['--output-csp', self.csp]
-        subp = Popen(self.args + extras, stdin=PIPE, stderr=PIPE, stdout=outf)
+        subp = _EncoderProcess('x264', self.args + extras, outf)
         return outf, subp
 
     def _spawn(self, framesize):
         self.framesize = framesize
+        self._dest = self.dest
         self.outf, self.subp = self._spawn_sub(framesize, False)
         if self.alpha:
             self.aoutf, self.asubp = self._spawn_sub(framesize, True)
-            bufsz = framesize[0] * framesize[1] / 2
-            self.zeros = np.empty(bufsz, dtype='u2')
-            self.zeros.fill(32767)
-
-    def _flush_sub(self, subp):
-        if gevent is not None:
-            # Use non-blocking poll to allow applications to continue
-            # rendering in other coros
-            subp.stdin.close()
-            log = ''
-            while subp.poll() is None:
-                log += subp.stderr.read()
-                gevent.sleep(0.1)
-            log += subp.stderr.read()
-        else:
-            (stdout, log) = subp.communicate()
-        if subp.returncode:
-            raise IOError("x264 exited with an error")
-        return log
 
     def _flush(self):
         if self.subp is None:
             return {}, []
-        log = self._flush_sub(self.subp)
-        self.outf.seek(0)
-        self.subp = None
+        log = self.subp.close()
+        outf = _close_segment(self.outf, self._dest, self._suffix(False))
+        self.subp = self.outf = None
         if self.alpha:
-            alog = self._flush_sub(self.asubp)
-            self.aoutf.seek(0)
-            self.asubp = None
-            return ({'_color.h264': self.outf, '_alpha.h264': self.aoutf},
+            alog = self.asubp.close()
+            aoutf = _close_segment(self.aoutf, self._dest, self._suffix(True))
+            self.asubp = self.aoutf = None
+            return ({'_color.h264': outf, '_alpha.h264': aoutf},
                     [('x264_color', log), ('x264_alpha', alog)])
-        return {'.h264': self.outf}, [('x264_color', log)]
-
-    def _write(self, buf, subp):
-        try:
-            subp.stdin.write(buffer(buf))
-        except IOError, e:
-            print >> sys.stderr, 'Exception while writing. Log:'
-            print >> sys.stderr, subp.stderr.read()
-            raise e
+        return {'.h264': outf}, [('x264_color', log)]
 
     def encode(self, buf):
         out = ({}, [])
+        abuf = None
+        if self.alpha and buf is not None:
+            buf, abuf = buf
         if buf is None or self.framesize != buf.shape[:2]:
             out = self._flush()
         if buf is None:
             return out
         if self.subp is None:
             self._spawn(buf.shape[:2])
-        self._write(np.delete(buf, 3, axis=2), self.subp)
-        if self.alpha:
-            self._write(buf[:,:,3].tostring(), self.asubp)
-            self._write(buffer(self.zeros), self.asubp)
+        self.subp.write(buf)
+        if abuf is not None:
+            self.asubp.write(abuf)
         return out
 
+    def held_frames(self):
+        return [f for p in (self.subp, self.asubp) if p for f in p.held()]
+
 class VPxOutput(Output, ClsMod):
     lib = pixfmtlib
 
@@ -309,7 +662,7 @@ class VPxOutput(Output, ClsMod):
 
         self.args = self.base.split()
         if pix_fmt == 'yuv420p':
-            self.out_filter = 'f32_to_yuv444p'
+            self.out_filter = 'f32_to_yuv420p'
         else:
             assert codec == 'vp9'
             if pix_fmt == 'yuv444p':
@@ -345,7 +698,7 @@ class VPxOutput(Output, ClsMod):
         if self.pix_fmt in ('yuv444p10', 'yuv420p10', 'yuv444p12'):
             fmt = 'u2'
         dims =  (3, dim.h, dim.w)
-        if self.pix_fmt == 'yuv420p10':
+        if self.pix_fmt in ('yuv420p', 'yuv420p10'):
             dims = (dim.h * dim.w * 6 / 4,)
         h_out = pool.allocate(dims, fmt)
         cuda.memcpy_dtoh_async(h_out, fb.d_back, stream)
@@ -357,41 +710,17 @@ class VPxOutput(Output, ClsMod):
         if num_columns:
             extras.append('--tile-columns=%d' % num_columns)
 
-        self.outf = tempfile.TemporaryFile(bufsize=0)
-        self.subp = Popen(map(str, self.args + extras),
-                          stdin=PIPE, stderr=PIPE, stdout=self.outf)
-
-    def _flush_sub(self, subp):
-        if gevent is not None:
-            # Use non-blocking poll to allow applications to continue
-            # rendering in other coros
-            subp.stdin.close()
-            log = ''
-            while subp.poll() is None:
-                log += subp.stderr.read()
-                gevent.sleep(0.1)
-            log += subp.stderr.read()
-        else:
-            (stdout, log) = subp.communicate()
-        if subp.returncode:
-            raise IOError("vpxenc exited with an error")
-        return log
+        self._dest = self.dest
+        self.outf = _open_segment(self._dest, '.webm')
+        self.subp = _EncoderProcess('vpxenc', self.args + extras, self.outf)
 
     def _flush(self):
         if self.subp is None:
             return {}, []
-        log = self._flush_sub(self.subp)
-        self.outf.seek(0)
-        self.subp = None
-        return {'.webm': self.outf}, [('webm', log)]
-
-    def _write(self, buf, subp):
-        try:
-            subp.stdin.write(buffer(buf))
-        except IOError, e:
-            print >> sys.stderr, 'Exception while writing. Log:'
-            print >> sys.stderr, subp.stderr.read()
-            raise e
+        log = self.subp.close()
+        outf = _close_segment(self.outf, self._dest, '.webm')
+        self.subp = self.outf = None
+        return {'.webm': outf}, [('webm', log)]
 
     def encode(self, buf):
         out = ({}, [])
@@ -399,36 +728,399 @@ class VPxOutput(Output, ClsMod):
             return self._flush()
         if self.subp is None:
             self._spawn()
-        if self.pix_fmt == 'yuv420p':
-            # Perform terrible chroma subsampling
-            self._write(buf[0].tostring(), self.subp)
-            self._write(buf[1,::2,::2].tostring(), self.subp)
-            self._write(buf[2,::2,::2].tostring(), self.subp)
-        else:
-            self._write(buf, self.subp)
+        self.subp.write(buf)
         return out
 
+    def held_frames(self):
+        return self.subp.held() if self.subp else []
+
+class Y4MOutput(Output, ClsMod):
+    """
+    Writes uncompressed YUV4MPEG2 video, for other tools to consume as
+    frames are rendered.
+
+    If ``path`` is given, every frame is written to one stream at that path,
+    which may be a named pipe, or '-' for stdout; flushing a segment only
+    flushes the stream. Otherwise, each segment is written to its own
+    '.y4m' file.
+    """
+    lib = pixfmtlib
+
+    # pix_fmt: (kernel, host dtype, chroma is subsampled, colorspace, range)
+    formats = {
+        'yuv420p': ('f32_to_yuv420p', 'u1', True, '420jpeg', 'FULL'),
+        'yuv444p': ('f32_to_yuv444p', 'u1', False, '444', 'FULL'),
+        'yuv420p10': ('f32_to_yuv420p10', 'u2', True, '420p10', 'FULL'),
+        'yuv444p10': ('f32_to_yuv444p10', 'u2', False, '444p10', 'FULL'),
+        'yuv444p12': ('f32_to_yuv444p12', 'u2', False, '444p12', 'LIMITED'),
+    }
+
+    def __init__(self, fps=24, pix_fmt='yuv420p', path=None):
+        super(Y4MOutput, self).__init__()
+        if pix_fmt not in self.formats:
+            raise ValueError('Invalid pix_fmt: ' + pix_fmt)
+        self.fps, self.pix_fmt, self.path = fps, pix_fmt, path
+        self.dim = None
+        self.outf = None
+
+    def convert(self, fb, gnm, dim, stream=None):
+        self.dim = dim
+        launchC(self.formats[self.pix_fmt][0], self.mod, stream, dim, fb,
+                fb.d_rb, fb.d_seeds)
+
+    def copy(self, fb, dim, pool, stream=None):
+        kern, fmt, sub, csp, rng = self.formats[self.pix_fmt]
+        dims = (dim.h * dim.w * 6 / 4,) if sub else (3, dim.h, dim.w)
+        h_out = pool.allocate(dims, fmt)
+        cuda.memcpy_dtoh_async(h_out, fb.d_back, stream)
+        return h_out
+
+    def header(self):
+        kern, fmt, sub, csp, rng = self.formats[self.pix_fmt]
+        return 'YUV4MPEG2 W%d H%d F%d:1 Ip A1:1 C%s XCOLORRANGE=%s\n' % (
+                self.dim.w, self.dim.h, self.fps, csp, rng)
+
+    def _spawn(self):
+        if self.path == '-':
+            self.outf = sys.stdout
+        elif self.path is not None:
+            self.outf = open(self.path, 'wb')
+        else:
+            self._dest = self.dest
+            self.outf = _open_segment(self._dest, '.y4m')
+        self.outf.write(self.header())
+
+    def _flush(self):
+        if self.outf is None:
+            return {}, []
+        if self.path is not None:
+            self.outf.flush()
+            return {}, []
+        outf = _close_segment(self.outf, self._dest, '.y4m')
+        self.outf = None
+        return {'.y4m': outf}, []
+
+    def encode(self, buf):
+        if buf is None:
+            return self._flush()
+        if self.outf is None:
+            self._spawn()
+        self.outf.write('FRAME\n')
+        self.outf.write(buffer(buf))
+        return {}, []
+
+    def close(self):
+        if self.outf not in (None, sys.stdout):
+            self.outf.close()
+        self.outf = None
+        return []
+
+def _area_resize_axis(img, m, axis):
+    n = img.shape[axis]
+    if n == m:
+        return img
+    if n % m == 0:
+        shape = img.shape[:axis] + (m, n / m) + img.shape[axis+1:]
+        return img.reshape(shape).mean(axis=axis+1, dtype=f32)
+    # Integrate along the axis, and difference the integral at the (possibly
+    # fractional) boundaries of each output pixel
+    cs = np.cumsum(img, axis=axis, dtype=np.float64)
+    cs = np.concatenate([np.zeros_like(cs.take([0], axis)), cs], axis)
+    edges = np.arange(m + 1) * (float(n) / m)
+    idx = np.minimum(edges.astype(int), n - 1)
+    shape = [1] * img.ndim
+    shape[axis] = m + 1
+    frac = (edges - idx).reshape(shape)
+    at = cs.take(idx, axis) + frac * img.take(idx, axis)
+    return (np.diff(at, axis=axis) * (float(m) / n)).astype(f32)
+
+def area_resize(img, h, w):
+    """
+    Resize `img`, of shape `(height, width, channels)`, to `(h, w)` by
+    averaging over the area covered by each output pixel. Returns float32.
+    """
+    return _area_resize_axis(_area_resize_axis(img, h, 0), w, 1)
+
+class ProxyOutput(Output):
+    """
+    Encodes a downsampled copy of each frame, taken from the host buffer of
+    another output, `source`, so that proxies need no separate download or
+    decode. Only outputs whose host buffers are interleaved RGB or RGBA
+    (JPEG, PNG, TIFF and x264) can be used as sources.
+
+    Proxies of still images are encoded as still images by `PILOutput`.
+    Proxies of x264 video are themselves temporal, and encoded by an
+    `X264Output` into a segment for each of the source's segments. Media
+    suffixes are prefixed with the proxy height, as in '_540p.jpg'.
+    """
+    sources = (PILOutput, PNGOutput, TiffOutput, X264Output)
+
+    def __init__(self, source, scale=0.5, type=None, fps=24, **opts):
+        source = getattr(source, 'current', source)
+        if not isinstance(source, self.sources):
+            raise ValueError('Proxies are not supported for %s' %
+                             source.__class__.__name__)
+        self.scale = scale
+        self.temporal = source.temporal
+        self._h = None
+        if not self.temporal:
+            self.out = PILOutput(codec=type or 'jpeg', **opts)
+        elif type in (None, 'x264'):
+            self.out = X264Output(fps=fps, **opts)
+        else:
+            raise ValueError('Proxies of video must be x264, not %s' % type)
+
+    def _rename(self, (out, logs)):
+        return dict(('_%dp%s' % (self._h, k), v) for k, v in out.items()), logs
+
+    def encode(self, buf):
+        if buf is None:
+            if not self.temporal:
+                return {}, []
+            return self._rename(self.out.encode(None))
+        if isinstance(buf, tuple):
+            buf = buf[0]
+        h, w = [max(1, int(round(d * self.scale))) for d in buf.shape[:2]]
+        img = area_resize(buf, h, w)
+        self._h = h
+        if self.temporal:
+            # Packed 16-bit RGB, like the source's own frames
+            self.out.dest = self.dest and '%s_%dp' % (self.dest, h)
+            return self._rename(self.out.encode(
+                    np.around(img).astype(np.uint16)))
+        if buf.dtype == np.uint16:
+            img *= 1 / 257.
+        rgba = np.empty((h, w, 4), np.uint8)
+        rgba[:,:,:3] = np.around(img[:,:,:3])
+        rgba[:,:,3] = np.around(img[:,:,3]) if img.shape[2] == 4 else 255
+        return self._rename(self.out.encode(rgba))
+
+    def close(self):
+        return map(self._rename, self.out.close())
+
+def _nbytes(obj):
+    if isinstance(obj, (tuple, list)):
+        return sum(map(_nbytes, obj))
+    return getattr(obj, 'nbytes', 0)
+
+class _Task(object):
+    def __init__(self, fn, args):
+        self.fn, self.args = fn, args
+        self.nbytes = _nbytes(args)
+        self.done = threading.Event()
+        self.value = self.exc_info = None
+
+    def run(self):
+        try:
+            self.value = self.fn(*self.args)
+        except:
+            self.exc_info = sys.exc_info()
+        self.done.set()
+
+    def result(self):
+        self.done.wait()
+        # Drop references to the arguments (typically page-locked host
+        # buffers) only now, so they're returned to their pool by the thread
+        # that allocated them.
+        self.fn = self.args = None
+        if self.exc_info:
+            raise self.exc_info[0], self.exc_info[1], self.exc_info[2]
+        return self.value
+
+class EncodePool(object):
+    """
+    Run encoding tasks (normally calls to `encode` on a non-temporal output)
+    on a pool of threads, so that encoding overlaps rendering.
+
+    Results are returned in the order tasks were submitted. At most ``depth``
+    tasks may be outstanding, holding arrays (typically page-locked host
+    buffers) totalling no more than ``max_bytes`` unless there's only one;
+    past either limit, `submit` blocks until the oldest task completes, so
+    that host buffers are not allocated faster than they can be encoded.
+    An array passed to several tasks is counted once for each.
+
+    The threads only run in parallel where `threading` isn't patched by
+    gevent, as it is in distribute.py; there, ``threads`` defaults to one.
+    """
+    def __init__(self, threads=None, depth=None, max_bytes=512 << 20):
+        threads = threads or _default_threads()
+        self.depth = depth or 2 * threads
+        self.max_bytes = max_bytes
+        self._queue = Queue.Queue()
+        self._pending = deque()
+        self._bytes = 0
+        self._threads = [threading.Thread(target=self._work)
+                         for i in range(threads)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+            if task is None:
+                return
+            task.run()
+
+    def submit(self, fn, *args):
+        """
+        Queue `fn(*args)` to be run on the pool. Returns a list containing
+        the results of all tasks that have completed since the last call, in
+        submission order. Exceptions raised by tasks are re-raised here.
+        """
+        task = _Task(fn, args)
+        self._pending.append(task)
+        self._bytes += task.nbytes
+        self._queue.put(task)
+        done = []
+        while (len(self._pending) > self.depth or
+               len(self._pending) > 1 and self._bytes > self.max_bytes):
+            done.append(self._pop())
+        return done + self.poll()
+
+    def _pop(self):
+        task = self._pending.popleft()
+        self._bytes -= task.nbytes
+        return task.result()
+
+    def poll(self):
+        """
+        Return the results of tasks that have completed, in submission
+        order, without waiting for any others.
+        """
+        done = []
+        while self._pending and self._pending[0].done.is_set():
+            done.append(self._pop())
+        return done
+
+    def drain(self):
+        """Wait for all outstanding tasks, returning their results."""
+        done = []
+        while self._pending:
+            done.append(self._pop())
+        return done
+
+    def close(self):
+        """Drain the pool and stop its threads, returning any results."""
+        try:
+            return self.drain()
+        finally:
+            for thread in self._threads:
+                self._queue.put(None)
+            for thread in self._threads:
+                thread.join()
+
+def _finish_segment(out, held):
+    return out.encode(None)
+
+class ParallelOutput(Output):
+    """
+    Runs up to ``parallel`` instances of a temporal output at once. Frames
+    are encoded by the current instance; when it's flushed, it finishes its
+    segment on a background thread while a fresh instance (from ``factory``)
+    takes the next segment's frames. This lets several encoder processes
+    run at once when rendering sharded animations.
+
+    Finished segments are returned from `encode` in the order they were
+    flushed, one per call, rather than from the flush itself, so `close`
+    must be called after the final flush. Set `dest` for each segment, since
+    a segment is generally returned while a later one is being encoded.
+
+    The frames a flushed instance still holds are also held by its pool
+    task until the segment is collected, so that they're freed on the
+    caller's thread rather than the one that finished the segment.
+    """
+    def __init__(self, factory, parallel=2):
+        self.factory = factory
+        self.current = factory()
+        self._pool = EncodePool(parallel - 1, parallel - 1)
+        self._done = deque()
+
+    @property
+    def dest(self):
+        return self.current.dest
+
+    @dest.setter
+    def dest(self, dest):
+        self.current.dest = dest
+
+    def convert(self, fb, gnm, dim, stream=None):
+        self.current.convert(fb, gnm, dim, stream)
+
+    def copy(self, fb, dim, pool, stream=None):
+        return self.current.copy(fb, dim, pool, stream)
+
+    def held_frames(self):
+        return self.current.held_frames()
+
+    def encode(self, buf):
+        if buf is None:
+            out, self.current = self.current, self.factory()
+            self._done.extend(self._pool.submit(_finish_segment, out,
+                                                out.held_frames()))
+        else:
+            media, logs = self.current.encode(buf)
+            if media or logs:
+                self._done.append((media, logs))
+            self._done.extend(self._pool.poll())
+        if self._done:
+            return self._done.popleft()
+        return {}, []
+
+    def close(self):
+        self._done.extend(self._pool.close())
+        self._done.extend(self.current.close())
+        done, self._done = list(self._done), deque()
+        return done
+
 def get_suffix_for_profile(gprof):
   opts = dict(gprof.output._val)
   ext = dict(jpeg='.jpg', png='.png', tiff='.tiff', x264='.h264',
-             prores='.mov', vp8='.webm', vp9='.webm')[opts.get('type', 'jpeg')]
-  if opts.get('alpha'):
+             prores='.mov', vp8='.webm', vp9='.webm',
+             y4m='.y4m', exr='.exr')[opts.get('type', 'jpeg')]
+  # Only these write alpha to a separate file
+  if opts.get('alpha') and opts.get('type', 'jpeg') in ('jpeg', 'x264'):
     ext = '_color' + ext
   return ext
 
 def get_output_for_profile(gprof):
     opts = dict(gprof.output._val)
     handler = opts.pop('type', 'jpeg')
-    if handler in ('jpeg', 'png'):
+    parallel = opts.pop('parallel', 1)
+    opts.pop('proxies', None)
+    make = lambda: _get_output(handler, gprof.fps, opts)
+    out = make()
+    if out.temporal and parallel > 1:
+        return ParallelOutput(make, parallel)
+    return out
+
+def get_proxies_for_profile(gprof, source):
+    """
+    Return a list of `ProxyOutput` instances for the proxies declared by
+    the profile, as a list of dicts in the 'proxies' key of its output
+    options, each holding a 'scale' and the type and options of a still
+    image output, or for x264 video, of an x264 output.
+    """
+    return [ProxyOutput(source, fps=gprof.fps, **dict(p))
+            for p in gprof.output._val.get('proxies', [])]
+
+def _get_output(handler, fps, opts):
+    if handler == 'jpeg':
         return PILOutput(codec=handler, **opts)
+    elif handler == 'png':
+        return PNGOutput(**opts)
     elif handler == 'tiff':
         return TiffOutput(**opts)
+    elif handler == 'exr':
+        return EXROutput(**opts)
     elif handler == 'x264':
-        return X264Output(fps=gprof.fps, **opts)
+        return X264Output(fps=fps, **opts)
     elif handler == 'vp8':
-        return VPxOutput(codec='vp8', fps=gprof.fps, **opts)
+        return VPxOutput(codec='vp8', fps=fps, **opts)
     elif handler == 'vp9':
-        return VPxOutput(codec='vp9', fps=gprof.fps, **opts)
+        return VPxOutput(codec='vp9', fps=fps, **opts)
     elif handler == 'prores':
-        return ProResOutput(fps=gprof.fps, **opts)
+        return ProResOutput(fps=fps, **opts)
+    elif handler == 'y4m':
+        return Y4MOutput(fps=fps, **opts)
     raise ValueError('Invalid output type "%s".' % handler)
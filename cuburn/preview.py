@@ -0,0 +1,140 @@
+"""
+A memory-mapped ring of recently rendered frames, for live previews.
+
+The file holds a header followed by ``depth`` slots, each large enough for
+one frame:
+
+    header: magic (8s), depth (u4), pad (u4), slot size (u8), count (u8)
+    slot:   seq (u8), frame index (i8), ndim (u4), shape (4 x u4),
+            dtype (8s, as numpy's ``dtype.str``), nbytes (u8), padding to
+            64 bytes, then the frame data
+
+All fields are little-endian. The writer fills slots in turn. Each slot's
+``seq`` is a sequence lock: it's odd while the slot is being written, and
+is bumped to the next even value when the write is done. ``count`` is the
+number of frames written, and is updated after each write, so the newest
+frame is in slot ``(count - 1) % depth``. Readers copy a slot and retry if
+its ``seq`` was odd or changed meanwhile, so they never see torn frames and
+never block the writer.
+
+If the frame size grows, the writer replaces the file, keeping the count,
+and readers reopen it when they notice.
+"""
+
+import os
+import mmap
+import time
+import struct
+from collections import namedtuple
+
+import numpy as np
+
+MAGIC = 'CUBPREV1'
+HEADER = struct.Struct('<8sIIQQ')
+SLOT = struct.Struct('<QqI4I8sQ')
+SLOT_HEADER_SIZE = 64
+COUNT_OFFSET = 24
+
+Frame = namedtuple('Frame', 'count index data')
+
+class PreviewWriter(object):
+    """
+    Writes frames to the ring at ``path``, creating it on the first write.
+    """
+    def __init__(self, path, depth=3):
+        self.path, self.depth = path, depth
+        self.count = 0
+        self._map = None
+        self.slot_size = 0
+
+    def _create(self, slot_size):
+        self.close()
+        size = HEADER.size + self.depth * (SLOT_HEADER_SIZE + slot_size)
+        with open(self.path + '.tmp', 'wb') as fp:
+            fp.truncate(size)
+        with open(self.path + '.tmp', 'r+b') as fp:
+            self._map = mmap.mmap(fp.fileno(), size)
+        HEADER.pack_into(self._map, 0, MAGIC, self.depth, 0, slot_size,
+                         self.count)
+        os.rename(self.path + '.tmp', self.path)
+        self.slot_size = slot_size
+
+    def write(self, index, buf):
+        """Write ``buf``, an array of up to 4 dimensions, as frame ``index``."""
+        if self._map is None or buf.nbytes > self.slot_size:
+            self._create(buf.nbytes)
+        off = HEADER.size + (self.count % self.depth) * (
+                SLOT_HEADER_SIZE + self.slot_size)
+        seq = struct.unpack_from('<Q', self._map, off)[0]
+        struct.pack_into('<Q', self._map, off, seq + 1)
+        shape = list(buf.shape) + [0] * (4 - buf.ndim)
+        SLOT.pack_into(self._map, off, seq + 1, index, buf.ndim, *(
+                shape + [buf.dtype.str, buf.nbytes]))
+        dst = np.ndarray(buf.nbytes, 'u1', self._map, off + SLOT_HEADER_SIZE)
+        dst[:] = np.ascontiguousarray(buf).view('u1').reshape(-1)
+        struct.pack_into('<Q', self._map, off, seq + 2)
+        self.count += 1
+        struct.pack_into('<Q', self._map, COUNT_OFFSET, self.count)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+class PreviewReader(object):
+    """
+    Reads the newest frame from the ring at ``path``.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._map = self._ino = None
+
+    def _open(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return False
+        if self._map is not None and st.st_ino == self._ino:
+            return True
+        self.close()
+        if st.st_size < HEADER.size:
+            return False
+        with open(self.path, 'rb') as fp:
+            self._map = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.depth, pad, self.slot_size, count = \
+                HEADER.unpack_from(self._map)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError('%s is not a preview ring' % self.path)
+        self._ino = st.st_ino
+        return True
+
+    def read(self, after=0, retries=100):
+        """
+        Return the newest frame as a `Frame`, or None if no frame newer
+        than the frame with count ``after`` has been written.
+        """
+        for i in range(retries):
+            if not self._open():
+                return None
+            count = struct.unpack_from('<Q', self._map, COUNT_OFFSET)[0]
+            if count <= after:
+                return None
+            off = HEADER.size + ((count - 1) % self.depth) * (
+                    SLOT_HEADER_SIZE + self.slot_size)
+            slot = SLOT.unpack_from(self._map, off)
+            seq, index, ndim = slot[:3]
+            if not seq & 1:
+                dtype, nbytes = slot[7:]
+                data = np.frombuffer(self._map, 'u1', nbytes,
+                                     off + SLOT_HEADER_SIZE).copy()
+                if struct.unpack_from('<Q', self._map, off)[0] == seq:
+                    data = data.view(dtype.rstrip('\0'))
+                    return Frame(count, index, data.reshape(slot[3:3+ndim]))
+            time.sleep(0.001)
+        return None
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+        self._map = self._ino = None
@@ -6,6 +6,7 @@ import numpy as np
 from genome.specs import toplevels
 from genome.use import RefWrapper, SplineWrapper
 import output
+import archive
 
 BUILTIN={
     '4k': dict(width=3840, height=2160),
@@ -60,7 +61,8 @@ def add_args(parser=None):
 
     out = parser.add_argument_group('Output options')
     out.add_argument('--codec',
-        choices=['jpeg', 'png', 'tiff', 'x264', 'vp8', 'vp9', 'prores'])
+        choices=['jpeg', 'png', 'tiff', 'exr', 'x264', 'vp8', 'vp9',
+                 'prores', 'y4m'])
     out.add_argument('-n', metavar='NAME', type=str, dest='name',
         help="Prefix to use when saving files (default is basename of input)")
     out.add_argument('--suffix', metavar='NAME', type=str, dest='suffix',
@@ -71,6 +73,10 @@ def add_args(parser=None):
         help="Don't overwrite output files that are newer than the input")
     out.add_argument('--subdir', action='store_true',
         help="Use basename as subdirectory of out dir, instead of prefix")
+    out.add_argument('--archive', action='store_true',
+        help="Append output files to one indexed archive per animation "
+             "(NAME.cuba and NAME.cuba.idx in the out dir), instead of "
+             "leaving one file per frame")
 
     return parser
 
@@ -135,12 +141,11 @@ def enumerate_jobs(gprof, basename, args, resume=None):
 
     If `resume` is set to True, either by kwarg or (if the kwarg is None)
     in the argparse arguments, check for the existence of a file with the
-    canonical extension for the selected output module.
+    canonical extension for the selected output module (or, with
+    `--archive`, for its entry in the animation's archive index).
     """
 
-    if args.name is not None:
-        basename = args.name
-    prefix = os.path.join(args.dir, basename)
+    prefix = get_archive_path(args, basename)
     if args.subdir:
         if not os.path.isdir(prefix):
             os.mkdir(prefix)
@@ -154,7 +159,29 @@ def enumerate_jobs(gprof, basename, args, resume=None):
     resume = args.resume if resume is None else resume
     if resume:
       out_suffix = output.get_suffix_for_profile(gprof)
-      frames = [(n, t) for (n, t) in frames
-                if not os.path.isfile(n + out_suffix)]
+      if getattr(args, 'archive', False):
+        index = archive.read_index(prefix)
+        frames = [(n, t) for (n, t) in frames
+                  if get_archive_member(n) + out_suffix not in index]
+      else:
+        frames = [(n, t) for (n, t) in frames
+                  if not os.path.isfile(n + out_suffix)]
 
     return frames
+
+def get_archive_path(args, basename):
+    """
+    Return the path of the archive for the animation `basename` (without
+    the archive's suffixes). This is also the prefix of each output path
+    returned by `enumerate_jobs`.
+    """
+    if args.name is not None:
+        basename = args.name
+    return os.path.join(args.dir, basename)
+
+def get_archive_member(name):
+    """
+    Return the archive member name (without file extensions) to use for an
+    output base path returned by `enumerate_jobs`.
+    """
+    return os.path.basename(name)
@@ -229,11 +229,24 @@ class Renderer(object):
     MAX_MODREFS = 20
     _modrefs = {}
 
+    # Processes that render many genomes (such as distributed workers) reuse
+    # compiled modules for genomes that generate identical code, which is
+    # usually the case when their structural hashes match.
+    MAX_CUBINS = 64
+    _cubins = {}
+    compile_count = 0
+
     @classmethod
     def compile(cls, gnm, arch=None, keep=False):
         packer, lib = iter.mkiterlib(gnm)
-        cubin = util.compile('iter', assemble_code(lib), arch=arch, keep=keep)
-        return packer, lib, cubin
+        src = assemble_code(lib)
+        key = (src, arch)
+        if keep or key not in cls._cubins:
+            if len(cls._cubins) > cls.MAX_CUBINS:
+                cls._cubins.clear()
+            cls._cubins[key] = util.compile('iter', src, arch=arch, keep=keep)
+            Renderer.compile_count += 1
+        return packer, lib, cls._cubins[key]
 
     def load(self, cubin):
         if cubin in self._modrefs:
@@ -249,6 +262,7 @@ class Renderer(object):
         self.mod = self.load(self.cubin)
         self.filts = filters.create(gprof)
         self.out = output.get_output_for_profile(gprof)
+        self.proxies = output.get_proxies_for_profile(gprof, self.out)
 
 class RenderManager(ClsMod):
     lib = devlib(deps=[interp.palintlib, filldptrlib])
@@ -0,0 +1,139 @@
+"""
+Cost-based job scheduling for the dispatcher.
+
+A job's cost is estimated as the number of samples it takes to render,
+the sum of ``spp(t) * width * height`` over its frame times, scaled by the
+complexity of its genome. Jobs are handed out longest-first (LPT), which
+keeps a few large jobs from landing at the end of a batch and stretching
+it. Estimates are corrected as jobs complete, using an exponentially
+weighted moving average of the ratio of observed render time to estimated
+cost, for each genome structure and overall.
+
+Jobs can also be routed by affinity: a worker that recently rendered
+genomes with the same structure (the same `genome.util.hash`) has their
+iteration module compiled already, so it's given a matching job instead
+of the longest one, as long as the matching job isn't much shorter.
+
+Traces of completed jobs can be replayed with `simulate` to compare the
+makespan of LPT and FIFO scheduling on a given number of workers.
+"""
+
+import json
+from collections import namedtuple
+
+# Relative cost of each xform and each variation, per sample, against the
+# fixed cost of iterating, accumulating and filtering that sample
+XFORM_COST = 0.05
+VARIATION_COST = 0.15
+
+def complexity(gnm):
+    """Return the relative per-sample cost of iterating the genome `gnm`."""
+    xforms = gnm.get('xforms', {}).values()
+    if gnm.get('final_xform'):
+        xforms.append(gnm['final_xform'])
+    nvars = sum(len(xf.get('variations', {})) for xf in xforms)
+    return 1 + XFORM_COST * len(xforms) + VARIATION_COST * nvars
+
+def estimate_cost(gprof, gnm, times):
+    """
+    Estimate the cost of rendering the genome `gnm` with the wrapped
+    profile `gprof` at each of `times`, in units of millions of samples of
+    unit complexity.
+    """
+    samples = sum(gprof.spp(t) for t in times) * gprof.width * gprof.height
+    return samples * complexity(gnm) / 1e6
+
+class Scheduler(object):
+    """
+    Holds jobs, handing out the one with the longest corrected estimated
+    time first. Each job has a cost, from `estimate_cost`, and a key, such
+    as the genome's `genome.util.hash`, under which its render times are
+    tracked, and which can be used to route jobs by affinity.
+    """
+    def __init__(self, alpha=0.3, affinity=0.5):
+        self.alpha, self.affinity = alpha, affinity
+        self.ratio = None
+        self.ratios = {}
+        self._jobs = []
+
+    def __len__(self):
+        return len(self._jobs)
+
+    def estimate(self, cost, key=None):
+        """Return the estimated render time in ms for a job."""
+        return cost * (self.ratios.get(key) or self.ratio or 1)
+
+    def push(self, job, cost, key=None):
+        self._jobs.append((cost, key, job))
+
+    def pop(self, prefer=()):
+        """
+        Remove and return the job with the longest estimated time, unless
+        there's a job with a key in `prefer` whose estimated time is at
+        least `affinity` times as long, in which case return the longest
+        such job.
+        """
+        # Corrections change the order as jobs complete, so the jobs aren't
+        # kept sorted; the dispatcher only holds a few dozen at once
+        est = lambda i: self.estimate(*self._jobs[i][:2])
+        idxs = range(len(self._jobs))
+        i = max(idxs, key=est)
+        matches = [j for j in idxs if self._jobs[j][1] in prefer]
+        if matches:
+            j = max(matches, key=est)
+            if est(j) >= self.affinity * est(i):
+                i = j
+        return self._jobs.pop(i)[2]
+
+    def observe(self, cost, key, ms):
+        """Record that a job of estimated `cost` took `ms` to render."""
+        if cost <= 0:
+            return
+        ratio = ms / float(cost)
+        ewma = lambda old: ratio if old is None else (
+                old + self.alpha * (ratio - old))
+        self.ratio = ewma(self.ratio)
+        self.ratios[key] = ewma(self.ratios.get(key))
+
+# One line of a trace, for each job completed by the dispatcher. `seq` is
+# the job's position in submission order, and `ms` its total render time.
+TraceEntry = namedtuple('TraceEntry', 'seq name key cost ms worker')
+
+def format_trace_entry(entry):
+    return json.dumps(entry._asdict())
+
+def read_trace(path):
+    """Return the entries in the trace at `path`, in submission order."""
+    with open(path) as fp:
+        entries = [TraceEntry(**json.loads(line))
+                   for line in fp if line.strip()]
+    return sorted(entries, key=lambda e: e.seq)
+
+def simulate(trace, nworkers, lpt=True, lookahead=64):
+    """
+    Replay `trace`, a list of `TraceEntry` in submission order, on
+    `nworkers` identical workers, returning the makespan in ms. Jobs are
+    taken in order, or, if `lpt` is set, by a `Scheduler` holding up to
+    `lookahead` submitted jobs and learning from each job's recorded time
+    as it completes. Times spent outside rendering are not modeled.
+    """
+    sched = Scheduler()
+    pending = list(trace)[::-1]
+    free = [0] * nworkers
+    done = []
+    while pending or sched:
+        now = min(free)
+        worker = free.index(now)
+        for entry in [e for e in done if e[0] <= now]:
+            sched.observe(entry[1].cost, entry[1].key, entry[1].ms)
+            done.remove(entry)
+        if lpt:
+            while pending and len(sched) < lookahead:
+                entry = pending.pop()
+                sched.push(entry, entry.cost, entry.key)
+            entry = sched.pop()
+        else:
+            entry = pending.pop()
+        free[worker] = now + entry.ms
+        done.append((free[worker], entry))
+    return max(free)
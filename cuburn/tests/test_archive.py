@@ -0,0 +1,53 @@
+import os
+import shutil
+import tempfile
+import unittest
+from cStringIO import StringIO
+
+from cuburn import archive
+
+class ArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'anim')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_roundtrip(self):
+        arc = archive.ArchiveWriter(self.path, sync_every=2)
+        arc.add('anim_00001.jpg', 'first')
+        arc.add('anim_00002.jpg', StringIO('second'))
+        arc.add('anim_00001.jpg', 'again')
+        arc.add('empty.jpg', '')
+        arc.close()
+
+        self.assertEquals(['anim_00002.jpg', 'anim_00001.jpg', 'empty.jpg'],
+                          archive.read_index(self.path).keys())
+        rdr = archive.ArchiveReader(self.path)
+        self.assertEquals('again', str(rdr['anim_00001.jpg']))
+        self.assertEquals('second', str(rdr['anim_00002.jpg']))
+        self.assertEquals('', str(rdr['empty.jpg']))
+        self.assertNotIn('anim_00003.jpg', rdr)
+        rdr.close()
+
+    def test_unsynced_data_is_discarded(self):
+        arc = archive.ArchiveWriter(self.path, sync_every=1)
+        arc.add('a', 'synced')
+        arc.close()
+        # Simulate a crash partway through a later batch
+        with open(self.path + archive.BLOB_SUFFIX, 'ab') as fp:
+            fp.write('lost')
+        with open(self.path + archive.INDEX_SUFFIX, 'ab') as fp:
+            fp.write('6 4 b')
+        self.assertEquals(['a'], archive.read_index(self.path).keys())
+
+        arc = archive.ArchiveWriter(self.path)
+        arc.add('c', 'kept')
+        arc.close()
+        self.assertEquals({'a': (0, 6), 'c': (6, 4)},
+                          dict(archive.read_index(self.path)))
+        self.assertEquals(10, os.path.getsize(self.path + archive.BLOB_SUFFIX))
+
+    def test_missing_archive(self):
+        self.assertEquals({}, archive.read_index(self.path))
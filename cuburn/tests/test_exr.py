@@ -0,0 +1,29 @@
+import unittest
+import numpy as np
+from cStringIO import StringIO
+
+from cuburn import exr
+
+class EXRTest(unittest.TestCase):
+    def _roundtrip(self, img, channels, compression):
+        fp = StringIO()
+        exr.write(fp, img, channels, compression)
+        fp.seek(0)
+        return exr.read(fp)
+
+    def test_roundtrip(self):
+        rand = np.random.RandomState(0)
+        img = rand.uniform(0, 4, (37, 21, 4)).astype('f2')
+        img[:20] = 0
+        for compression in exr.COMPRESSION:
+            out, channels = self._roundtrip(img, 'RGBA', compression)
+            self.assertEquals('ABGR', channels)
+            self.assertTrue(np.all(out == img[:,:,::-1]))
+
+    def test_header(self):
+        fp = StringIO()
+        exr.write(fp, np.zeros((2, 3, 3), 'f4'), 'RGB')
+        data = fp.getvalue()
+        self.assertEquals('\x76\x2f\x31\x01', data[:4])
+        self.assertIn('dataWindow\0box2i\0\x10\0\0\0' +
+                      '\0' * 8 + '\x02\0\0\0\x01\0\0\0', data)
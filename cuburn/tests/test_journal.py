@@ -0,0 +1,88 @@
+import os
+import shutil
+import tempfile
+import unittest
+from collections import namedtuple
+
+from cuburn import journal
+
+Job = namedtuple('Job', 'genome name times archive start retry_count')
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_replay(self):
+        gnm = {'type': 'edge', 'xforms': {}}
+        a = Job(gnm, 'a', [0.1, 0.2, 0.3, 0.4], None, 0, 0)
+        b = Job(gnm, 'b', [0.5], None, 0, 0)
+        c = Job(dict(gnm), 'c', [0.6], None, 0, 0)
+        jnl = journal.Journal(self.path)
+        for job in a, b, c:
+            jnl.submit(job)
+        jnl.source('anim')
+        jnl.assign(a, 'host/0')
+        jnl.split(a, 3)
+        jnl.submit(a._replace(times=a.times[3:], start=3))
+        jnl.complete(a._replace(times=a.times[:3]), ['.h264'])
+        jnl.fail(b, True)
+        jnl.fail(c, False)
+        jnl.close()
+        with open(self.path) as fp:
+            # Genomes are only written once
+            self.assertEquals(1, fp.read().count('"ev": "genome"'))
+
+        jnl = journal.Journal(self.path)
+        self.assertEquals(set(['anim']), jnl.sources)
+        self.assertEquals([('b', 0, 1, [0.5]), ('a', 3, 0, [0.4])],
+                          [(j['name'], j['start'], j['retry_count'], j['times'])
+                           for j in jnl.pending])
+        self.assertEquals(gnm, Job(**jnl.pending[0]).genome)
+        self.assertEquals({'a': dict(starts=set([0, 3]),
+                                     suffixes=set(['.h264']), pending=1,
+                                     failed=False)},
+                          jnl.splits)
+        jnl.close()
+
+    def test_split_part_dropped(self):
+        a = Job({}, 'a', [0.1, 0.2, 0.3, 0.4], None, 0, 0)
+        jnl = journal.Journal(self.path)
+        jnl.submit(a)
+        jnl.split(a, 2)
+        jnl.submit(a._replace(times=a.times[2:], start=2))
+        jnl.complete(a._replace(times=a.times[:2]), ['.h264'])
+        jnl.fail(a._replace(times=a.times[2:], start=2), False)
+        jnl.close()
+        jnl = journal.Journal(self.path)
+        self.assertEquals([], jnl.pending)
+        self.assertEquals({'a': dict(starts=set([0, 2]),
+                                     suffixes=set(['.h264']), pending=0,
+                                     failed=True)},
+                          jnl.splits)
+        jnl.close()
+
+    def test_torn_line(self):
+        jnl = journal.Journal(self.path)
+        jnl.submit(Job({}, 'a', [0.5], None, 0, 0))
+        jnl.close()
+        with open(self.path, 'a') as fp:
+            fp.write('{"ev": "compl')
+        jnl = journal.Journal(self.path)
+        self.assertEquals(['a'], [j['name'] for j in jnl.pending])
+        jnl.complete(Job({}, 'a', [0.5], None, 0, 0), [])
+        jnl.close()
+        self.assertEquals([], journal.Journal(self.path).pending)
+
+    def test_fail_unknown(self):
+        a = Job({}, 'a', [0.5], None, 0, 0)
+        jnl = journal.Journal(self.path)
+        jnl.submit(a)
+        jnl.complete(a, [])
+        jnl.fail(a, True)
+        jnl.fail(Job({}, 'b', [0.5], None, 0, 0), False)
+        jnl.close()
+        self.assertEquals([], journal.Journal(self.path).pending)
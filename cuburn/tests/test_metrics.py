@@ -0,0 +1,35 @@
+import json
+import unittest
+
+from cuburn import metrics
+
+class MetricsTest(unittest.TestCase):
+    def test_worker_stats(self):
+        now = [100.]
+        m = metrics.Metrics(queue_depth=lambda: 3, clock=lambda: now[0])
+        m.job_started('a/0', affine=True)
+        for i in range(4):
+            now[0] += 1
+            m.frame('a/0', 500)
+        m.transfer('a/0', 4000000, 1000000, 0.5)
+        m.job_done('a/0', compiles=2)
+        now[0] += 2
+        m.job_started('a/0')
+        now[0] += 2
+        m.job_done('a/0', failed=True)
+        now[0] += 2
+
+        snap = json.loads(json.dumps(m.snapshot()))
+        w = snap['workers']['a/0']
+        self.assertEquals(1, w['jobs'])
+        self.assertEquals(1, w['retries'])
+        self.assertEquals(4, w['frames'])
+        self.assertEquals(2, w['compiles'])
+        self.assertEquals(1, w['affine_jobs'])
+        self.assertAlmostEquals(0.4, w['fps'])
+        self.assertAlmostEquals(500, w['ms_per_frame'])
+        self.assertAlmostEquals(2, w['mbps'])
+        # Idle before the second job, and since the last one
+        self.assertAlmostEquals(4, w['idle_time'])
+        self.assertEquals(3, snap['total']['queue_depth'])
+        self.assertIn('a/0', m.summary())
@@ -0,0 +1,167 @@
+import os
+import sys
+import types
+import struct
+import threading
+import unittest
+import numpy as np
+
+from cuburn import output, profile
+from cuburn.output import area_resize, _png_filter, EncodePool
+
+class AreaResizeTest(unittest.TestCase):
+    def test_integer_factor(self):
+        img = np.arange(16, dtype='u1').reshape(4, 4, 1)
+        out = area_resize(img, 2, 2)
+        self.assertEquals(out.dtype, np.float32)
+        self.assertTrue(np.allclose(out[:,:,0], [[2.5, 4.5], [10.5, 12.5]]))
+
+    def test_fractional_factor(self):
+        img = np.array([0, 3, 6], 'u2').reshape(1, 3, 1)
+        out = area_resize(img, 1, 2)
+        # Each output pixel covers one and a half input pixels
+        self.assertTrue(np.allclose(out[0,:,0], [1, 5]))
+
+    def test_preserves_mean(self):
+        img = np.random.RandomState(0).uniform(0, 255, (108, 192, 4))
+        out = area_resize(img, 36, 128)
+        self.assertEquals(out.shape, (36, 128, 4))
+        self.assertTrue(np.allclose(img.mean(axis=(0, 1)),
+                                    out.mean(axis=(0, 1)), rtol=1e-4))
+
+def _paeth(a, b, c):
+    p = a + b - c
+    pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+    if pa <= pb and pa <= pc:
+        return a
+    return b if pb <= pc else c
+
+class PNGFilterTest(unittest.TestCase):
+    def test_matches_spec(self):
+        bpp = 2
+        rows = np.random.RandomState(0).randint(0, 256, (5, 8)).astype('u1')
+        preds = [lambda a, b, c: 0, lambda a, b, c: a, lambda a, b, c: b,
+                 lambda a, b, c: (a + b) // 2, _paeth]
+        for ftype, pred in enumerate(preds):
+            out = _png_filter(rows, bpp, ftype)
+            for y in range(rows.shape[0]):
+                for x in range(rows.shape[1]):
+                    a = int(rows[y, x-bpp]) if x >= bpp else 0
+                    b = int(rows[y-1, x]) if y else 0
+                    c = int(rows[y-1, x-bpp]) if x >= bpp and y else 0
+                    self.assertEquals(out[y, x],
+                                      (rows[y, x] - pred(a, b, c)) % 256)
+
+class EncodePoolTest(unittest.TestCase):
+    def test_limits(self):
+        pool = EncodePool(2, depth=4, max_bytes=200)
+        results = []
+        for i in range(10):
+            buf = np.zeros(64 if i % 2 else 8, 'u1')
+            results += pool.submit(lambda i, buf: i, i, (buf, buf))
+            self.assertLessEqual(len(pool._pending), 4)
+            # Two 128-byte tasks would exceed the limit
+            self.assertLessEqual(pool._bytes, 200)
+        results += pool.close()
+        self.assertEquals(range(10), results)
+        self.assertEquals(0, pool._bytes)
+
+    def test_one_thread_under_gevent(self):
+        monkey = types.ModuleType('gevent.monkey')
+        monkey.is_module_patched = lambda name: name == 'threading'
+        sys.modules['gevent.monkey'] = monkey
+        try:
+            pool = EncodePool()
+        finally:
+            del sys.modules['gevent.monkey']
+        self.assertEquals(1, len(pool._threads))
+        pool.close()
+
+class _Frame(str):
+    """A frame that records the thread it was freed on."""
+    freed = []
+    def __del__(self):
+        self.freed.append(threading.current_thread())
+
+class _CatOutput(output.Output):
+    """A minimal temporal output, feeding frames to `cat`."""
+    def __init__(self):
+        self.subp = None
+
+    def encode(self, buf):
+        if buf is None:
+            log = self.subp.close()
+            self.subp = None
+            return {'.cat': 'done'}, [('cat', log)]
+        if self.subp is None:
+            with open(os.devnull, 'w') as null:
+                self.subp = output._EncoderProcess('cat', ['cat'], null)
+        self.subp.write(buf)
+        return {}, []
+
+    def held_frames(self):
+        return self.subp.held() if self.subp else []
+
+class EncoderReleaseTest(unittest.TestCase):
+    def setUp(self):
+        del _Frame.freed[:]
+
+    def test_encoder_process(self):
+        out = _CatOutput()
+        for i in range(8):
+            out.encode(_Frame('x' * 4096))
+        out.encode(None)
+        self.assertEquals([threading.current_thread()] * 8, _Frame.freed)
+
+    def test_parallel_output(self):
+        out = output.ParallelOutput(_CatOutput, 2)
+        done = []
+        for i in range(3):
+            for j in range(4):
+                done.append(out.encode(_Frame('x' * 4096)))
+            # Each segment is finished on the pool's thread
+            done.append(out.encode(None))
+        done += out.close()
+        self.assertEquals(3, sum('.cat' in media for media, logs in done))
+        self.assertEquals([threading.current_thread()] * 12, _Frame.freed)
+
+class PNGOutputTest(unittest.TestCase):
+    def setUp(self):
+        # Skip compiling the conversion kernels, which aren't used here
+        output.PNGOutput.load = classmethod(lambda cls, name=None: None)
+
+    def tearDown(self):
+        del output.PNGOutput.load
+
+    def _color_type(self, opts):
+        gprof = profile.wrap(dict(output=dict(opts, type='png')), {})
+        out = output.get_output_for_profile(gprof)
+        media, logs = out.encode(np.zeros((4, 4, 4), 'u1'))
+        data = media['.png'].read()
+        self.assertEquals('IHDR', data[12:16])
+        w, h, depth, ctype = struct.unpack('>IIBB', data[16:26])
+        self.assertEquals((4, 4, 8), (w, h, depth))
+        return ctype
+
+    def test_default_alpha(self):
+        # RGBA, as PNGs written by `PILOutput` were
+        self.assertEquals(6, self._color_type({}))
+        self.assertEquals(2, self._color_type({'alpha': False}))
+
+class ProxyOutputTest(unittest.TestCase):
+    def setUp(self):
+        output.X264Output.load = classmethod(lambda cls, name=None: None)
+
+    def tearDown(self):
+        del output.X264Output.load
+
+    def test_video_proxies(self):
+        src = output.X264Output()
+        proxy = output.ProxyOutput(src, 0.5)
+        self.assertTrue(proxy.temporal)
+        self.assertIsInstance(proxy.out, output.X264Output)
+        par = output.ParallelOutput(output.X264Output)
+        self.assertTrue(output.ProxyOutput(par, 0.5, 'x264').temporal)
+        par.close()
+        # Stills can't hold every frame of a video segment
+        self.assertRaises(ValueError, output.ProxyOutput, src, 0.5, 'jpeg')
@@ -0,0 +1,37 @@
+import os
+import shutil
+import tempfile
+import unittest
+import numpy as np
+
+from cuburn import preview
+
+class PreviewTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'ring')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_newest_frame(self):
+        writer = preview.PreviewWriter(self.path, depth=2)
+        reader = preview.PreviewReader(self.path)
+        self.assertEquals(None, reader.read())
+        for i in range(5):
+            writer.write(10 + i, np.full((3, 4, 2), i, 'u2'))
+        frame = reader.read()
+        self.assertEquals((5, 14), frame[:2])
+        self.assertEquals((3, 4, 2), frame.data.shape)
+        self.assertTrue(np.all(frame.data == 4))
+        self.assertEquals(None, reader.read(after=frame.count))
+
+    def test_growth_replaces_ring(self):
+        writer = preview.PreviewWriter(self.path)
+        reader = preview.PreviewReader(self.path)
+        writer.write(1, np.zeros(16, 'u1'))
+        self.assertEquals(1, reader.read().count)
+        writer.write(2, np.arange(64, dtype='u1').reshape(8, 8))
+        frame = reader.read(after=1)
+        self.assertEquals((2, 2), frame[:2])
+        self.assertEquals(63, frame.data[7, 7])
@@ -0,0 +1,56 @@
+import unittest
+
+from cuburn import profile, sched
+
+class CostTest(unittest.TestCase):
+    def test_estimate_cost(self):
+        args = profile.add_args().parse_args(['-P', '720p', '--spp', '100'])
+        name, prof = profile.get_from_args(args)
+        simple = {'type': 'edge', 'xforms': {'0': {'variations': {
+                    'linear': {'weight': 1}}}}}
+        busy = {'type': 'edge', 'xforms': dict(
+            (str(i), {'variations': {'linear': {'weight': 1},
+                                     'julia': {'weight': 1}}})
+            for i in range(4))}
+        gprof = profile.wrap(prof, simple)
+        one = sched.estimate_cost(gprof, simple, [0.5])
+        self.assertAlmostEquals(one, gprof.spp(0.5) * 1280 * 720 / 1e6 *
+                                     sched.complexity(simple))
+        self.assertAlmostEquals(
+                sched.estimate_cost(gprof, simple, [0.25, 0.75]), 2 * one)
+        self.assertGreater(sched.complexity(busy), sched.complexity(simple))
+
+class SchedulerTest(unittest.TestCase):
+    def test_longest_first(self):
+        s = sched.Scheduler()
+        for job, cost in [('a', 1), ('b', 5), ('c', 3)]:
+            s.push(job, cost)
+        self.assertEquals(['b', 'c', 'a'], [s.pop() for i in range(3)])
+        self.assertEquals(0, len(s))
+
+    def test_correction(self):
+        s = sched.Scheduler(alpha=1)
+        s.push('slow', 2, 'x')
+        s.push('fast', 3, 'y')
+        # Jobs keyed 'x' turn out to take three times as long per unit cost
+        s.observe(1, 'x', 300)
+        s.observe(1, 'y', 100)
+        self.assertEquals(600, s.estimate(2, 'x'))
+        self.assertEquals('slow', s.pop())
+
+    def test_affinity(self):
+        s = sched.Scheduler(affinity=0.5)
+        for job, cost, key in [('a', 10, 'x'), ('b', 6, 'y'), ('c', 4, 'z')]:
+            s.push(job, cost, key)
+        self.assertEquals('b', s.pop(prefer=['y']))
+        # Too short to be worth the imbalance
+        self.assertEquals('a', s.pop(prefer=['z']))
+        self.assertEquals('c', s.pop(prefer=['w']))
+
+    def test_simulate(self):
+        # A long job submitted last stretches a FIFO batch
+        trace = [sched.TraceEntry(i, str(i), None, ms, ms, None)
+                 for i, ms in enumerate([10] * 8 + [40])]
+        self.assertEquals(80, sched.simulate(trace, 2, lpt=False))
+        self.assertEquals(80, sched.simulate(trace, 2, lookahead=1))
+        self.assertEquals(60, sched.simulate(trace, 2))
@@ -11,68 +11,145 @@ import gevent
 import gevent.event
 import gevent.queue
 import gevent.pool
+import gevent.lock
+import gevent.pywsgi
 from gevent import monkey
+# This makes every thread green, workers' included, so the output module's
+# encoding and deflate threads don't run in parallel here (they default to
+# one thread, and proxies are encoded inline); only main.py gets that speedup
 monkey.patch_all()
 
 import json
+import time
+import select
+import shutil
+import zlib
+import struct
+import tempfile
 import warnings
 from subprocess import Popen
-from itertools import ifilter
-from collections import namedtuple
+from itertools import ifilter, count
+from collections import namedtuple, deque
 
 import numpy as np
 
 sys.path.insert(0, os.path.dirname(__file__))
-from cuburn import render, filters, output, profile
-from cuburn.genome import convert, use, db
+from cuburn import render, filters, output, profile, archive, sched, journal
+from cuburn import metrics
+from cuburn.genome import convert, use, db, validate, divergence, util
 
 ready_str = 'worker ready'
 closing_encoder_str = 'closing encoder'
 output_file_str = 'here is a file for you'
+output_path_str = 'wrote a file for you'
 done_str = 'we done here'
+job_done_str = 'job done'
+progress_str = 'frames done'
+truncate_str = 'stop early'
+truncated_str = 'stopping early'
 
 def write_str(out, val):
   out.write(np.array([len(val)], '>u4').tostring())
   out.write(val)
   out.flush()
 
-def write_filelike(out, filelike):
-  filelike.seek(0, 2)
-  out.write(np.array([filelike.tell()], '>u8').tostring())
+# Files are sent as a series of chunks, each preceded by a header holding
+# the chunk's codec, its length on the wire, and the CRC32 of its decoded
+# contents. A zero-length chunk ends the file. Each chunk falls back to
+# 'none' if compressing it doesn't help.
+chunk_header = struct.Struct('>BII')
+chunk_size = 1024 * 1024
+codec_names = ['none', 'zlib', 'lz4']
+
+def get_codecs():
+  """Return a dict of codec name to `(compress, decompress)` functions."""
+  ident = lambda data: data
+  codecs = dict(none=(ident, ident),
+                zlib=(lambda data: zlib.compress(data, 1), zlib.decompress))
+  try:
+    import lz4.block
+    codecs['lz4'] = (lz4.block.compress, lz4.block.decompress)
+  except ImportError:
+    pass
+  return codecs
+
+# Already-compressed outputs gain nothing from another pass
+compressible_suffixes = ('.tiff', '.y4m')
+
+def write_filelike(out, filelike, codec='none'):
+  """Send a file, returning `(size, bytes sent)`."""
+  compress = get_codecs()[codec][0]
   filelike.seek(0)
-  buf = filelike.read(1024 * 1024)
+  size = sent = 0
+  buf = filelike.read(chunk_size)
   while buf:
-    out.write(buf)
-    buf = filelike.read(1024 * 1024)
+    payload, cid = buf, 0
+    if codec != 'none':
+      packed = compress(buf)
+      if len(packed) < len(buf):
+        payload, cid = packed, codec_names.index(codec)
+    out.write(chunk_header.pack(cid, len(payload),
+                                zlib.crc32(buf) & 0xffffffff))
+    out.write(payload)
+    size += len(buf)
+    sent += chunk_header.size + len(payload)
+    buf = filelike.read(chunk_size)
+  out.write(chunk_header.pack(0, 0, 0))
   out.flush()
+  return size, sent + chunk_header.size
+
+def _read_exactly(infp, size, what):
+  data = infp.read(size)
+  if len(data) != size:
+    raise IOError('Truncated %s: expected %d bytes, got %d' % (
+        what, size, len(data)))
+  return data
 
 def read_str(infp):
-  sz_buf = infp.read(4)
-  assert len(sz_buf) == 4, 'Incomplete read of str size'
-  assert sz_buf[0] == '\0', 'No str should be that big'
-  sz = np.frombuffer(sz_buf, '>u4')[0]
-  msg = infp.read(sz)
-  assert len(msg) == sz, 'Incomplete read, expected %d got %d' % (sz, len(msg))
-  return msg
+  sz = struct.unpack('>I', _read_exactly(infp, 4, 'message size'))[0]
+  if sz > 1 << 30:
+    raise IOError('Implausible message size %d' % sz)
+  return _read_exactly(infp, sz, 'message')
 
 def copy_filelike(infp, dst):
-  sz_buf = infp.read(8)
-  assert len(sz_buf) == 8, 'Incomplete read of filelike size'
-  assert sz_buf[0] == '\0', 'No filelike should be that big'
-  sz = np.frombuffer(sz_buf, '>u8')[0]
-  recvd = 0
-  while recvd < sz:
-    # uh... why is int needed here?
-    chunk_sz = int(min(1024 * 1024, sz - recvd))
-    chunk = infp.read(chunk_sz)
-    assert len(chunk) == chunk_sz, (
-        'Incomplete chunk, expected %d (%s)got %d' % (sz, `sz_buf`, len(chunk)))
-    dst.write(chunk)
-    recvd += len(chunk)
+  """Receive a file sent by `write_filelike`, returning `(size, bytes read)`."""
+  codecs = get_codecs()
+  size = recvd = 0
+  while True:
+    cid, length, crc = chunk_header.unpack(
+        _read_exactly(infp, chunk_header.size, 'chunk header'))
+    recvd += chunk_header.size
+    if not length:
+      return size, recvd
+    data = _read_exactly(infp, length, 'chunk')
+    if cid >= len(codec_names) or codec_names[cid] not in codecs:
+      raise IOError('Unsupported chunk codec %d' % cid)
+    data = codecs[codec_names[cid]][1](data)
+    if zlib.crc32(data) & 0xffffffff != crc:
+      raise IOError('Chunk checksum mismatch')
+    dst.write(data)
+    size += len(data)
+    recvd += length
 
 def work(args):
+  """
+  Render jobs sent by the dispatcher on stdin, or on a Unix socket if
+  `--socket` is given, until it sends `done_str`, keeping the CUDA context,
+  render manager and compiled modules warm from one job to the next. Each
+  job ends with `job_done_str`.
+  """
   addr = socket.gethostname().split('.')[0] + '/' + str(args.device)
-  write_str(sys.stdout, ready_str)
+  # Input is unbuffered, so that polling it for messages during a job is
+  # reliable
+  if args.socket:
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.connect(args.socket)
+    infp, outfp = sock.makefile('rb', 0), sock.makefile('wb')
+  else:
+    infp, outfp = os.fdopen(sys.stdin.fileno(), 'rb', 0), sys.stdout
+  write_str(outfp, ready_str)
+  # Offer our transfer codecs; the dispatcher replies with its choice
+  write_str(outfp, json.dumps(dict(codecs=sorted(get_codecs()))))
 
   import pycuda.driver as cuda
   cuda.init()
@@ -80,58 +157,269 @@ def work(args):
   cuctx = dev.make_context(flags=cuda.ctx_flags.SCHED_BLOCKING_SYNC)
 
   try:
-    job_text = read_str(sys.stdin)
-    if job_text == done_str:
-      return
-    job_desc = json.loads(job_text)
-    prof, gnm, times, name = map(job_desc.get, 'profile genome times name'.split())
-    gprof = profile.wrap(prof, gnm)
-
     rmgr = render.RenderManager()
     arch = 'sm_{}{}'.format(
         dev.get_attribute(cuda.device_attribute.COMPUTE_CAPABILITY_MAJOR),
         dev.get_attribute(cuda.device_attribute.COMPUTE_CAPABILITY_MINOR))
-    rdr = render.Renderer(gnm, gprof, arch=arch)
-    last_render_time_ms = 0
-
-    def save(buf):
-      out, log = rdr.out.encode(buf)
-      for suffix, file_like in out.items():
-        write_str(sys.stdout, output_file_str)
-        write_str(sys.stdout, suffix)
-        write_filelike(sys.stdout, file_like)
-        if getattr(file_like, 'close', None):
-          file_like.close()
-
-    evt = buf = next_evt = next_buf = None
-    for idx, t in enumerate(list(times) + [None]):
-      evt, buf = next_evt, next_buf
-      if t is not None:
-        next_evt, next_buf = rmgr.queue_frame(rdr, gnm, gprof, t)
-      if not evt: continue
-      if last_render_time_ms > 2000:
-        while not evt.query():
-          gevent.sleep(0.2)
-      else:
-        evt.synchronize()
-      last_render_time_ms = evt.time()
-      print >> sys.stderr, '%30s: %s (%3d/%3d), %dms' % (
-          addr, name, idx, len(times), last_render_time_ms)
-      sys.stderr.flush()
-
-      save(buf)
-    write_str(sys.stdout, closing_encoder_str)
-    save(None)
-    write_str(sys.stdout, done_str)
+    codec = json.loads(read_str(infp))['codec']
+    while True:
+      job_text = read_str(infp)
+      if job_text == done_str:
+        return
+      if job_text == truncate_str:
+        # Sent for a job that finished before we saw it
+        read_str(infp)
+        continue
+      compiles = render.Renderer.compile_count
+      render_job(rmgr, arch, addr, codec, json.loads(job_text), infp, outfp)
+      # Followed by the number of iteration modules compiled for the job
+      write_str(outfp, job_done_str)
+      write_str(outfp, str(render.Renderer.compile_count - compiles))
   finally:
     cuda.Context.pop()
 
-Job = namedtuple('Job', 'genome name times retry_count')
+def render_job(rmgr, arch, addr, codec, job_desc, infp, outfp):
+  prof, gnm, times, name = map(job_desc.get, 'profile genome times name'.split())
+  # If set, files are written under this path prefix, and only their names
+  # are sent
+  direct = job_desc.get('direct')
+  seq = count()
+  gprof = profile.wrap(prof, gnm)
+  rdr = render.Renderer(gnm, gprof, arch=arch)
+  if direct:
+    # Temporal outputs then encode straight to the shared filesystem
+    for out in [rdr.out] + rdr.proxies:
+      out.dest = direct
+  last_render_time_ms = 0
+
+  def save(buf):
+    send(rdr.out.encode(buf))
+    # Threads are green here, so proxies are encoded inline
+    for proxy in rdr.proxies:
+      send(proxy.encode(buf))
+
+  def send((out, log)):
+    for suffix, file_like in out.items():
+      if direct:
+        path = '%s%s.%d.tmp' % (direct, suffix, next(seq))
+        if isinstance(file_like, basestring):
+          shutil.move(file_like, path)
+        else:
+          file_like.seek(0)
+          with open(path, 'wb') as fp:
+            shutil.copyfileobj(file_like, fp, 1 << 20)
+          if getattr(file_like, 'close', None):
+            file_like.close()
+        write_str(outfp, output_path_str)
+        write_str(outfp, suffix)
+        write_str(outfp, path)
+        continue
+      write_str(outfp, output_file_str)
+      write_str(outfp, suffix)
+      file_codec = codec if suffix.endswith(compressible_suffixes) else 'none'
+      if isinstance(file_like, basestring):
+        with open(file_like) as fp:
+          write_filelike(outfp, fp, file_codec)
+        os.unlink(file_like)
+        continue
+      write_filelike(outfp, file_like, file_codec)
+      if getattr(file_like, 'close', None):
+        file_like.close()
+
+  # Frames from `limit` on are left unrendered. The dispatcher lowers it to
+  # hand the tail of this job to an idle worker; frames already queued are
+  # kept, and the final limit is sent back.
+  limit, queued = [len(times)], [0]
+  def poll_control():
+    while select.select([infp], [], [], 0)[0]:
+      msg = read_str(infp)
+      if msg != truncate_str:
+        raise IOError('Unexpected message %r during a job' % msg)
+      limit[0] = min(limit[0], max(queued[0], int(read_str(infp))))
+      write_str(outfp, truncated_str)
+      write_str(outfp, str(limit[0]))
+
+  evt = buf = next_evt = next_buf = None
+  idx = 0
+  while True:
+    evt, buf = next_evt, next_buf
+    next_evt = next_buf = None
+    if queued[0] < limit[0]:
+      next_evt, next_buf = rmgr.queue_frame(rdr, gnm, gprof, times[queued[0]])
+      queued[0] += 1
+    if not evt:
+      if next_evt: continue
+      break
+    if last_render_time_ms > 2000:
+      while not evt.query():
+        gevent.sleep(0.2)
+    else:
+      evt.synchronize()
+    last_render_time_ms = evt.time()
+    print >> sys.stderr, '%30s: %s (%3d/%3d), %dms' % (
+        addr, name, idx + 1, limit[0], last_render_time_ms)
+    sys.stderr.flush()
+
+    save(buf)
+    idx += 1
+    write_str(outfp, progress_str)
+    write_str(outfp, '%d %d' % (idx, last_render_time_ms))
+    poll_control()
+  write_str(outfp, closing_encoder_str)
+  save(None)
+  for out in [rdr.out] + rdr.proxies:
+    for done in out.close():
+      send(done)
+
+# Number of recent genome structures to route to each worker by affinity.
+# Workers keep up to `render.Renderer.MAX_CUBINS` compiled modules.
+affinity_window = 8
+
+# `start` is the index of the job's first frame among those originally
+# enumerated for `name`; it's nonzero for the tails of split jobs
+Job = namedtuple('Job', 'genome name times archive start retry_count')
+
+class RunningJob(object):
+  """The dispatcher's view of a job in progress on a worker."""
+  def __init__(self, job, addr, worker, splittable):
+    self.job, self.addr, self.worker = job, addr, worker
+    self.done = self.render_ms = self.compiles = 0
+    self.suffixes = set()
+    self.splittable = splittable and len(job.times) > 1
+    self.truncating = False
+
+def part_name(name, start):
+  return '%s.part%05d' % (name, start)
+
+def remove_partial(prefix):
+  """
+  Remove the temporary files a local worker writing outputs directly under
+  `prefix` left behind when its job failed.
+  """
+  dirname, base = os.path.split(prefix)
+  for fn in os.listdir(dirname or '.'):
+    if (fn.startswith(base) and fn.endswith('.tmp') and
+        fn[len(base):][:1] in ('.', '_')):
+      try:
+        os.unlink(os.path.join(dirname, fn))
+      except OSError:
+        pass
+
+# Container formats for concatenating the parts of temporal outputs
+concat_formats = {'.h264': 'mp4', '.webm': 'webm', '.mov': 'mov', '.y4m': None}
+
+def concat_y4m(paths, dst):
+  with open(dst, 'wb') as out:
+    for i, path in enumerate(paths):
+      with open(path, 'rb') as fp:
+        if i:
+          fp.readline()
+        shutil.copyfileobj(fp, out, 1 << 20)
+
+def concat_ffmpeg(paths, dst, fmt):
+  with tempfile.NamedTemporaryFile(suffix='.txt') as lst:
+    for path in paths:
+      lst.write("file '%s'\n" % os.path.abspath(path).replace("'", "'\\''"))
+    lst.flush()
+    subprocess.check_call(['ffmpeg', '-v', 'error', '-y', '-f', 'concat',
+                           '-safe', '0', '-i', lst.name, '-c', 'copy',
+                           '-f', fmt, dst])
+
+def join_parts(name, starts, suffixes):
+  """
+  Combine the outputs of a job that was split into frame ranges, each
+  written under `part_name(name, start)`, into the job's own output files.
+  Temporal outputs are concatenated in order. For still images, as when an
+  unsplit shard overwrites its file on each frame, the last frame wins.
+  """
+  for suffix in suffixes:
+    paths = [part_name(name, s) + suffix for s in sorted(starts)]
+    paths = filter(os.path.isfile, paths)
+    if not paths:
+      # Already joined, before a restart
+      continue
+    ext = '.' + suffix.rsplit('.', 1)[-1]
+    if ext not in concat_formats:
+      os.rename(paths[-1], name + suffix)
+      paths = paths[:-1]
+    else:
+      if ext == '.y4m':
+        concat_y4m(paths, name + suffix + '.tmp')
+      else:
+        concat_ffmpeg(paths, name + suffix + '.tmp', concat_formats[ext])
+      os.rename(name + suffix + '.tmp', name + suffix)
+    map(os.unlink, paths)
+
+class LocalWorker(object):
+  """
+  A worker process on this machine, run from this checkout with the
+  current interpreter, connected over a Unix socket in `sock_dir` instead
+  of pipes, and writing the files it renders straight to disk. Otherwise it
+  looks like the `Popen` of a remote worker.
+  """
+  def __init__(self, device, sock_dir):
+    path = os.path.join(sock_dir, 'worker%s.sock' % device)
+    if os.path.exists(path):
+      os.unlink(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(1)
+    self.proc = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), 'work',
+         '--device', str(device), '--socket', path])
+    try:
+      with gevent.Timeout(120):
+        self.conn = listener.accept()[0]
+    except:
+      self.kill()
+      raise
+    finally:
+      listener.close()
+      os.unlink(path)
+    self.stdin, self.stdout = self.conn.makefile('wb'), self.conn.makefile('rb')
+
+  def kill(self):
+    self.proc.kill()
+
+  def wait(self):
+    ret = self.proc.wait()
+    if getattr(self, 'conn', None):
+      self.conn.close()
+    return ret
+
+def start_status_server(addr, stats):
+  """
+  Serve a JSON snapshot of `stats` over HTTP at `addr`, which is either a
+  port on localhost, 'host:port', or the path of a Unix socket.
+  """
+  def app(environ, start_response):
+    start_response('200 OK', [('Content-Type', 'application/json')])
+    return [json.dumps(stats.snapshot(), indent=2) + '\n']
+  if '/' in addr:
+    if os.path.exists(addr):
+      os.unlink(addr)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(addr)
+    listener.listen(16)
+  else:
+    host, port = addr.rsplit(':', 1) if ':' in addr else ('127.0.0.1', addr)
+    listener = (host, int(port))
+  server = gevent.pywsgi.WSGIServer(listener, app, log=None)
+  server.start()
+  return server
 
 def dispatch(args):
   pname, prof = profile.get_from_args(args)
 
   workers = args.worker
+  if args.local:
+    if args.local == 'all':
+      import pycuda.driver as cuda
+      cuda.init()
+      devices = range(cuda.Device.count())
+    else:
+      devices = args.local.split(',')
+    workers = (workers or []) + ['local/%s' % d for d in devices]
   if not workers:
     try:
       with open(os.path.expanduser('~/.cuburn-workers')) as fp:
@@ -140,35 +428,131 @@ def dispatch(args):
       traceback.print_exc()
       pass
   if not workers:
-    print >> sys.stderr, ('No workers defined. Pass --workers or set up '
-                          '~/.cuburn-workers with one worker per line.')
+    print >> sys.stderr, ('No workers defined. Pass --worker or --local, or '
+                          'set up ~/.cuburn-workers with one worker per '
+                          'line.')
+    sys.exit(1)
+
+  errs = validate.validate(prof, 'profile')
+  if errs:
+    print >> sys.stderr, validate.format_violations('Invalid profile', errs)
     sys.exit(1)
 
   gdb = db.connect(args.genomedb)
+  jnl = journal.Journal(args.journal) if args.journal else None
+
+  # The queue holds a token for each job, for `join`, and the scheduler
+  # holds the jobs; workers taking a token get the job with the longest
+  # estimated time. A None token shuts a worker down. Only the filler waits
+  # for there to be fewer than `lookahead` jobs queued: retries and split
+  # jobs are queued by worker greenlets, which would deadlock if they all
+  # waited on each other to take a job.
+  job_queue = gevent.queue.JoinableQueue()
+  scheduler = sched.Scheduler(affinity=args.affinity)
+  room = gevent.event.Event()
+  submitted = {}
+  def queue_job(job, log=True, wait=False):
+    while wait and len(scheduler) >= args.lookahead:
+      room.clear()
+      room.wait()
+    if jnl and log:
+      jnl.submit(job)
+    ident = (job.name, job.start)
+    if ident not in submitted:
+      submitted[ident] = (len(submitted), util.hash(job.genome))
+    cost = sched.estimate_cost(profile.wrap(prof, job.genome), job.genome,
+                               job.times)
+    scheduler.push(job, cost, submitted[ident][1])
+    job_queue.put_nowait(True)
 
-  job_queue = gevent.queue.JoinableQueue(5)
-  active_job_group = gevent.pool.Group()
   def fill_jobs():
+    if jnl:
+      # Requeue everything the journal shows as incomplete, including jobs
+      # that were in flight, and skip ids whose jobs were all submitted
+      print >> sys.stderr, 'Requeueing %d jobs from the journal' % len(
+          jnl.pending)
+      for fields in jnl.pending:
+        queue_job(Job(**fields), log=False, wait=True)
     for oid in args.flames:
       ids = [oid]
       if oid[0] == '@':
         with open(oid[1:]) as fp:
           ids = fp.read().split('\n')
       for id in ids:
-        gnm, basename = gdb.get_anim(id)
-        gprof = profile.wrap(prof, gnm)
-        for name, times in profile.enumerate_jobs(gprof, basename, args,
-                                                  resume=True):
-          job_queue.put(Job(gnm, name, times, 0))
+        if jnl and id in jnl.sources:
+          continue
+        fill_source(id)
+        if jnl:
+          jnl.source(id)
+
+  def fill_source(id):
+    gnm, basename = gdb.get_anim(id)
+    errs = validate.validate(gnm)
+    if errs:
+      print >> sys.stderr, validate.format_violations(
+          'Skipping invalid genome %s' % id, errs)
+      return
+    if args.max_reset_rate is not None:
+      # Sampling takes long enough to stall workers' transfers, so it runs
+      # on the hub's thread pool instead of the event loop
+      div = gevent.get_hub().threadpool.apply(divergence.analyze, (gnm,))
+      if div.reset_rate > args.max_reset_rate:
+        print >> sys.stderr, 'Skipping divergent genome'
+        print >> sys.stderr, divergence.format_report(id, div)
+        return
+    gprof = profile.wrap(prof, gnm)
+    arc = profile.get_archive_path(args, basename) if args.archive else None
+    for name, times in profile.enumerate_jobs(gprof, basename, args,
+                                              resume=True):
+      # Jobs from a partly submitted id may already be queued
+      if (name, 0) not in submitted:
+        queue_job(Job(gnm, name, times, arc, 0, 0), wait=True)
   job_filler = gevent.spawn(fill_jobs)
 
+  # Multi-frame jobs can be split between workers unless their output is
+  # written somewhere other than the files we receive
+  out_opts = prof.get('output', {})
+  splittable = (args.steal and not args.archive and
+                'path' not in out_opts and 'dest' not in out_opts)
+
+  def handshake(subp):
+    assert read_str(subp.stdout) == ready_str
+    offered = json.loads(read_str(subp.stdout))['codecs']
+    ours = get_codecs()
+    if args.compress == 'auto':
+      codec = 'lz4' if 'lz4' in offered and 'lz4' in ours else 'zlib'
+    elif args.compress in offered and args.compress in ours:
+      codec = args.compress
+    else:
+      print >> sys.stderr, 'Worker lacks %s compression' % args.compress
+      codec = 'none'
+    write_str(subp.stdin, json.dumps(dict(codec=codec)))
+
+  def send(worker, *msgs):
+    # Messages from different greenlets mustn't interleave
+    with worker.lock:
+      for msg in msgs:
+        write_str(worker.stdin, msg)
+
+  # Holds the directory of local workers' sockets, once it's created
+  sock_dir = []
+
   def connect_to_worker(addr):
     host, device = addr.split('/')
     if host == 'localhost':
       distribute_path = os.path.expanduser('~/.cuburn_dist/distribute.py')
       args = [distribute_path, 'work', '--device', str(device)]
       subp = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-      assert read_str(subp.stdout) == ready_str
+      handshake(subp)
+    elif host == 'local':
+      if not sock_dir:
+        sock_dir.append(tempfile.mkdtemp(prefix='cuburn-'))
+      subp = LocalWorker(device, sock_dir[0])
+      try:
+        handshake(subp)
+      except:
+        subp.kill()
+        raise
     else:
       connect_timeout = 5
       while True:
@@ -177,75 +561,302 @@ def dispatch(args):
               ['ssh', host, '.cuburn_dist/distribute.py', 'work',
                '--device', str(device)],
               stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-          assert read_str(subp.stdout) == ready_str
+          handshake(subp)
           break
         except:
           traceback.print_exc()
           gevent.sleep(connect_timeout)
           connect_timeout = min(600, connect_timeout * 2)
+    subp.lock = gevent.lock.Semaphore()
+    subp.direct = host == 'local'
     return subp
 
-  exiting = False
+  # Archive writers, by path. Files are received completely before being
+  # added, so that writes from different greenlets can't interleave.
+  archives = {}
+  def add_to_archive(path, member, fp):
+    if path not in archives:
+      archives[path] = archive.ArchiveWriter(path)
+    archives[path].add(member, fp)
+
+  def save_to_archive(path, member, infp):
+    with tempfile.TemporaryFile() as fp:
+      sizes = copy_filelike(infp, fp)
+      fp.seek(0)
+      add_to_archive(path, member, fp)
+    return sizes
+
+  # Jobs in progress, by worker address, and the parts of split jobs, by
+  # name, as a dict of part start frames, output suffixes, the number of
+  # parts not yet done, and whether any part was dropped
+  running = {}
+  splits = jnl.splits if jnl else {}
+
+  def end_split(name):
+    parts = splits.pop(name)
+    if parts['failed']:
+      print >> sys.stderr, ('%s: not joined, since a part failed; the other '
+                            'parts are left in %s.part*' % (name, name))
+    else:
+      join_parts(name, parts['starts'], parts['suffixes'])
+
+  for name, parts in splits.items():
+    if not parts['pending']:
+      # The last part completed, or was dropped, just before a restart
+      end_split(name)
+
+  def steal():
+    """
+    Ask the worker with the most frames left in a splittable job to stop
+    halfway through them. The remaining frames are queued as a new job when
+    it replies.
+    """
+    if not job_queue.empty() or any(r.truncating for r in running.values()):
+      return
+    cands = [r for r in running.values() if r.splittable]
+    if not cands:
+      return
+    r = max(cands, key=lambda r: len(r.job.times) - r.done)
+    left = len(r.job.times) - r.done
+    # The worker already has the next frame queued
+    if left < 3:
+      return
+    r.truncating = True
+    try:
+      send(r.worker, truncate_str, str(r.done + 1 + (left - 1) / 2))
+    except IOError:
+      # The worker's own greenlet deals with its failure
+      pass
+
+  def split(r, limit):
+    r.truncating = False
+    job = r.job
+    if limit >= len(job.times):
+      return
+    tail = job._replace(times=job.times[limit:], start=job.start + limit,
+                        retry_count=0)
+    r.job = job._replace(times=job.times[:limit])
+    if jnl:
+      jnl.split(job, limit)
+    parts = splits.setdefault(job.name, dict(
+        starts=set([job.start]), suffixes=set(), pending=1, failed=False))
+    parts['starts'].add(tail.start)
+    parts['pending'] += 1
+    print >> sys.stderr, '%s: frames from %d moved to another worker' % (
+        job.name, tail.start)
+    queue_job(tail)
+
+  def finish_part(job, failed=False):
+    parts = splits.get(job.name)
+    if parts is None:
+      return
+    parts['pending'] -= 1
+    parts['failed'] |= failed
+    if not parts['pending']:
+      end_split(job.name)
+
   worker_failure_counts = {}
-  def run_job(addr):
-    worker = connect_to_worker(addr)
-    job = job_queue.get()
-    evt = gevent.event.Event()
-    def _run_job():
+  def run_job(r):
+    worker, job = r.worker, r.job
+    job_desc = dict(profile=prof, genome=job.genome, times=list(job.times),
+                    name=job.name)
+    if worker.direct:
+      job_desc['direct'] = os.path.abspath(part_name(job.name, job.start))
+    send(worker, json.dumps(job_desc))
+    # Bytes received, before and after decompression, and time spent
+    size = wire = xfer_time = 0
+    while True:
+      msg_name = read_str(worker.stdout)
+      if msg_name == progress_str:
+        r.done, ms = map(int, read_str(worker.stdout).split())
+        r.render_ms += ms
+        stats.frame(r.addr, ms)
+      elif msg_name == truncated_str:
+        split(r, int(read_str(worker.stdout)))
+      elif msg_name == closing_encoder_str:
+        # The worker takes its next job once this one is done
+        r.splittable = False
+      elif msg_name in (output_file_str, output_path_str):
+        suffix = read_str(worker.stdout)
+        filename = job.name + suffix
+        r.suffixes.add(suffix)
+        if job.name in splits:
+          splits[job.name]['suffixes'].add(suffix)
+          filename = part_name(job.name, job.start) + suffix
+        start = time.time()
+        if msg_name == output_path_str:
+          # Written by a local worker; nothing crossed the wire
+          path = read_str(worker.stdout)
+          n, w = os.path.getsize(path), 0
+          if job.archive:
+            with open(path, 'rb') as fp:
+              add_to_archive(job.archive,
+                             profile.get_archive_member(filename), fp)
+            os.unlink(path)
+          else:
+            os.rename(path, filename)
+        elif job.archive:
+          n, w = save_to_archive(job.archive,
+                                 profile.get_archive_member(filename),
+                                 worker.stdout)
+        else:
+          with open(filename + '.tmp', 'w') as fp:
+            n, w = copy_filelike(worker.stdout, fp)
+          os.rename(filename + '.tmp', filename)
+        size, wire = size + n, wire + w
+        xfer_time += time.time() - start
+        stats.transfer(r.addr, n, w, time.time() - start)
+      elif msg_name == job_done_str:
+        r.compiles = int(read_str(worker.stdout))
+        break
+      else:
+        raise IOError('Unknown message %r' % msg_name)
+    print >> sys.stderr, ('%s: received %.1f MB (%.1f MB on the wire) in '
+                          '%.1fs, %d compiles' % (job.name, size / 1e6,
+                                                  wire / 1e6, xfer_time,
+                                                  r.compiles))
+
+  stats = metrics.Metrics(queue_depth=job_queue.qsize)
+  def log_metrics():
+    with open(args.metrics, 'a') as fp:
+      while True:
+        gevent.sleep(args.metrics_interval)
+        fp.write(json.dumps(stats.snapshot()) + '\n')
+        fp.flush()
+  if args.metrics:
+    gevent.spawn(log_metrics)
+  if args.status:
+    status_server = start_status_server(args.status, stats)
+
+  trace = open(args.trace, 'a') if args.trace else None
+  def record(addr, r):
+    job = r.job
+    seq, key = submitted[(job.name, job.start)]
+    cost = sched.estimate_cost(profile.wrap(prof, job.genome), job.genome,
+                               job.times)
+    scheduler.observe(cost, key, r.render_ms)
+    if trace:
+      trace.write(sched.format_trace_entry(sched.TraceEntry(
+          seq, job.name, key, cost, r.render_ms, addr)) + '\n')
+      trace.flush()
+
+  # When the first worker found nothing left to take
+  first_idle = []
+
+  # The genome structure hashes of each worker's most recent jobs, whose
+  # iteration modules it probably still has compiled
+  recent = {}
+
+  def next_job(addr):
+    while True:
       try:
-        if job is None:
-          write_str(worker.stdin, done_str)
+        if not job_queue.get(timeout=1):
+          return None
+        room.set()
+        return scheduler.pop(prefer=recent.get(addr, ()))
+      except gevent.queue.Empty:
+        if job_filler.ready():
+          if not first_idle:
+            first_idle.append(time.time())
+          if splittable:
+            steal()
+
+  def run_worker(addr):
+    # Each worker process is kept for as many jobs as it completes, and
+    # replaced after a failure
+    worker = None
+    while worker_failure_counts.get(addr) < 4:
+      if worker is None:
+        worker = connect_to_worker(addr)
+        # A new worker process starts with nothing compiled
+        recent.pop(addr, None)
+      job = next_job(addr)
+      if job is None:
+        job_queue.task_done()
+        try:
+          send(worker, done_str)
           worker.stdin.close()
-          return
-        job_desc = dict(profile=prof, genome=job.genome, times=list(job.times),
-                        name=job.name)
-        write_str(worker.stdin, json.dumps(job_desc))
-        worker.stdin.close()
-        while True:
-          msg_name = read_str(worker.stdout)
-          if msg_name == closing_encoder_str:
-            evt.set()
-          elif msg_name == output_file_str:
-            filename = job.name + read_str(worker.stdout)
-            with open(filename + '.tmp', 'w') as fp:
-              copy_filelike(worker.stdout, fp)
-            os.rename(filename + '.tmp', filename)
-          else:
-            assert msg_name == done_str, 'no known event ' + msg_name
-            break
+          worker.wait()
+        except IOError:
+          pass
+        return
+      r = running[addr] = RunningJob(job, addr, worker, splittable)
+      key = submitted[(job.name, job.start)][1]
+      hashes = recent.setdefault(addr, deque(maxlen=affinity_window))
+      stats.job_started(addr, affine=key in hashes)
+      if key in hashes:
+        hashes.remove(key)
+      hashes.append(key)
+      if jnl:
+        jnl.assign(job, addr)
+      try:
+        run_job(r)
+        stats.job_done(addr, compiles=r.compiles)
+        del running[addr]
+        if jnl:
+          jnl.complete(r.job, r.suffixes)
+        finish_part(r.job)
+        record(addr, r)
         worker_failure_counts[addr] = 0
       except:
         print >> sys.stderr, traceback.format_exc()
+        stats.job_done(addr, failed=True)
+        running.pop(addr, None)
         worker_failure_counts[addr] = worker_failure_counts.get(addr, 0) + 1
+        try:
+          worker.kill()
+          worker.wait()
+        except OSError:
+          pass
+        # Before the job can be retried under the same name
+        if worker.direct:
+          remove_partial(os.path.abspath(part_name(r.job.name, r.job.start)))
+        worker = None
+        # Retry whatever part of the job hadn't been handed off
+        job = r.job
+        if jnl:
+          jnl.fail(job, job.retry_count < 3)
         if job.retry_count < 3:
-          job_queue.put(Job(job.genome, job.name, job.times, job.retry_count + 1))
+          queue_job(job._replace(retry_count=job.retry_count + 1), log=False)
+        else:
+          # Out of retries: a split job can't be joined without this part
+          finish_part(job, failed=True)
       finally:
         job_queue.task_done()
-        evt.set()
-    greenlet = gevent.spawn(_run_job)
-    active_job_group.add(greenlet)
-    return greenlet, evt
-
-  def run_worker(addr):
-    while worker_failure_counts.get(addr) < 4 and not exiting:
-      greenlet, evt = run_job(addr)
-      evt.wait()
 
+  batch_start = time.time()
   worker_group = gevent.pool.Group()
   for addr in workers:
     worker_group.spawn(run_worker, addr)
   job_filler.join()
 
   # Flush all outstanding jobs and, possibly, retries
-  while job_queue.join():
-    active_job_group.join()
-    if job_queue.empty():
-      break
+  job_queue.join()
+  end = time.time()
+  print >> sys.stderr, 'Batch done in %.1fs' % (end - batch_start),
+  if first_idle:
+    # How long the end of the batch left some workers with nothing to do
+    print >> sys.stderr, '(tail: %.1fs after a worker first went idle)' % (
+        end - first_idle[0]),
+  print >> sys.stderr
 
   # Close the remaining workers
-  exiting = True
   map(job_queue.put, [None] * len(worker_group))
   worker_group.join()
+  print >> sys.stderr, stats.summary()
+  if args.metrics:
+    with open(args.metrics, 'a') as fp:
+      fp.write(json.dumps(stats.snapshot()) + '\n')
+  if args.status:
+    status_server.stop()
+  for arc in archives.values():
+    arc.close()
+  if trace:
+    trace.close()
+  if jnl:
+    jnl.close()
+  if sock_dir:
+    shutil.rmtree(sock_dir[0], ignore_errors=True)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
@@ -259,9 +870,46 @@ if __name__ == "__main__":
         help='Flames to render (prefix playlist with @)')
     dispatch_parser.add_argument('--worker', metavar='ADDRESS', nargs='*',
         help='Worker address (in the form "host/device_id")')
+    dispatch_parser.add_argument('--local', metavar='DEVICES', nargs='?',
+        const='all', help="Add a worker for each GPU on this machine (or "
+        "each in a comma-separated list), run from this checkout over Unix "
+        "sockets, writing outputs directly instead of sending them")
     dispatch_parser.add_argument('-d', '--genomedb', metavar='PATH', type=str,
         help="Path to genome database (file or directory, default '.')",
         default='.')
+    dispatch_parser.add_argument('--compress', default='auto',
+        choices=['auto', 'none', 'zlib', 'lz4'],
+        help="Compression for uncompressed outputs (TIFF, Y4M) sent from "
+             "workers (default: lz4 if available on both ends, else zlib)")
+    dispatch_parser.add_argument('--max-reset-rate', metavar='FRAC',
+        type=float, help="Skip genomes that reset more than this fraction "
+        "of iterations in a sampled run (default: don't check)")
+    dispatch_parser.add_argument('--lookahead', metavar='N', type=int,
+        default=64, help="Number of queued jobs to choose the next job "
+        "from, longest first by estimated cost (default: 64)")
+    dispatch_parser.add_argument('--affinity', metavar='FRAC', type=float,
+        default=0.5, help="Give a worker a job with the same genome "
+        "structure as one of its recent jobs, to reuse its compiled code, "
+        "if the job's estimated time is at least FRAC times that of the "
+        "longest queued job (default: 0.5; 1 disables affinity)")
+    dispatch_parser.add_argument('--trace', metavar='PATH',
+        help="Append a JSON line for each completed job to PATH, for "
+             "replay with helpers/schedsim.py")
+    dispatch_parser.add_argument('--journal', metavar='PATH',
+        help="Record jobs in a journal at PATH. If it exists, requeue the "
+             "jobs it shows as incomplete, and skip ids whose jobs were "
+             "all submitted, instead of resolving them again")
+    dispatch_parser.add_argument('--metrics', metavar='PATH',
+        help="Append a JSON line of per-worker metrics to PATH periodically, "
+             "and at the end of the batch")
+    dispatch_parser.add_argument('--metrics-interval', metavar='SECS',
+        type=float, default=10, help='Seconds between metrics lines')
+    dispatch_parser.add_argument('--status', metavar='ADDR',
+        help="Serve the current metrics as JSON over HTTP on a local port, "
+             "'host:port', or a Unix socket at the given path")
+    dispatch_parser.add_argument('--no-steal', dest='steal',
+        action='store_false', help="Don't split multi-frame jobs (from "
+        "--shard) to give idle workers the remaining frames of slow ones")
     profile.add_args(dispatch_parser)
     dispatch_parser.set_defaults(func=dispatch)
 
@@ -269,6 +917,9 @@ if __name__ == "__main__":
         'work', help='Perform a task (controlled by a dispatcher).')
     worker_parser.add_argument('--device', metavar='NUM', type=int,
         help='GPU device number to use, 0-indexed.')
+    worker_parser.add_argument('--socket', metavar='PATH',
+        help='Talk to the dispatcher on the Unix socket at PATH, instead of '
+             'stdin and stdout.')
     worker_parser.set_defaults(func=work)
 
     args = parser.parse_args()
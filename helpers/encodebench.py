@@ -0,0 +1,104 @@
+#!/usr/bin/env python2
+
+"""
+Benchmark per-frame encoding time and size of the still-image outputs at
+1080p and 4K, on synthetic frames with flame-like structure (smooth
+gradients, dark background, dithering noise).
+
+Usage: encodebench.py [REPS]
+"""
+
+import sys, time
+import numpy as np
+
+import pycuda.autoinit
+
+from os.path import abspath, join, dirname
+sys.path.insert(0, abspath(join(dirname(__file__), '..')))
+
+from cuburn import output
+
+SIZES = [('1080p', 1920, 1080), ('4K', 3840, 2160)]
+
+def make_frame(w, h, depth='u1', seed=0):
+    rand = np.random.RandomState(seed)
+    y, x = np.mgrid[0:h, 0:w] / float(w)
+    r = np.hypot(x - 0.5, y - 0.3)
+    base = np.exp(-8 * r) * (0.6 + 0.4 * np.sin(40 * r))
+    frame = np.empty((h, w, 4))
+    for i, phase in enumerate([0, 2, 4]):
+        frame[:,:,i] = base * (0.5 + 0.5 * np.cos(6 * r + phase))
+    frame[:,:,3] = np.minimum(1, 4 * base)
+    frame += rand.uniform(-0.5, 0.5, frame.shape) / 255.
+    scale = 255 if depth == 'u1' else 65535
+    return np.clip(frame * scale, 0, scale).astype(depth)
+
+def timeit(name, fn, reps):
+    best = 1e9
+    for i in range(reps):
+        a = time.time()
+        media, logs = fn()
+        best = min(best, time.time() - a)
+    size = sum(len(v.read()) for v in media.values())
+    print '  %-32s %9.1f ms %10d bytes' % (name, best * 1000, size)
+
+def legacy_pil(buf, codec, quality=100):
+    # The previous implementation, for comparison, if scipy still has it
+    import scipy.misc
+    from cStringIO import StringIO
+    out = StringIO()
+    img = scipy.misc.toimage(buf, cmin=0, cmax=1)
+    img.save(out, codec, quality=quality, compress_level=1)
+    out.seek(0)
+    return {'.' + codec: out}, []
+
+def main(reps):
+    try:
+        import scipy.misc
+        has_legacy = hasattr(scipy.misc, 'toimage')
+    except ImportError:
+        has_legacy = False
+
+    outputs = [
+        ('jpeg q100', output.PILOutput('jpeg')),
+        ('jpeg q95 4:2:0', output.PILOutput('jpeg', 95, subsampling=2)),
+        ('jpeg q100 +alpha', output.PILOutput('jpeg', alpha=True)),
+        ('png level 1 (PIL)', output.PILOutput('png')),
+        ('png level 6 (PIL)', output.PILOutput('png', compress_level=6)),
+        ('png level 1 up', output.PNGOutput()),
+        ('png level 1 up, 1 thread', output.PNGOutput(threads=1)),
+        ('png level 6 paeth', output.PNGOutput(level=6, filter='paeth')),
+        ('png level 6 adaptive', output.PNGOutput(level=6,
+                                                  filter='adaptive')),
+    ]
+    outputs_hdr = [
+        ('exr zip', output.EXROutput()),
+        ('exr zip level 1', output.EXROutput(level=1)),
+        ('exr uncompressed', output.EXROutput(compression='none')),
+    ]
+    outputs16 = [
+        ('png16 level 1 up', output.PNGOutput(depth=16)),
+        ('png16 level 6 paeth', output.PNGOutput(depth=16, level=6,
+                                                 filter='paeth')),
+    ]
+    for label, w, h in SIZES:
+        print '%s (%dx%d):' % (label, w, h)
+        buf = make_frame(w, h)
+        if has_legacy:
+            timeit('jpeg q100 (scipy.misc.toimage)',
+                   lambda: legacy_pil(buf[:,:,:3], 'jpeg'), reps)
+            timeit('png level 1 (scipy.misc.toimage)',
+                   lambda: legacy_pil(buf, 'png'), reps)
+        for name, out in outputs:
+            timeit(name, lambda: out.encode(buf), reps)
+        buf16 = make_frame(w, h, 'u2')
+        timeit('tiff', lambda: output.TiffOutput().encode(buf16), reps)
+        for name, out in outputs16:
+            timeit(name, lambda: out.encode(buf16), reps)
+        # Half-float frames carry the unclamped HDR range
+        buf16f = (make_frame(w, h, 'u2') / 16384.).astype('f2')
+        for name, out in outputs_hdr:
+            timeit(name, lambda: out.encode(buf16f), reps)
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 3)
@@ -0,0 +1,36 @@
+#!/usr/bin/env python2
+
+"""
+Compare the makespan of FIFO and longest-first scheduling on a trace of
+completed jobs, as written by `distribute.py dispatch --trace`.
+
+Usage: schedsim.py TRACE [WORKERS...]
+"""
+
+import sys
+
+from os.path import abspath, join, dirname
+sys.path.insert(0, abspath(join(dirname(__file__), '..')))
+
+from cuburn import sched
+
+def main(path, counts):
+    trace = sched.read_trace(path)
+    total = sum(e.ms for e in trace)
+    print '%d jobs, %.1f GPU-minutes' % (len(trace), total / 60e3)
+    print '%8s %12s %12s %8s %10s' % (
+            'workers', 'FIFO (min)', 'LPT (min)', 'change', 'bound')
+    for n in counts:
+        fifo = sched.simulate(trace, n, lpt=False)
+        lpt = sched.simulate(trace, n)
+        # No schedule can beat perfect balance, or the longest job
+        bound = max(total / float(n), max(e.ms for e in trace))
+        print '%8d %12.1f %12.1f %7.1f%% %10.1f' % (
+                n, fifo / 60e3, lpt / 60e3, 100. * (lpt - fifo) / fifo,
+                bound / 60e3)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print __doc__
+        sys.exit(1)
+    main(sys.argv[1], map(int, sys.argv[2:]) or [8, 16, 40])
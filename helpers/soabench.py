@@ -0,0 +1,72 @@
+#!/usr/bin/env python2
+
+"""
+Benchmark construction, round-trip and packing of struct-of-arrays genomes
+against the plain-dict code paths, on large synthetic animations.
+
+Usage: soabench.py [NXFORMS ...]
+"""
+
+import sys, time
+import numpy as np
+
+from os.path import abspath, join, dirname
+sys.path.insert(0, abspath(join(dirname(__file__), '..')))
+
+from cuburn.genome import specs
+from cuburn.genome.soa import GenomeArrays
+from cuburn.code.interp import GenomePacker
+
+def make_anim(nxforms, seed=0):
+    rand = np.random.RandomState(seed)
+    knotted = lambda: ([rand.randn(), rand.randn(), rand.randn(), rand.randn()]
+                       + list(np.ravel(zip(np.sort(rand.rand(4)),
+                                           rand.randn(4)))))
+    spl = lambda: rand.choice([lambda: rand.randn(),
+                               lambda: [rand.randn(), rand.randn()],
+                               knotted])()
+    aff = lambda: dict(angle=[rand.rand() * 360, -360,
+                              rand.rand() * 360 - 360, -360],
+                       spread=spl(), magnitude=dict(x=spl(), y=spl()),
+                       offset=dict(x=spl(), y=spl()))
+    names = sorted(specs.var_params)
+    xforms = {}
+    for i in range(nxforms):
+        vs = {}
+        for name in rand.choice(names, 3, replace=False):
+            vs[name] = dict((k, spl()) for k in specs.var_params[name])
+        xforms[str(i)] = dict(weight=spl(), color=spl(), color_speed=spl(),
+                              pre_affine=aff(), post_affine=aff(),
+                              variations=vs)
+    return dict(type='animation', xforms=xforms, time=dict(duration=2),
+                camera=dict(center=dict(x=spl(), y=spl()), scale=spl(),
+                            rotation=spl()))
+
+def timeit(name, fn, reps=5):
+    best = 1e9
+    for i in range(reps):
+        a = time.time()
+        ret = fn()
+        best = min(best, time.time() - a)
+    print '  %-24s %9.3f ms' % (name, best * 1000)
+    return ret
+
+def main(sizes):
+    for nxf in sizes:
+        gnm = make_anim(nxf)
+        arrs = GenomeArrays.from_dict(gnm)
+        print '%d xforms, %d splines, %d values:' % (
+                nxf, len(arrs), len(arrs.values))
+        timeit('from_dict', lambda: GenomeArrays.from_dict(gnm))
+        rt = timeit('to_dict', arrs.to_dict)
+        assert GenomeArrays.from_dict(rt).to_dict() == rt
+
+        packer = GenomePacker('bench', 'params', specs.anim)
+        packer.genome = list(arrs.paths)
+        dt, dk = timeit('pack (dict)', lambda: packer.pack(gnm))
+        at, ak = timeit('pack (arrays)', lambda: packer.pack(arrs))
+        assert np.all(dt == at) and np.allclose(dk, ak)
+        timeit('evaluate (all splines)', lambda: arrs.evaluate(0.5))
+
+if __name__ == "__main__":
+    main(map(int, sys.argv[1:]) or [10, 100, 1000])
@@ -14,6 +14,7 @@ import os
 import sys
 import time
 import json
+import shutil
 import warnings
 import argparse
 from subprocess import Popen
@@ -22,12 +23,15 @@ from itertools import ifilter
 import numpy as np
 
 sys.path.insert(0, os.path.dirname(__file__))
-from cuburn import render, filters, output, profile
-from cuburn.genome import convert, use, db
+from cuburn import render, filters, output, profile, archive, preview
+from cuburn.genome import convert, use, db, simplify
 
 def main(args, prof):
     gdb = db.connect(args.genomedb)
     gnm, basename = gdb.get_anim(args.flame, args.half)
+    if args.max_knot_error is not None:
+        gnm, report = simplify.simplify(gnm, args.max_knot_error)
+        simplify.print_report(report, sys.stderr)
     if getattr(args, 'print'):
         print convert.to_json(gnm)
         return
@@ -40,6 +44,7 @@ def main(args, prof):
     dev = cuda.Device(args.device or 0)
     cuctx = dev.make_context(flags=cuda.ctx_flags.SCHED_BLOCKING_SYNC)
 
+    rawring = arc = None
     try:
       rmgr = render.RenderManager()
       arch = 'sm_{}{}'.format(
@@ -48,18 +53,66 @@ def main(args, prof):
       rdr = render.Renderer(gnm, gprof, keep=args.keep, arch=arch)
       last_render_time_ms = 0
 
+      pool = None
+      if ((rdr.proxies or not rdr.out.temporal) and
+              args.encode_threads != 1):
+          pool = output.EncodePool(args.encode_threads, args.encode_depth)
+
+      if args.rawfn:
+          rawring = preview.PreviewWriter(args.rawfn, args.raw_depth)
+      nframes = 0
+
+      if args.archive:
+          arc = archive.ArchiveWriter(profile.get_archive_path(args, basename))
+
+      def write(name, (out, log)):
+          for suffix, file_like in out.items():
+              # Temporal outputs write straight to their destination, and
+              # return its path
+              if isinstance(file_like, basestring):
+                  if arc is not None:
+                      with open(file_like, 'rb') as fp:
+                          arc.add(profile.get_archive_member(file_like), fp)
+                      os.unlink(file_like)
+                  continue
+              assert name is not None, 'Segment %s has no name' % suffix
+              if arc is not None:
+                  arc.add(profile.get_archive_member(name) + suffix, file_like)
+              else:
+                  with open(name + suffix + '.tmp', 'w') as fp:
+                      shutil.copyfileobj(file_like, fp, 1 << 20)
+                  os.rename(name + suffix + '.tmp', name + suffix)
+              if getattr(file_like, 'close', None):
+                  file_like.close()
+          for key, val in log:
+              print >> sys.stderr, '\n=== %s ===' % key
+              print >> sys.stderr, val
+
+      def encode(name, out, buf):
+          return name, out.encode(buf)
+
       for name, times in frames:
+          rdr.out.dest = name
+          for proxy in rdr.proxies:
+              proxy.dest = name
           def save(buf):
-              out, log = rdr.out.encode(buf)
-              for suffix, file_like in out.items():
-                  with open(name + suffix, 'w') as fp:
-                      fp.write(file_like.read())
-                  if getattr(file_like, 'close', None):
-                      file_like.close()
-              for key, val in log:
-                  print >> sys.stderr, '\n=== %s ===' % key
-                  print >> sys.stderr, val
-
+              if pool is None or rdr.out.temporal:
+                  write(name, rdr.out.encode(buf))
+              elif buf is not None:
+                  for done in pool.submit(encode, name, rdr.out, buf):
+                      write(*done)
+              # Proxies are made from the same host buffer, off the main
+              # thread when possible; video proxies take frames in order
+              for proxy in rdr.proxies:
+                  if pool is None or proxy.temporal:
+                      write(name, proxy.encode(buf))
+                  elif buf is not None:
+                      for done in pool.submit(encode, name, proxy, buf):
+                          write(*done)
+
+          # Time the render loop spent blocked in the encoder, during which
+          # the GPU has at most one frame of work queued
+          stall = 0
           evt = buf = next_evt = next_buf = None
           for idx, t in enumerate(list(times) + [None]):
               evt, buf = next_evt, next_buf
@@ -73,12 +126,15 @@ def main(args, prof):
                 evt.synchronize()
               last_render_time_ms = evt.time()
 
+              save_start = time.time()
               save(buf)
+              stall += time.time() - save_start
 
-              if args.rawfn:
+              nframes += 1
+              if rawring is not None:
                   try:
-                      buf.tofile(args.rawfn + '.tmp')
-                      os.rename(args.rawfn + '.tmp', args.rawfn)
+                      raw = buf[0] if isinstance(buf, tuple) else buf
+                      rawring.write(nframes, raw)
                   except:
                       import traceback
                       print >> sys.stderr, 'Failed to write %s: %s' % (
@@ -88,9 +144,27 @@ def main(args, prof):
                   name, idx, len(times), last_render_time_ms)
               sys.stderr.flush()
 
+          flush_start = time.time()
           save(None)
+          if rdr.out.temporal:
+              print >> sys.stderr, ('%s: %.1fs blocked on encoder, %.1fs '
+                  'flushing' % (name, stall, time.time() - flush_start))
+
+      if pool is not None:
+          for done in pool.close():
+              write(*done)
+      # Temporal outputs may still be finishing segments in the background,
+      # writing them to the destinations set before each job, so they come
+      # back as paths rather than needing a name
+      for out in [rdr.out] + rdr.proxies:
+          for done in out.close():
+              write(None, done)
 
     finally:
+      if arc is not None:
+          arc.close()
+      if rawring is not None:
+          rawring.close()
       cuda.Context.pop()
 
 def list_devices():
@@ -115,15 +189,27 @@ if __name__ == "__main__":
         help="Path to genome database (file or directory, default '.')",
         default='.')
     parser.add_argument('--raw', metavar='PATH', type=str, dest='rawfn',
-        help="Target file for raw buffer, to enable previews.")
+        help="Write each raw frame into a shared ring buffer at PATH, to "
+             "enable previews (see cuburn/preview.py).")
+    parser.add_argument('--raw-depth', metavar='NUM', type=int, default=3,
+        help="Number of frames held in the --raw ring (default 3)")
     parser.add_argument('--half', action='store_true',
         help='Use half-loops when converting nodes to animations')
+    parser.add_argument('--max-knot-error', metavar='TOL', type=float,
+        help="Remove spline knots, keeping curves within this distance of "
+             "the original (for magnitudes, such as opacity, in log2 units)")
     parser.add_argument('--print', action='store_true',
         help="Print the blended animation and exit.")
     parser.add_argument('--list-devices', action='store_true',
         help="List devices and exit.")
     parser.add_argument('--device', metavar='NUM', type=int,
         help="GPU device number to use (may differ from nvidia-smi).")
+    parser.add_argument('--encode-threads', metavar='NUM', type=int,
+        help="Threads used to encode still images (default: one per CPU; "
+             "1 encodes on the main thread)")
+    parser.add_argument('--encode-depth', metavar='NUM', type=int,
+        help="Frames waiting to be encoded before rendering blocks (default: "
+             "two per encode thread, in up to 512MB of page-locked memory)")
     parser.add_argument('--keep', action='store_true',
         help="Keep compiled kernels to help with profiling")
     profile.add_args(parser)